@@ -1,15 +1,20 @@
+import os
 from os.path import join
 import cPickle as pickle
 from itertools import product
+from collections import defaultdict
 import numpy as np
-from scipy.io import savemat
 from sklearn.datasets.base import Bunch
 from fit_score import loo_score
 import config as cfg
 from project_dirs import cache_dir, fit_results_relative_path
 from utils.misc import init_array, covariance_to_correlation
-from utils.formats import list_of_strings_to_matlab_cell_array
+from utils.matrix_stats import r2_rows
 from utils import job_splitting
+from utils.derived_fields import get_derived, fingerprint
+from utils.result_arrays import ResultArrays
+from utils.chunked_export import ChunkedExport, open_export, export_filename
+from utils.work_queue import WorkQueue
 import scalers
 
 class Fits(dict):
@@ -21,30 +26,125 @@ class Fits(dict):
 def get_all_fits(data, fitter, k_of_n=None, n_correlation_iterations=0, correlations_k_of_n=None, allow_new_computation=True):
     """Returns { dataset_name -> {(gene,region) -> fit} } for all datasets in 'data'.
     """
-    return Fits({ds.name : _get_dataset_fits(data, ds, fitter, k_of_n, n_correlation_iterations, correlations_k_of_n, allow_new_computation) for ds in data.datasets})
+    # the basic fits of all the datasets are computed together, so the workers don't wait
+    # for the slowest fits of one dataset before starting on the next dataset
+    partition = _get_partition(data, fitter, k_of_n)
+    jobs = [_dataset_fits_job(data, ds, fitter, k_of_n, partition, allow_new_computation) for ds in data.datasets]
+    all_dataset_fits = job_splitting.compute_many(jobs)
+    fits = Fits({ds.name : _complete_dataset_fits(ds, fitter, dataset_fits, k_of_n, n_correlation_iterations, correlations_k_of_n, allow_new_computation) 
+                 for ds,dataset_fits in zip(data.datasets,all_dataset_fits)})
+    fits.k_of_n = k_of_n # needed for caching fields derived from a shard of the fits
+    return fits
 
-def _get_dataset_fits(data, dataset, fitter, k_of_n, n_correlation_iterations, correlations_k_of_n, allow_new_computation):
-    def arg_mapper(gr,f_proxy):
-        g,r = gr
-        series = dataset.get_one_series(g,r)
-        return f_proxy(series,fitter)
-        
+def get_all_fits_with_work_queue(data, fitter, new_queue=False):
+    """Computes the basic fits together with any number of other processes (possibly on other machines)
+       that call this function with the same data and fitter, using a work queue in the cache directory.
+       The genes are split into chunks (most expensive first) and each process computes the chunks it claims. 
+       Returns the fits in the one process that consolidates them after all the chunks are done, and None 
+       in all the other processes (including processes that find the queue already finished).
+       new_queue - start a new queue instead of joining the existing one (e.g. to compute the fits again
+                   after the cache was removed). Processes still working on the old queue stop.
+    """
+    base_filename = fit_results_relative_path(data,fitter)
+    costs = _estimated_gene_costs(data,fitter)
+    genes = sorted(data.gene_names, key=lambda g: -costs[g])
+    n = cfg.work_queue_chunk_size
+    chunks = [genes[i:i+n] for i in xrange(0,len(genes),n)]
+    queue = WorkQueue(join(cache_dir(), base_filename + '-queue.sqlite'), chunks, new=new_queue)
+    if queue.is_finished():
+        print 'The work queue in {} is already finished (use compute_fits.py --new_queue to compute the fits again)'.format(queue.filename)
+        return None
+
+    # each chunk is computed as a shard with a fixed partition, so the results are cached in the usual shard files.
+    # the chunks are taken from the queue, since it may have been created by another process.
+    partition = queue.all_chunks()
+    def compute_chunk(chunk):
+        k_of_n = (partition.index(chunk)+1, len(partition))
+        jobs = [_dataset_fits_job(data, ds, fitter, k_of_n, partition, allow_new_computation=True) for ds in data.datasets]
+        job_splitting.compute_many(jobs)
+    queue.process_all(compute_chunk)
+
+    if not queue.claim_consolidation():
+        return None
+    return get_all_fits(data, fitter)
+
+def _get_partition(data, fitter, k_of_n):
+    """Shards are balanced by the estimated cost of fitting each gene (in all datasets).
+       The partition is determined by the first shard and used by all the others.
+       Computing everything (no sharding) removes the saved partitions, so the next sharded
+       computation can use the timings recorded meanwhile.
+    """
+    base_filename = fit_results_relative_path(data,fitter)
+    if k_of_n is None:
+        job_splitting.remove_partitions(base_filename)
+        return None
+    k,n = k_of_n
+    return job_splitting.balanced_partition(base_filename, data.gene_names, n, lambda: _estimated_gene_costs(data,fitter))
+
+def _count_series_points(ds):
+    """Returns the number of points and of nonzero points of each series (genes x regions).
+       The expression is read a block of genes at a time, so the expression of the whole dataset
+       is never in memory (it's memory mapped).
+    """
+    shape = (len(ds.gene_names), len(ds.region_names))
+    n_points = np.empty(shape, dtype=int)
+    n_nonzero = np.empty(shape, dtype=int)
+    n = cfg.gene_block_size
+    for i in xrange(0, shape[0], n):
+        genes = range(i, min(i+n, shape[0]))
+        for ir in xrange(shape[1]):
+            block = ds.get_series_block(genes, ir)
+            with np.errstate(invalid='ignore'):
+                n_points[genes,ir] = block.valid.sum(axis=0)
+                n_nonzero[genes,ir] = (abs(block.expression) > cfg.nonzero_threshold).sum(axis=0)
+    return n_points, n_nonzero
+
+def _estimated_gene_costs(data, fitter):
+    """Returns dictionary gene -> estimated cost of fitting the gene in all the regions of all the datasets.
+       For series that were fitted before, the cost is the recorded time. Otherwise it is estimated from 
+       the length of the series and the number of parameters of the shape, and converted to seconds using
+       the recorded timings (if there are any). Series that have too few points to fit are cheap.
+    """
+    units = {} # (dataset name, g, r) -> cost in arbitrary units
+    times = {} # (dataset name, g, r) -> recorded seconds
+    for ds in data.datasets:
+        n_points, n_nonzero = _count_series_points(ds)
+        ds_units = n_points * fitter.shape.n_params()
+        ds_units[n_nonzero < cfg.min_nonzero_points_for_fitting] = 1
+        for ig,g in enumerate(ds.gene_names):
+            for ir,r in enumerate(ds.region_names):
+                units[(ds.name,g,r)] = ds_units[ig,ir]
+        for (g,r),seconds in job_splitting.read_timings(fit_results_relative_path(ds,fitter)).iteritems():
+            times[(ds.name,g,r)] = seconds
+
+    rates = [seconds/units[k] for k,seconds in times.iteritems() if k in units]
+    seconds_per_unit = np.median(rates) if rates else 1.0
+    costs = {g:0 for g in data.gene_names}
+    for k,u in units.iteritems():
+        dsname,g,r = k
+        costs[g] += times.get(k, seconds_per_unit*u)
+    return costs
+
+def _dataset_fits_job(data, dataset, fitter, k_of_n, partition, allow_new_computation):
     # sharding is done by gene, so plots.plot_and_save_all_genes can work on a shard
     # this also requires that the list of all genes be taken from the whole data
     # and not from each dataset. Otherwise we can get a mismatch between the genes 
     # in the shard for different datasets.
-    dataset_fits = job_splitting.compute(
-        name = 'fits',
-        f = _compute_fit,
-        arg_mapper = arg_mapper,
+    return job_splitting.job(
+        name = 'fits ({})'.format(dataset.name),
+        f = _compute_dataset_fit,
+        context = Bunch(dataset=dataset, fitter=fitter), # kept resident in the worker processes (the expression is shared, not copied)
         all_keys = list(product(dataset.gene_names,dataset.region_names)),
         all_sharding_keys = data.gene_names,
         f_sharding_key = lambda gr: gr[0],
         k_of_n = k_of_n,
+        partition = partition,
         base_filename = fit_results_relative_path(dataset,fitter),
         allow_new_computation = allow_new_computation,
+        result_arrays = _fit_result_arrays(dataset, fitter),
     )
-    
+
+def _complete_dataset_fits(dataset, fitter, dataset_fits, k_of_n, n_correlation_iterations, correlations_k_of_n, allow_new_computation):
     if n_correlation_iterations > 0:
         # The problem is that if we're using a shard for the basic fits we won't have theta for all genes in a region
         # which is necessary for computing correlations in that region.
@@ -53,19 +153,15 @@ def _get_dataset_fits(data, dataset, fitter, k_of_n, n_correlation_iterations, c
 
     if cfg.verbosity > 0:
         print 'Adding fit scores... ',
-    _add_scores(dataset, dataset_fits)
+    _add_scores(dataset, fitter, dataset_fits, k_of_n)
     if cfg.verbosity > 0:
         print 'done!'
     
     return dataset_fits
 
 def _add_dataset_correlation_fits(dataset, fitter, ds_fits, n_iterations, k_of_n, allow_new_computation):
-    def arg_mapper(key, f_proxy):
-        ir, loo_point = key
-        r = dataset.region_names[ir]
-        series = dataset.get_several_series(dataset.gene_names,r)
-        basic_theta = [ds_fits[(g,r)].theta for g in dataset.gene_names]
-        return f_proxy(series, fitter, basic_theta, loo_point, n_iterations)
+    basic_theta = {r : [ds_fits[(g,r)].theta for g in dataset.gene_names] for r in dataset.region_names}
+    context = Bunch(dataset=dataset, fitter=fitter, basic_theta=basic_theta, n_iterations=n_iterations)
         
     all_keys = []
     for ir,r in enumerate(dataset.region_names):
@@ -86,8 +182,9 @@ def _add_dataset_correlation_fits(dataset, fitter, ds_fits, n_iterations, k_of_n
         
     dct_results = job_splitting.compute(
         name = 'fits-correlations',
-        f = _compute_fit_with_correlations,
-        arg_mapper = arg_mapper,
+        f = _compute_dataset_fit_with_correlations,
+        arg_mapper = None,
+        context = context,
         all_keys = all_keys,
         f_sharding_key = f_sharding_key,
         k_of_n = k_of_n,
@@ -132,40 +229,165 @@ def _add_dataset_correlation_fits_from_results_dictionary(dataset, ds_fits, dct_
                 fit.with_correlations[iLevel].LOO_predictions[orig_ix] = level_prediction
     
 
+def _compute_dataset_fit_with_correlations(context, key):
+    ir, loo_point = key
+    r = context.dataset.region_names[ir]
+    series = context.dataset.get_several_series(context.dataset.gene_names,r)
+    return _compute_fit_with_correlations(series, context.fitter, context.basic_theta[r], loo_point, context.n_iterations)
+
 def _compute_fit_with_correlations(series, fitter, basic_theta, loo_point, n_iterations):
     if cfg.verbosity > 0:
         print 'Computing fit with correlations ({n_iterations} iterations) for LOO point {loo_point} at {series.region_name} using {fitter}'.format(**locals())
     return fitter.fit_multiple_series_with_cache(series.ages, series.expression, basic_theta, loo_point, n_iterations)
 
 
-def _add_scores(dataset,dataset_fits):
-    for (g,r),fit in dataset_fits.iteritems():
-        if g is None:
-            continue  # it's a region fit
-            
-        series = dataset.get_one_series(g,r)
-        try:
-            if fit.fit_predictions is None:
-                fit.fit_score = None
-            else:
-                fit.fit_score = cfg.score(series.single_expression, fit.fit_predictions)
-        except:
-            fit.fit_score = None
-        try:
-            fit.LOO_score = loo_score(series.single_expression, fit.LOO_predictions)
-        except:
-            fit.LOO_score = None
-            
-        # add score for correlation LOO fits
+def _add_scores(dataset, fitter, dataset_fits, k_of_n=None):
+    """Adds the fit scores to the fits. The scores are cached next to the fits and are only 
+       recomputed for fits whose predictions changed.
+    """
+    gene_fits = {(g,r):fit for (g,r),fit in dataset_fits.iteritems() if g is not None} # skip region fits
+    dct_scores = get_derived(
+        name = 'scores',
+        base_filename = fit_results_relative_path(dataset,fitter),
+        dependencies = [cfg.score_type],
+        items = gene_fits,
+        f_fingerprint = _scores_fingerprint,
+        f_compute = lambda dct_fits: _compute_all_scores(dataset, dct_fits),
+        k_of_n = k_of_n,
+    )
+    for (g,r),fit in gene_fits.iteritems():
+        fit.fit_score, fit.LOO_score, correlation_scores = dct_scores[(g,r)]
         correlation_levels = getattr(fit, 'with_correlations', None)
         if correlation_levels is not None:
-            for level in correlation_levels:
-                y_real = series.single_expression
-                y_pred = level.LOO_predictions[series.original_inds] # match the predictions to the indices of the single series after NaN are removed from it
-                level.LOO_score = loo_score(y_real, y_pred)
-            
+            for level,score in zip(correlation_levels, correlation_scores):
+                level.LOO_score = score
     return dataset_fits
 
+def _scores_fingerprint(fit):
+    correlation_levels = getattr(fit, 'with_correlations', None) or []
+    return fingerprint(fit.fit_predictions, fit.LOO_predictions, *[level.LOO_predictions for level in correlation_levels])
+
+def _compute_all_scores(dataset, dct_fits):
+    """Returns {(g,r) -> scores} (see _compute_scores) for all the fits. For R2 scores, the observations and
+       predictions of all the fits in a region are aligned into (genes x ages) arrays (NaN where a series has
+       no value) and the scores of all the fits and correlation levels are computed together.
+    """
+    if cfg.score_type != 'R2':
+        return {(g,r):_compute_scores(dataset,g,r,fit) for (g,r),fit in dct_fits.iteritems()}
+    region_genes = defaultdict(list)
+    for g,r in dct_fits.iterkeys():
+        region_genes[r].append(g)
+    res = {}
+    for r,genes in region_genes.iteritems():
+        block = dataset.get_series_block(genes, r)
+        y = block.expression.T
+        valid = block.valid.T
+        fits = [dct_fits[(g,r)] for g in genes]
+
+        # fit_predictions and LOO_predictions are only for the valid points of each series
+        fit_predictions = _aligned_predictions([fit.fit_predictions for fit in fits], valid)
+        fit_scores = r2_rows(y, fit_predictions, skip_nan=True)
+        fit_scores[(valid & np.isnan(fit_predictions)).any(axis=1)] = np.NaN # r2_score fails on NaN predictions
+
+        # LOO scores ignore the first and last points (see loo_score)
+        y_trimmed = np.where(_without_first_and_last(valid), y, np.NaN)
+        def LOO_scores(predictions, rows=slice(None)):
+            y_rows = y_trimmed[rows]
+            scores = r2_rows(y_rows, predictions, skip_nan=True)
+            n_points = (~np.isnan(y_rows) & ~np.isnan(predictions)).sum(axis=1)
+            scores[n_points < 3] = np.NaN
+            return scores
+        LOO_scores_basic = LOO_scores(_aligned_predictions([fit.LOO_predictions for fit in fits], valid))
+
+        # the LOO predictions of the correlation levels are for all the ages
+        correlation_levels = [getattr(fit, 'with_correlations', None) or [] for fit in fits]
+        correlation_scores = [[] for _ in fits]
+        for i_level in xrange(max([len(levels) for levels in correlation_levels] + [0])):
+            rows = [i for i,levels in enumerate(correlation_levels) if len(levels) > i_level]
+            predictions = np.empty((len(rows), y.shape[1]))
+            for j,i in enumerate(rows):
+                pred = correlation_levels[i][i_level].LOO_predictions
+                predictions[j,:] = np.NaN if pred is None else pred
+            scores = LOO_scores(predictions, rows)
+            for i,score in zip(rows, _with_none(scores)):
+                correlation_scores[i].append(score)
+
+        for g,fit_score,LOO_score,level_scores in zip(genes, _with_none(fit_scores), _with_none(LOO_scores_basic), correlation_scores):
+            res[(g,r)] = fit_score, LOO_score, level_scores
+    return res
+
+def _aligned_predictions(lst_predictions, valid):
+    """Returns (series x ages) predictions, where the predictions of each series (for its valid points only)
+       are placed at its valid ages. Missing predictions (or predictions of the wrong size) are NaN.
+    """
+    n_valid = valid.sum(axis=1)
+    def as_valid(pred, n):
+        if pred is None or len(pred) != n:
+            return np.NaN * np.ones(n)
+        return pred
+    res = np.NaN * np.ones(valid.shape)
+    if len(lst_predictions) > 0:
+        res[valid] = np.concatenate([as_valid(pred,n) for pred,n in zip(lst_predictions, n_valid)]) # fills the rows in order
+    return res
+
+def _without_first_and_last(valid):
+    """Returns a copy of valid without the first and last valid point of each row"""
+    res = valid.copy()
+    rows = np.flatnonzero(valid.any(axis=1))
+    res[rows, np.argmax(valid[rows], axis=1)] = False
+    res[rows, valid.shape[1] - 1 - np.argmax(valid[rows,::-1], axis=1)] = False
+    return res
+
+def _with_none(scores):
+    return [None if np.isnan(s) else float(s) for s in scores]
+
+def _compute_scores(dataset, g, r, fit):
+    """Returns (fit_score, LOO_score, [LOO_score for each correlation level])"""
+    series = dataset.get_one_series(g,r)
+    try:
+        if fit.fit_predictions is None:
+            fit_score = None
+        else:
+            fit_score = cfg.score(series.single_expression, fit.fit_predictions)
+    except:
+        fit_score = None
+    try:
+        LOO_score = loo_score(series.single_expression, fit.LOO_predictions)
+    except:
+        LOO_score = None
+        
+    # add score for correlation LOO fits
+    correlation_scores = []
+    correlation_levels = getattr(fit, 'with_correlations', None)
+    if correlation_levels is not None:
+        for level in correlation_levels:
+            y_real = series.single_expression
+            y_pred = level.LOO_predictions[series.original_inds] # match the predictions to the indices of the single series after NaN are removed from it
+            correlation_scores.append(loo_score(y_real, y_pred))
+    return fit_score, LOO_score, correlation_scores
+
+def _fit_result_arrays(dataset, fitter):
+    """Layout of the fits in shared result arrays (see _compute_fit), or None if they shouldn't be used"""
+    if not cfg.parallel_results_in_shared_arrays or fitter.shape.parameter_type() == object:
+        return None
+    n_params = fitter.shape.n_params()
+    n_ages = len(dataset.ages)
+    return ResultArrays(
+        fields = dict(
+            theta = (n_params,),
+            sigma = (),
+            fit_predictions = (n_ages,),
+            LOO_predictions = (n_ages,),
+            theta_samples = (n_params, cfg.n_parameter_estimate_bootstrap_samples),
+        ),
+        constants = dict(fitter=fitter, seed=cfg.random_seed),
+    )
+
+def _compute_dataset_fit(context, key):
+    g,r = key
+    series = context.dataset.get_one_series(g,r)
+    return _compute_fit(series, context.fitter)
+
 def _compute_fit(series, fitter):
     if cfg.verbosity > 0:
         print 'Computing fit for {}@{} using {}'.format(series.gene_name, series.region_name, fitter)
@@ -201,72 +423,127 @@ def _compute_fit(series, fitter):
         theta_samples = theta_samples,
     )
 
-def save_as_mat_files(data, fitter, fits, has_change_distributions):
+def save_as_mat_files(data, fitter, fits, has_change_distributions, k_of_n=None):
+    """Exports the fits of each dataset in cfg.export_format (see utils/chunked_export.py).
+       With k_of_n, only the genes of the shard are exported, and when the exports of all the
+       shards exist they are merged into the export of the whole dataset.
+    """
+    fmt = cfg.export_format
     for dataset in data.datasets:
-        filename = join(cache_dir(), fit_results_relative_path(dataset,fitter) + '.mat')
+        base_filename = join(cache_dir(), fit_results_relative_path(dataset,fitter))
         dataset_fits = fits[dataset.name]
-    
-        print 'Saving mat file to {}'.format(filename)
+        if k_of_n is None:
+            _export_dataset_fits(dataset, fitter, fits, dataset.gene_names, base_filename, fmt, has_change_distributions)
+        else:
+            shard_genes = {g for g,r in dataset_fits.iterkeys() if g is not None}
+            gene_names = [g for g in dataset.gene_names if g in shard_genes]
+            _export_dataset_fits(dataset, fitter, fits, gene_names, _shard_base_filename(base_filename,k_of_n), fmt, has_change_distributions)
+            _merge_shard_exports(dataset, base_filename, k_of_n, fmt)
+
+def _export_dataset_fits(dataset, fitter, fits, gene_names, base_filename, fmt, has_change_distributions):
+    dataset_fits = fits[dataset.name]
+    with ChunkedExport(base_filename, fmt, cfg.export_float32) as export:
+        print 'Saving {} file to {}'.format(fmt, export.filename)
         shape = fitter.shape
-        
-        gene_names = dataset.gene_names
-        gene_idx = {g:i for i,g in enumerate(gene_names)}
         n_genes = len(gene_names)
         region_names = dataset.region_names
-        region_idx = {r:i for i,r in enumerate(region_names)}
         n_regions = len(region_names)
-        
+        n_ages = len(dataset.ages)
+        export.set('gene_names', list(gene_names))
+        export.set('region_names', list(region_names))
+
         write_theta = shape.can_export_params_to_matlab()
         if write_theta:
-            theta = init_array(np.NaN, shape.n_params(), n_genes,n_regions)
+            theta = export.create('theta', (shape.n_params(), n_genes, n_regions))
         else:
-            theta = np.NaN
-        
-        fit_scores = init_array(np.NaN, n_genes,n_regions)
-        LOO_scores = init_array(np.NaN, n_genes,n_regions)
-        fit_predictions = init_array(np.NaN, *dataset.expression.shape)
-        LOO_predictions = init_array(np.NaN, *dataset.expression.shape)
-        high_res_predictions = init_array(np.NaN, cfg.n_curve_points_to_plot, n_genes, n_regions)
+            export.set('theta', np.NaN)
+        fit_scores = export.create('fit_scores', (n_genes,n_regions))
+        LOO_scores = export.create('LOO_scores', (n_genes,n_regions))
+        fit_predictions = export.create('fit_predictions', (n_ages,n_genes,n_regions))
+        LOO_predictions = export.create('LOO_predictions', (n_ages,n_genes,n_regions))
+        high_res_predictions = export.create('high_res_predictions', (cfg.n_curve_points_to_plot,n_genes,n_regions))
         scaled_high_res_ages = np.linspace(dataset.ages.min(), dataset.ages.max(), cfg.n_curve_points_to_plot)
-        original_high_res_ages = scalers.unify(dataset.age_scaler).unscale(scaled_high_res_ages)
+        export.set('high_res_ages', scalers.unify(dataset.age_scaler).unscale(scaled_high_res_ages))
         if has_change_distributions:
             change_distribution_bin_centers = fits.change_distribution_params.bin_centers
-            n_bins = len(change_distribution_bin_centers)
-            change_distribution_weights = init_array(np.NaN, n_bins, n_genes, n_regions)
+            export.set('change_distribution_bin_centers', change_distribution_bin_centers)
+            change_distribution_weights = export.create('change_distribution_weights', (len(change_distribution_bin_centers),n_genes,n_regions))
         else:
-            change_distribution_bin_centers = []
-            change_distribution_weights = []
-        for (g,r),fit in dataset_fits.iteritems():
-            series = dataset.get_one_series(g,r)
-            ig = gene_idx[g]
-            ir = region_idx[r]
-            fit_scores[ig,ir] = fit.fit_score
-            LOO_scores[ig,ir] = fit.LOO_score
-            if write_theta and fit.theta is not None:
-                theta[:,ig,ir] = fit.theta
-            if fit.fit_predictions is not None:
-                fit_predictions[series.original_inds,ig,ir] = fit.fit_predictions
-            if fit.LOO_predictions is not None:
-                LOO_predictions[series.original_inds,ig,ir] = fit.LOO_predictions
-            if fit.theta is not None:
-                high_res_predictions[:,ig,ir] = shape.f(fit.theta, scaled_high_res_ages)
-            change_weights = getattr(fit,'change_distribution_weights',None)
-            if change_weights is not None:
-                change_distribution_weights[:,ig,ir] = change_weights
-        mdict = dict(
-            gene_names = list_of_strings_to_matlab_cell_array(gene_names),
-            region_names = list_of_strings_to_matlab_cell_array(region_names),
-            theta = theta,
-            fit_scores = fit_scores,
-            LOO_scores = LOO_scores,
-            fit_predictions = fit_predictions,
-            LOO_predictions = LOO_predictions,
-            high_res_predictions = high_res_predictions,
-            high_res_ages = original_high_res_ages,
-            change_distribution_bin_centers = change_distribution_bin_centers,
-            change_distribution_weights = change_distribution_weights,
-        )
-        savemat(filename, mdict, oned_as='column')
+            export.set('change_distribution_bin_centers', np.array([]))
+            export.set('change_distribution_weights', np.array([]))
+
+        # fill a block of genes at a time, so the memory doesn't depend on the number of genes
+        for i_from in xrange(0, n_genes, cfg.export_gene_block_size):
+            block_genes = gene_names[i_from : i_from + cfg.export_gene_block_size]
+            genes = slice(i_from, i_from + len(block_genes))
+            for ir,r in enumerate(region_names):
+                block = dataset.get_series_block(block_genes, r) # for the valid points of all the series in the region
+                block_fits = [dataset_fits.get((g,r)) for g in block_genes]
+                has_fit = np.array([fit is not None for fit in block_fits])
+                if not has_fit.any():
+                    continue
+                fits_or_none = lambda f: [f(fit) if fit is not None else None for fit in block_fits]
+                fit_scores[genes,ir] = _as_floats(fits_or_none(lambda fit: fit.fit_score))
+                LOO_scores[genes,ir] = _as_floats(fits_or_none(lambda fit: fit.LOO_score))
+                valid = block.valid.T & has_fit[:,np.newaxis]
+                fit_predictions[:,genes,ir] = _aligned_predictions(fits_or_none(lambda fit: fit.fit_predictions), valid).T
+                LOO_predictions[:,genes,ir] = _aligned_predictions(fits_or_none(lambda fit: fit.LOO_predictions), valid).T
+                with_theta = [i for i,fit in enumerate(block_fits) if fit is not None and fit.theta is not None]
+                if with_theta:
+                    thetas = [block_fits[i].theta for i in with_theta]
+                    block_high_res = np.NaN * np.ones((len(block_genes), len(scaled_high_res_ages)))
+                    block_high_res[with_theta,:] = shape.f_batch(thetas, scaled_high_res_ages)
+                    high_res_predictions[:,genes,ir] = block_high_res.T
+                    if write_theta:
+                        block_theta = np.NaN * np.ones((shape.n_params(), len(block_genes)))
+                        block_theta[:,with_theta] = np.array(thetas).T
+                        theta[:,genes,ir] = block_theta
+                if has_change_distributions:
+                    block_weights = np.NaN * np.ones((len(block_genes), len(change_distribution_bin_centers)))
+                    for i,fit in enumerate(block_fits):
+                        change_weights = getattr(fit,'change_distribution_weights',None)
+                        if change_weights is not None:
+                            block_weights[i,:] = change_weights
+                    change_distribution_weights[:,genes,ir] = block_weights.T
+
+def _shard_base_filename(base_filename, k_of_n):
+    k,n = k_of_n
+    return '{}.{}-of-{}'.format(base_filename,k,n)
+
+def _merge_shard_exports(dataset, base_filename, k_of_n, fmt):
+    """Merges the exports of all the shards into the export of the dataset, if all the shards were exported"""
+    _,n = k_of_n
+    shard_filenames = [export_filename(_shard_base_filename(base_filename,(k,n)), fmt) for k in xrange(1,n+1)]
+    n_missing = len([f for f in shard_filenames if not os.path.exists(f)])
+    if n_missing > 0:
+        print 'Waiting for the exports of {}/{} more shards before merging them'.format(n_missing, n)
+        return
+    with ChunkedExport(base_filename, fmt, cfg.export_float32) as export:
+        print 'Merging the exports of {} shards into {}'.format(n, export.filename)
+        g2i = {g:i for i,g in enumerate(dataset.gene_names)}
+        n_genes = len(dataset.gene_names)
+        export.set('gene_names', list(dataset.gene_names))
+        arrays = {}
+        for i,filename in enumerate(shard_filenames):
+            with open_export(filename, fmt) as shard:
+                inds = [g2i[g] for g in shard['gene_names']] # the genes are in the order of the dataset
+                for name,val in shard.iteritems():
+                    if name == 'gene_names':
+                        continue
+                    is_per_gene = name in _per_gene_export_fields and getattr(val,'ndim',0) >= 2 # the genes are the next to last axis
+                    if not is_per_gene:
+                        if i == 0:
+                            export.set(name, np.asarray(val) if hasattr(val,'dtype') else val) # read h5py datasets (they can't be assigned to another file)
+                        continue
+                    if name not in arrays:
+                        arrays[name] = export.create(name, val.shape[:-2] + (n_genes,val.shape[-1]))
+                    if inds:
+                        arrays[name][...,inds,:] = val[...]
+
+_per_gene_export_fields = ['theta', 'fit_scores', 'LOO_scores', 'fit_predictions', 'LOO_predictions', 'high_res_predictions', 'change_distribution_weights']
+
+def _as_floats(values):
+    return np.array([np.NaN if v is None else v for v in values], dtype=float)
 
 def save_theta_text_files(data, fitter, fits):
     assert fitter.shape.cache_name() == 'spline', "save to text is only supported for splines at the moment"
@@ -15,6 +15,10 @@ default_figure_facecolor = 0.85 * np.ones(3)
 default_figure_dpi = 100
 
 n_curve_points_to_plot = 200
+plot_with_templates = True # render the figures of all the series/genes by updating one figure per worker (see figure_templates.py)
+plot_batch_size = 100 # figures rendered by each parallel job when plot_with_templates is set
+plot_dpi = None # dpi of these figures (None means default_figure_dpi)
+plot_thumbnail_dpi = None # if set, also save low resolution thumbnails of these figures, used for inline images in the HTML
 
 b_verbose_optmization = False
 b_allow_less_restarts = True
@@ -25,8 +29,14 @@ if b_minimal_restarts:
 else:
     n_optimization_restarts = 10
 job_batch_size = 128
+job_checkpoint_seconds = 300 # also save a checkpoint when this much time passed since the last one
+job_max_attempts = 2 # a key that fails this many times is skipped
+work_queue_chunk_size = 20 # genes per chunk when computing with a work queue (compute_fits.py --queue)
+work_queue_lease_seconds = 1800
+work_queue_poll_seconds = 60
 parallel_n_jobs = -2 #1
 parallel_run_locally = False # disable parallelization for debugging
+parallel_results_in_shared_arrays = False # workers write numeric fits into memory mapped arrays instead of returning them
 
 n_folds = 30 # 0 is LOO
 
@@ -35,9 +45,21 @@ log_scale_x0 = -38.0/52
 fitter_scaling_percentiles = (10,90)
 
 n_parameter_estimate_bootstrap_samples = 30
+change_distribution_chunk_size = 1000 # fits whose change distributions are computed together (bounds the memory)
+dprime_baseline_mode = 'sampling' # 'sampling' or 'analytic' (see timing/region_pairs.py)
+timing_arrays_float32 = False # save the change distributions and d-prime cube of all the fits in single precision
+export_format = 'mat' # format of compute_fits.py --mat: 'mat', 'h5' (requires h5py) or 'npy' (see utils/chunked_export.py)
+export_float32 = False # export the fits in single precision
+export_gene_block_size = 1000 # genes that are exported together (bounds the memory for the 'h5' and 'npy' formats)
+gene_block_size = 1000 # genes that are read together when going over the expression of a whole dataset (bounds the memory)
 min_nonzero_points_for_fitting = 5
 nonzero_threshold = 1E-6
 
+# reduced settings for fitting permuted series (see permutation_null.py)
+null_n_folds = 5
+null_n_optimization_restarts = 2
+null_batch_size = 20 # permutations of a series that are generated and fitted together
+
 # these two settings must change together
 from sklearn.metrics import r2_score as score
 score_type = 'R2'
@@ -0,0 +1,192 @@
+"""
+Headless rendering of the figures for all the series and genes (see plots.plot_and_save_all_series
+and plots.plot_and_save_all_genes).
+
+Building a matplotlib figure takes longer than drawing it - the axes, the age ticks, the labels and the
+legend are created from scratch for every figure. Here each worker process builds a figure template once,
+using the Agg backend directly (no pyplot). For each series only the artists of the data and the fit and
+the titles are replaced before the figure is saved. The figures are the same as the ones drawn by
+plots.plot_one_series and plots._plot_gene_inner.
+"""
+
+import os.path
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from sklearn.datasets.base import Bunch
+import config as cfg
+from fit_score import loo_score
+from utils.misc import ensure_dir, rect_subplot
+from dev_stages import dev_stages
+from plots import add_age_ticks, thumbnail_filename
+
+def save_series_figures(jobs):
+    """jobs - list of the arguments of plots._plot_series_job"""
+    for series, fit, filename, use_correlations, change_distribution, figure_kw in jobs:
+        print 'Saving figure for {}@{}'.format(series.gene_name, series.region_name)
+        if use_correlations:
+            preds = fit.with_correlations.LOO_predictions
+        else:
+            preds = fit.LOO_predictions
+        template = _get_template(SeriesFigure, series.age_scaler, **(figure_kw or {}))
+        template.update(series, fit.fitter.shape, fit.theta, preds, change_distribution)
+        template.save(filename, b_thumbnail=True)
+
+def save_gene_figures(jobs):
+    """jobs - list of the arguments of plots._plot_genes_job"""
+    for gene, region_series_fits, filename, bin_centers in jobs:
+        print 'Saving figure for gene {}'.format(gene)
+        age_scaler = region_series_fits[0][1].age_scaler
+        template = _get_template(GeneFigure, age_scaler, n_regions=len(region_series_fits))
+        template.update(gene, region_series_fits, bin_centers)
+        template.save(filename)
+
+class FigureTemplate(object):
+    def __init__(self):
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
+
+    def save(self, filename, b_thumbnail=False):
+        """Saves the figure like plots.save_figure, at cfg.plot_dpi, and a thumbnail if b_thumbnail
+           and cfg.plot_thumbnail_dpi is set (only the series figures have thumbnails in the HTML)
+        """
+        self.fig.set_size_inches(cfg.default_figure_size_x_square, cfg.default_figure_size_y)
+        dpi = cfg.plot_dpi if cfg.plot_dpi is not None else cfg.default_figure_dpi
+        self.fig.savefig(filename, facecolor='white', dpi=dpi)
+        if b_thumbnail and cfg.plot_thumbnail_dpi is not None:
+            thumbnail = thumbnail_filename(filename)
+            ensure_dir(os.path.dirname(thumbnail))
+            self.fig.savefig(thumbnail, facecolor='white', dpi=cfg.plot_thumbnail_dpi)
+
+class SeriesFigure(FigureTemplate):
+    """The figure of a single series (see plots.plot_one_series)"""
+    def __init__(self, age_scaler, minimal_annotations=False, show_legend=True):
+        super(SeriesFigure, self).__init__()
+        ax = self.fig.add_subplot(111)
+        self.series_axes = SeriesAxes(ax, age_scaler, minimal_annotations, show_legend)
+        fontsize = self.series_axes.fontsize
+        ax.set_ylabel('expression level', fontsize=fontsize)
+        ax.set_xlabel('age', fontsize=fontsize)
+        self.minimal_annotations = minimal_annotations
+
+    def update(self, series, shape=None, theta=None, LOO_predictions=None, change_distribution=None):
+        ttl = self.series_axes.update(series, shape, theta, LOO_predictions, change_distribution)
+        if not self.minimal_annotations:
+            self.series_axes.ax.set_title(ttl, fontsize=self.series_axes.fontsize)
+
+class GeneFigure(FigureTemplate):
+    """The figure of a gene with a subplot for each region (see plots._plot_gene_inner)"""
+    def __init__(self, age_scaler, n_regions):
+        super(GeneFigure, self).__init__()
+        nRows, nCols = rect_subplot(n_regions)
+        self.all_series_axes = []
+        for iRegion in xrange(n_regions):
+            ax = self.fig.add_subplot(nRows, nCols, iRegion+1)
+            if iRegion % nCols == 0:
+                ax.set_ylabel('expression level')
+            self.all_series_axes.append(SeriesAxes(ax, age_scaler, minimal_annotations=True))
+        # the layout of a new figure (tight_layout depends on the current size and layout)
+        self.initial_size = self.fig.get_size_inches().copy()
+        params = self.fig.subplotpars
+        self.initial_subplot_params = dict(left=params.left, right=params.right, bottom=params.bottom, top=params.top,
+                                           wspace=params.wspace, hspace=params.hspace)
+        self.suptitle = self.fig.suptitle('')
+
+    def update(self, gene, region_series_fits, change_distribution_bin_centers=None):
+        for series_axes,(r,series,fit) in zip(self.all_series_axes, region_series_fits):
+            if change_distribution_bin_centers is None or not hasattr(fit, 'change_distribution_weights'):
+                change_distribution = None
+            else:
+                change_distribution = Bunch(
+                    centers = change_distribution_bin_centers,
+                    weights = fit.change_distribution_weights,
+                )
+            series_axes.update(series, fit.fitter.shape, fit.theta, change_distribution=change_distribution)
+            series_axes.ax.set_title('Region {}'.format(r))
+        # the tick labels and titles change with the gene, so the layout is computed for each gene,
+        # starting from the layout of a new figure like _plot_gene_inner
+        self.fig.set_size_inches(self.initial_size)
+        self.fig.subplots_adjust(**self.initial_subplot_params)
+        # a renderer for the current size (by default matplotlib 1.4 uses the one of the last saved figure)
+        self.fig.tight_layout(renderer=self.fig.canvas.get_renderer(), h_pad=0, w_pad=0)
+        self.suptitle.set_text('Gene {}'.format(gene))
+
+class SeriesAxes(object):
+    """The artists that show one series in an axes. The axes, its ticks and labels, the data points and the
+       birth line are created once. The artists that depend on the fit (fit line, LOO residuals and change
+       distribution bars) are removed and added again for each series, the same way plot_one_series adds them,
+       so the limits and the legend are the same as in plot_one_series.
+    """
+    def __init__(self, ax, age_scaler, minimal_annotations=False, show_legend=True):
+        self.ax = ax
+        self.fontsize = cfg.minimal_annotation_fontsize if minimal_annotations else cfg.fontsize
+        self.show_legend = show_legend and not minimal_annotations
+        markersize = 8 if not minimal_annotations else 4
+        self.points, = ax.plot([], [], 'ks', markersize=markersize)
+        self.birth_line = add_age_ticks(ax, age_scaler, self.fontsize)
+        self.fit_artists = []
+        if not minimal_annotations:
+            ax.tick_params(axis='y', labelsize=self.fontsize)
+
+    def update(self, series, shape=None, theta=None, LOO_predictions=None, change_distribution=None):
+        """Shows the series and returns its title"""
+        ax = self.ax
+        x = series.ages
+        y = series.single_expression
+        for artist in self.fit_artists + [self.birth_line]:
+            artist.remove()
+        self.fit_artists = []
+        ax.legend_ = None
+
+        # the limits are updated in the same order as plot_one_series adds the artists
+        self.points.set_data(x, y)
+        ax.relim()
+        ax.autoscale_view()
+        self.birth_line.set_ydata(ax.get_ylim())
+        ax.add_line(self.birth_line)
+        ax.autoscale_view()
+
+        if change_distribution:
+            ymin, ymax = ax.get_ylim()
+            centers = change_distribution.centers
+            width = centers[1] - centers[0]
+            weights = change_distribution.weights * (0.9 * (ymax - ymin) / change_distribution.weights.max())
+            self.fit_artists.extend(ax.bar(centers, weights, width=width, bottom=ymin, color='g', alpha=0.5))
+
+        ttl = '{}@{}'.format(series.gene_name, series.region_name)
+        if shape is not None and theta is not None:
+            ttl = '{}, {} fit'.format(ttl, shape)
+            more_ttl = shape.format_params(theta, series.age_scaler, latex=True)
+            if more_ttl:
+                ttl = '\n'.join([ttl, more_ttl])
+
+            score = cfg.score(y,shape.f(theta,x))
+            x_smooth,y_smooth = shape.high_res_preds(theta,x)
+            label = 'fit ({}={:.3g})'.format(cfg.score_type, score)
+            self.fit_artists.extend(ax.plot(x_smooth, y_smooth, 'b-', linewidth=3, label=label))
+
+            if LOO_predictions is not None:
+                score = loo_score(y,LOO_predictions)
+                for i,(xi,yi,y_loo) in enumerate(zip(x,y,LOO_predictions)):
+                    if y_loo is None or np.isnan(y_loo):
+                        continue
+                    label = 'LOO ({}={:.3g})'.format(cfg.score_type, score) if i==0 else None
+                    self.fit_artists.extend(ax.plot([xi, xi], [yi, y_loo], '-', color='0.5', label=label))
+                    self.fit_artists.extend(ax.plot(xi, y_loo, 'x', color='0.5', markeredgewidth=2))
+            if self.show_legend:
+                ax.legend(fontsize=self.fontsize, frameon=False)
+        return ttl
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+_templates = {} # kept for the lifetime of the worker process
+
+def _get_template(cls, age_scaler, **kw):
+    age_ticks = tuple(stage.scaled(age_scaler).central_age for stage in dev_stages)
+    key = (cls, age_ticks, tuple(sorted(kw.iteritems())))
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = cls(age_scaler, **kw)
+    return template
@@ -0,0 +1,204 @@
+"""
+An index over loaded fits, for analyses that run many queries against the same fits.
+
+iterate_fits() scans every fit in every dataset for each query. FitsIndex does one pass
+over the fits when it is built and keeps:
+  * postings - for each gene / region, the positions of the fits for it
+  * orderings - for each score (and region), the positions of the fits sorted by that score
+so queries like "all fits with LOO_score >= t in region r" or "top k fits by R2" are answered
+with a binary search / slice instead of a full scan.
+
+Positions are indices into FitsIndex.keys, which holds (dsname,g,r) for every gene fit.
+Region fits (the (None,r) keys added for correlations) are not indexed.
+"""
+
+import numpy as np
+from collections import defaultdict
+
+class FitsIndex(object):
+    def __init__(self, fits):
+        self.fits = fits
+        self.keys = [] # position -> (dsname,g,r)
+        self._fits = [] # position -> fit
+        for dsname,dsfits in fits.iteritems():
+            for (g,r),fit in dsfits.iteritems():
+                if g is None:
+                    continue  # skip region fits
+                self.keys.append( (dsname,g,r) )
+                self._fits.append(fit)
+        self.key_to_position = {key:i for i,key in enumerate(self.keys)}
+        self.has_theta = np.array([fit.theta is not None for fit in self._fits], dtype=bool)
+
+        gene_postings = defaultdict(list)
+        region_postings = defaultdict(list)
+        for i,(dsname,g,r) in enumerate(self.keys):
+            gene_postings[g].append(i)
+            region_postings[r].append(i)
+        self.gene_postings = {g:np.array(lst) for g,lst in gene_postings.iteritems()}
+        self.region_postings = {r:np.array(lst) for r,lst in region_postings.iteritems()}
+
+        self._scores = {} # score name -> array of scores by position (NaN where missing)
+        self._orderings = {} # (score name, region) -> (positions sorted by score, sorted scores)
+        self._positive_transitions = {} # shape cache name -> boolean array by position
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def gene_names(self):
+        return sorted(self.gene_postings.iterkeys())
+
+    @property
+    def region_names(self):
+        return sorted(self.region_postings.iterkeys())
+
+    def fit_at(self, i):
+        return self._fits[i]
+
+    def get_fit(self, dsname, g, r):
+        i = self.key_to_position.get( (dsname,g,r) )
+        return self._fits[i] if i is not None else None
+
+    def scores(self, score='LOO_score'):
+        """Returns an array with the given score for each position. Missing scores are NaN."""
+        res = self._scores.get(score)
+        if res is None:
+            def as_float(x):
+                return np.NaN if x is None else x
+            res = np.array([as_float(getattr(fit,score,None)) for fit in self._fits], dtype=float)
+            self._scores[score] = res
+        return res
+
+    #####################################################################
+    # Queries
+    #####################################################################
+
+    def query(self, genes=None, regions=None, min_score=None, score='LOO_score', allow_no_theta=False):
+        """Returns the (sorted) positions of all the fits matching all the given conditions:
+             genes/regions - sequence of names to restrict to (None = all)
+             min_score - keep only fits with score >= min_score (same as R2_threshold in iterate_fits)
+             allow_no_theta - also return fits where the fitting failed or was skipped
+        """
+        if isinstance(genes, basestring):
+            genes = [genes]
+        if isinstance(regions, basestring):
+            regions = [regions]
+        if min_score is not None:
+            if regions is None:
+                inds = self._above(score, None, min_score)
+            else:
+                inds = np.concatenate([self._above(score, r, min_score) for r in regions] + [np.array([],dtype=int)])
+        elif regions is not None:
+            inds = np.concatenate([self.region_postings.get(r,np.array([],dtype=int)) for r in regions] + [np.array([],dtype=int)])
+        else:
+            inds = None
+        if genes is not None:
+            gene_inds = np.concatenate([self.gene_postings.get(g,np.array([],dtype=int)) for g in genes] + [np.array([],dtype=int)])
+            inds = gene_inds if inds is None else np.intersect1d(inds, gene_inds)
+        if inds is None:
+            inds = np.arange(len(self.keys))
+        inds = np.unique(inds.astype(int))
+        if not allow_no_theta:
+            inds = inds[self.has_theta[inds]]
+        return inds
+
+    def top_k(self, k, score='LOO_score', region=None, allow_no_theta=False):
+        """Returns the positions of the k fits with the highest score (highest first)"""
+        positions, _ = self._ordering(score, region)
+        res = []
+        for i in positions[::-1]:
+            if len(res) >= k:
+                break
+            if allow_no_theta or self.has_theta[i]:
+                res.append(i)
+        return np.array(res, dtype=int)
+
+    def top_k_genes(self, k, score='LOO_score', region=None):
+        """Returns the k genes whose best fit (over regions) has the highest score (highest first)"""
+        positions, _ = self._ordering(score, region)
+        res = []
+        seen = set()
+        for i in positions[::-1]:
+            if len(res) >= k:
+                break
+            g = self.keys[i][1]
+            if self.has_theta[i] and g not in seen:
+                seen.add(g)
+                res.append(g)
+        return res
+
+    def transitions(self, shape, positive, positions=None):
+        """Returns the positions of the fits whose transition direction is positive (or negative).
+           Only fits with theta are considered. shape should support is_positive_transition()
+           (e.g. Sigmoid, Sigslope). Optionally filter an existing set of positions.
+        """
+        is_positive = self._positive_transitions.get(shape.cache_name())
+        if is_positive is None:
+            is_positive = np.zeros(len(self.keys), dtype=bool)
+            for i in self.has_theta.nonzero()[0]:
+                is_positive[i] = shape.is_positive_transition(self._fits[i].theta)
+            self._positive_transitions[shape.cache_name()] = is_positive
+        if positions is None:
+            positions = self.has_theta.nonzero()[0]
+        else:
+            positions = positions[self.has_theta[positions]]
+        if positive:
+            return positions[is_positive[positions]]
+        else:
+            return positions[~is_positive[positions]]
+
+    def genes_of(self, positions):
+        return sorted(set(self.keys[i][1] for i in positions))
+
+    def iterate(self, other=None, R2_threshold=None, allow_no_theta=False, return_keys=False, genes=None, regions=None):
+        """Same semantics as iterate_fits(), but uses the index.
+           other - optional FitsIndex to pair with (like fits2 in iterate_fits).
+           genes/regions - optional restriction of the iteration.
+        """
+        positions = self.query(genes=genes, regions=regions, min_score=R2_threshold, allow_no_theta=allow_no_theta)
+        if other is not None:
+            other_scores = other.scores() if R2_threshold is not None else None
+        for i in positions:
+            key = self.keys[i]
+            fit = self._fits[i]
+            if other is None:
+                if return_keys:
+                    yield key + (fit,)
+                else:
+                    yield fit
+            else:
+                j = other.key_to_position[key]
+                if not allow_no_theta and not other.has_theta[j]:
+                    continue
+                if R2_threshold is not None and not (other_scores[j] >= R2_threshold):
+                    continue
+                fit2 = other._fits[j]
+                if return_keys:
+                    yield key + (fit,fit2)
+                else:
+                    yield fit,fit2
+
+    #####################################################################
+    # Private helper methods
+    #####################################################################
+
+    def _ordering(self, score, region):
+        k = (score,region)
+        res = self._orderings.get(k)
+        if res is None:
+            if region is None:
+                positions = np.arange(len(self.keys))
+            else:
+                positions = self.region_postings.get(region,np.array([],dtype=int))
+            vals = self.scores(score)[positions]
+            valid = ~np.isnan(vals)
+            positions, vals = positions[valid], vals[valid]
+            order = np.argsort(vals, kind='mergesort')
+            res = (positions[order], vals[order])
+            self._orderings[k] = res
+        return res
+
+    def _above(self, score, region, threshold):
+        positions, vals = self._ordering(score, region)
+        i = np.searchsorted(vals, threshold, side='left')
+        return positions[i:]
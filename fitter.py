@@ -196,7 +196,7 @@ class Fitter(object):
         
         def E(P):
             theta = P.reshape(m,p)
-            R = y - mat([self.shape.f(t,x) for t in theta]).T
+            R = y - mat(self.shape.f_batch(theta,x)).T
             R[invalid] = 0  # ignores contribution of positions where y is unknown
             res = np.trace(R * L * R.T)
             if self.shape.priors is not None:
@@ -205,16 +205,13 @@ class Fitter(object):
             
         def E_grad(P):
             theta = P.reshape(m,p)
-            R = y - mat([self.shape.f(t,x) for t in theta]).T
+            R = y - mat(self.shape.f_batch(theta,x)).T
             R[invalid] = 0  # ignores contribution of positions where y is unknown            
             DR = np.array(-2*L*R.T)
-            grad = np.empty(theta.shape)
-            for k,t in enumerate(theta):
-                Dk = self.shape.f_grad(t,x)
-                for j,Dkj in enumerate(Dk):
-                    grad[k,j] = np.dot(DR[k], Dkj)
-                if self.shape.priors is not None:
-                    grad[k,:] = grad[k,:] - self.shape.d_log_prob_theta(t)                    
+            D = self.shape.f_grad_batch(theta,x) # m x p x n
+            grad = np.einsum('kn,kjn->kj', DR, D)
+            if self.shape.priors is not None:
+                grad = grad - np.array([self.shape.d_log_prob_theta(t) for t in theta])
             res = grad.reshape(m*p)
             return res
         
@@ -236,8 +233,9 @@ class Fitter(object):
            Gaussian distribution, given the other y values. See Bishop p. 87, eq. 2.75.
         """        
         assert np.isnan(y_other[k])
-        y0 = self.shape.f(theta[k],x)
-        dy_other = np.array([yi - self.shape.f(t,x) for t,yi in zip(theta,y_other)]) # dy_other[k] will be NaN
+        y_fit = self.shape.f_batch(theta, np.array([x]))[:,0]
+        y0 = y_fit[k]
+        dy_other = np.asarray(y_other) - y_fit # dy_other[k] will be NaN
         dy_other[np.isnan(dy_other)] = 0 # ignore in dot product (includes index k)
         dy = -np.dot(dy_other,L[k,:]) / L[k,k]
         return y0 + dy
@@ -283,9 +281,7 @@ class Fitter(object):
         """Maximum likelihood for the covariance matrix is just the empirical covariance
            matrix. See Bishop p. 93-94
         """
-        f_vals = np.empty(y.shape)
-        for i,ti in enumerate(theta):
-            f_vals[:,i] = self.shape.f(ti,x)
+        f_vals = self.shape.f_batch(theta,x).T
         r = y - f_vals
         r = np.ma.masked_array(r, np.isnan(r))
         C = np.ma.cov(r,rowvar=0)
@@ -1,12 +1,16 @@
 import cPickle as pickle
-from os.path import join, splitext, basename, isfile
+import os
+import atexit
+import shutil
+import tempfile
+from os.path import join, splitext, basename, isfile, isdir
 from collections import defaultdict
 import numpy as np
 from scipy.io import loadmat
 import project_dirs
 import config as cfg
 from utils.formats import matlab_cell_array_to_list_of_strings, read_strings_from_file
-from utils.misc import get_unique
+from utils.misc import get_unique, ensure_dir
 from sklearn.datasets.base import Bunch
 
 def load_kang_tree_distances():
@@ -118,6 +122,7 @@ class GeneData(object):
     def __init__(self, datasets, name):
         self.datasets = datasets
         self.name = name
+        self._names = None # cached gene names, region names and region -> datasets (see _get_names)
         
     @staticmethod
     def load(dataset):
@@ -154,28 +159,19 @@ class GeneData(object):
 
     @property
     def gene_names(self):
-        s = set()
-        for ds in self.datasets:
-            s.update(ds.gene_names)
-        return sorted(s)
+        return list(self._get_names().gene_names)
     
     @property
     def region_names(self):
-        region_names = []
-        for ds in self.datasets:
-            region_names.extend(cfg.sorted_regions[ds.name])
-        return region_names
+        return list(self._get_names().region_names)
 
     def region_to_dataset(self):
-        res = {}
-        for ds in self.datasets:
-            for r in ds.region_names:
-                res[r] = ds.name
-        return res
+        return {r:datasets[-1].name for r,datasets in self._get_names().region_datasets.iteritems()}
 
     def restrict_pathway(self, pathway, ad_hoc_genes=None, allow_missing_genes=True):
         for ds in self.datasets:
             ds.restrict_pathway(pathway, ad_hoc_genes, allow_missing_genes)
+        self._names = None
         return self
 
     def restrict_ages(self, restriction_name, from_age=-10, to_age=1000):
@@ -191,6 +187,7 @@ class GeneData(object):
     def restrict_regions(self, lst_regions):
         for ds in self.datasets:
             ds.restrict_regions(lst_regions)
+        self._names = None
         return self
         
     def scale_ages(self, scaler):
@@ -204,7 +201,7 @@ class GeneData(object):
         return self
     
     def get_one_series(self, iGene, iRegion, allow_missing=False):
-        for ds in self.datasets:
+        for ds in self._datasets_for(iRegion):
             series = ds.get_one_series(iGene, iRegion, allow_missing=True)
             if series is not None:
                 return series
@@ -213,17 +210,54 @@ class GeneData(object):
         raise AssertionError('{}@{} not found in the datasets'.format(iGene,iRegion))
     
     def get_several_series(self, genes, iRegion, allow_missing=False):
-        for ds in self.datasets:
+        for ds in self._datasets_for(iRegion):
             series = ds.get_several_series(genes, iRegion, allow_missing=True)
             if series is not None:
                 return series
         if allow_missing:
             return None
         raise AssertionError('{}@{} not found in the datasets'.format(genes,iRegion))
+
+    def get_series_block(self, genes, iRegion, allow_missing=False):
+        """See OneDataset.get_series_block()"""
+        for ds in self._datasets_for(iRegion):
+            block = ds.get_series_block(genes, iRegion, allow_missing=True)
+            if block is not None:
+                return block
+        if allow_missing:
+            return None
+        raise AssertionError('{}@{} not found in the datasets'.format(genes,iRegion))
         
     def get_dataset_for_region(self, region_name):
-        res = {ds.name for ds in self.datasets if region_name in ds.region_names}
-        return get_unique(res)
+        datasets = self._get_names().region_datasets.get(region_name, [])
+        return get_unique({ds.name for ds in datasets})
+
+    #####################################################################
+    # Private helper methods
+    #####################################################################        
+
+    def _get_names(self):
+        if self._names is None:
+            gene_names = set()
+            region_names = []
+            region_datasets = defaultdict(list) # region -> datasets that have it
+            for ds in self.datasets:
+                gene_names.update(ds.gene_names)
+                region_names.extend(cfg.sorted_regions[ds.name])
+                for r in ds.region_names:
+                    region_datasets[r].append(ds)
+            self._names = Bunch(
+                gene_names = sorted(gene_names),
+                region_names = region_names,
+                region_datasets = dict(region_datasets),
+            )
+        return self._names
+
+    def _datasets_for(self, iRegion):
+        """The datasets that may have the region (all of them when the region is given by index)"""
+        if isinstance(iRegion, basestring):
+            return self._get_names().region_datasets.get(iRegion, [])
+        return self.datasets
 
 class OneDataset(object):
     def __init__(self, expression, gene_names, region_names, genders, ages, name):
@@ -234,7 +268,7 @@ class OneDataset(object):
         assert len(gene_names) == n_genes
         assert len(region_names) == n_regions
         self.expression = expression
-        self.gene_names = gene_names
+        self.gene_names = gene_names # also resets the index (see below)
         self.region_names = region_names
         self.genders = genders
         self.ages = ages        
@@ -243,7 +277,90 @@ class OneDataset(object):
         self.age_restriction = None
         self.age_scaler = None
         self.is_shuffled = False
-        
+        self._shared_expression = None # (filename, is gene major, memory mapped base expression) - see share_expression()
+
+    def __getstate__(self):
+        # When the dataset is sent to another process (e.g. to the workers of a parallel.WorkerPool)
+        # the expression array is not copied. Instead, the base expression is in a memory mapped file 
+        # that the other process attaches to (read only), and the lazy restrictions are sent as they are.
+        self.share_expression()
+        dct = self.__dict__.copy()
+        filename, gene_major, _ = dct.pop('_shared_expression')
+        dct['_base'] = (filename, gene_major)
+        dct['_expression'] = None
+        return dct
+
+    def __setstate__(self, dct):
+        filename, gene_major = dct['_base']
+        base = np.load(filename, mmap_mode='r')
+        if gene_major:
+            base = base.transpose(1,0,2)
+        dct['_base'] = base
+        dct['_shared_expression'] = (filename, gene_major, base)
+        self.__dict__.update(dct)
+
+    def share_expression(self):
+        """Makes sure the base expression is a read only memory mapped file that can be shared by several 
+           processes. If it isn't, the (restricted) expression is saved to a new file and becomes the base.
+        """
+        if self._shared_expression is not None and self._shared_expression[2] is self._base:
+            return self
+        filename = _new_shared_filename(self.name)
+        np.save(filename, self.expression)
+        self.expression = np.load(filename, mmap_mode='r')
+        self._shared_expression = (filename, False, self._base)
+        return self
+
+    @property
+    def expression(self):
+        """ages x genes x regions. 
+           Restrictions and shuffling don't copy the expression. They are applied lazily to the base expression
+           (see _restrict), and the expression is materialized once, when it's needed. Getting a few series 
+           (get_several_series etc.) only reads those series from the base expression.
+        """
+        if self._expression is None:
+            age_inds, gene_inds, region_inds = self._selection
+            if age_inds is None and gene_inds is None and region_inds is None:
+                x = self._base
+            else:
+                n_ages, n_genes, n_regions = self._base.shape
+                def all_if_none(inds, n):
+                    return np.arange(n) if inds is None else inds
+                x = self._base[np.ix_(all_if_none(age_inds,n_ages), all_if_none(gene_inds,n_genes), all_if_none(region_inds,n_regions))]
+            if self._shuffle:
+                if not x.flags.writeable: # e.g. the (memory mapped) base
+                    x = np.array(x)
+                for ig,g in enumerate(self.gene_names):
+                    for ir,r in enumerate(self.region_names):
+                        x[:,ig,ir] = _shuffled(x[:,ig,ir], g, r)
+            self._expression = x
+        return self._expression
+
+    @expression.setter
+    def expression(self, expression):
+        self._base = expression
+        self._selection = (None, None, None) # indices into the base for each axis (None = all)
+        self._shuffle = False # whether each series should be permuted (after the selection)
+        self._expression = expression
+
+    @property
+    def gene_names(self):
+        return self._gene_names
+
+    @gene_names.setter
+    def gene_names(self, gene_names):
+        self._gene_names = gene_names
+        self._gene_index = None # name -> index. Built when needed.
+
+    @property
+    def region_names(self):
+        return self._region_names
+
+    @region_names.setter
+    def region_names(self, region_names):
+        self._region_names = region_names
+        self._region_index = None # name -> index. Built when needed.
+
     @property
     def age_range(self):
         min_age = min(self.ages)
@@ -252,6 +369,31 @@ class OneDataset(object):
         
     @staticmethod
     def load(dataset):
+        """Loads the dataset from its preprocessed (binary) form in the cache, creating it if needed.
+           The expression is memory mapped, so only the genes that are actually used are read from disk.
+        """
+        meta = _read_preprocessed_meta(dataset)
+        if meta is None:
+            _preprocess_dataset(dataset)
+            meta = _read_preprocessed_meta(dataset)
+        expression_file = join(_preprocessed_dir(dataset), 'expression.npy')
+        if cfg.verbosity > 0:
+            print 'Loading dataset {} from {}'.format(dataset,expression_file)
+        gene_major = np.load(expression_file, mmap_mode='r')
+        res = OneDataset(
+            expression = gene_major.transpose(1,0,2), # ages x genes x regions, like everywhere else
+            gene_names = meta['gene_names'],
+            region_names = meta['region_names'],
+            genders = meta['genders'],
+            ages = meta['ages'],
+            name = dataset,
+        )
+        res._shared_expression = (expression_file, True, res.expression)
+        return res
+
+    @staticmethod
+    def load_from_mat(dataset):
+        """Loads the dataset from the original matlab file (slow)"""
         datadir = project_dirs.data_dir()
         filename = '{}_allGenes.mat'.format(dataset)
         path = join(datadir,filename)
@@ -269,16 +411,19 @@ class OneDataset(object):
         if expression.ndim == 2: # extend shape to represent a single region name
             expression.shape = list(expression.shape)+[1]
             
-        # average expression for duplicate genes
-        dct = defaultdict(list) # gene_name -> list of indices where it appears
-        for i,g in enumerate(gene_names):
-            dct[g].append(i)
-        new_gene_names = sorted(set(gene_names))
-        new_expression = np.empty([len(ages),len(new_gene_names),len(region_names)])
-        for i,g in enumerate(new_gene_names):
-            idx = dct[g]
+        # drop the genes without a name (some data files contain empty names)
+        valid = np.array([g is not None for g in gene_names], dtype=bool)
+        gene_names = np.array(list(gene_names[valid]))
+        expression = expression[:,valid,:]
+
+        # average expression for duplicate genes (genes that appear once are just copied)
+        new_gene_names, first_inds, inverse = np.unique(gene_names, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse)
+        new_expression = expression[:,first_inds,:].astype(float, copy=False)
+        for i in (counts > 1).nonzero()[0]:
+            idx = (gene_names == new_gene_names[i]).nonzero()[0]
             new_expression[:,i,:] = expression[:,idx,:].mean(axis=1)
-        gene_names = np.array(new_gene_names)
+        gene_names = new_gene_names
         expression = new_expression
 
         # make sure ages are sorted (for colantuoni there are 2 datapoints that aren't)
@@ -294,7 +439,7 @@ class OneDataset(object):
             genders = genders,
             ages = ages,
             name = dataset
-        ).restrict_pathway('all')
+        )
         sorted_regions = cfg.sorted_regions.get(dataset)
         if sorted_regions is not None:
             res = res.restrict_regions(cfg.sorted_regions[dataset])
@@ -311,8 +456,9 @@ class OneDataset(object):
             if missing and cfg.verbosity > 0:
                 print 'Dataset {} is missing {} genes from pathway {}: {}'.format(self.name, len(missing), pathway, missing)
             inds = [x for x in inds if x is not None]
-        self.expression = self.expression[:,inds,:]
-        self.gene_names = self.gene_names[inds]
+        if inds != range(len(self.gene_names)):
+            self._restrict(1, inds)
+            self.gene_names = self.gene_names[inds]
         self.pathway = pathway
         return self
 
@@ -321,10 +467,12 @@ class OneDataset(object):
             from_age = self.age_scaler.scale(from_age)
             to_age = self.age_scaler.scale(to_age)
         valid = ((self.ages>=from_age) & (self.ages<=to_age))
+        if self._shuffle: # the permutations are of the current ages, so they have to be applied first
+            self.expression = self.expression
         self.ages = self.ages[valid]
         if self.genders is not None:
             self.genders = self.genders[valid]
-        self.expression = self.expression[valid,:,:]
+        self._restrict(0, valid.nonzero()[0])
         self.age_restriction = restriction_name
         return self    
 
@@ -334,8 +482,8 @@ class OneDataset(object):
         return self    
 
     def restrict_regions(self, lst_regions):
-        inds = [np.where(self.region_names == region)[0][0] for region in lst_regions]
-        self.expression = self.expression[:,:,inds]
+        inds = [self._find_region_index(region) for region in lst_regions]
+        self._restrict(2, inds)
         self.region_names = self.region_names[inds]
         return self
         
@@ -348,27 +496,20 @@ class OneDataset(object):
         return self
     
     def shuffle(self):
-        nPoints, nGenes, nRegions = self.expression.shape
-        for ig,g in enumerate(self.gene_names):
-            for ir,r in enumerate(self.region_names):
-                seed = abs(hash(g) ^ hash(r))
-                rng = np.random.RandomState(seed)
-                self.expression[:,ig,ir] = rng.permutation(self.expression[:,ig,ir])
+        if self._shuffle: # shuffling again permutes the already shuffled series
+            self.expression = self.expression
+        self._shuffle = True
+        self._expression = None
         self.is_shuffled = True
 
     def get_one_series(self, iGene, iRegion, allow_missing=False):
         return self.get_several_series([iGene],iRegion,allow_missing)
         
     def get_several_series(self, genes, iRegion, allow_missing=False):
-        if isinstance(iRegion, basestring):
-            iRegion = self._find_region_index(iRegion, allow_missing=allow_missing)
-        if iRegion is None:
-            return None
-        genes = [self._find_gene_index(g,allow_missing=allow_missing) if isinstance(g, basestring) else g for g in genes]
-        genes = [g for g in genes if g is not None] # remove genes we don't have data for
+        genes, iRegion = self._find_series_indices(genes, iRegion, allow_missing)
         if not genes:
             return None
-        expression = self.expression[:,genes,iRegion]
+        expression = self._series_expression(genes, iRegion)
         ages = self.ages
         valid = ~np.all(np.isnan(expression),axis=1) # remove subjects where we don't have data for any gene (i.e. all the gene values are NaN)
         ages, expression = ages[valid], expression[valid,:]
@@ -380,23 +521,82 @@ class OneDataset(object):
             original_inds = valid.nonzero()[0],
             age_scaler = self.age_scaler,
         )
+
+    def get_series_block(self, genes, iRegion, allow_missing=False):
+        """Returns the series of several genes in one region at once, as a Bunch with:
+             expression - ages x genes. NaN where there's no data.
+             valid - ages x genes. True where the expression is not NaN.
+             ages, gene_names, region_name, age_scaler
+           Unlike get_several_series(), no ages are removed. valid[:,i] are the points get_one_series() 
+           returns for gene i (its original_inds).
+        """
+        genes, iRegion = self._find_series_indices(genes, iRegion, allow_missing)
+        if not genes:
+            return None
+        expression = self._series_expression(genes, iRegion)
+        return Bunch(
+            expression = expression,
+            valid = ~np.isnan(expression),
+            ages = self.ages,
+            gene_names = self.gene_names[genes],
+            region_name = self.region_names[iRegion],
+            age_scaler = self.age_scaler,
+        )
         
     #####################################################################
     # Private helper methods
     #####################################################################        
+
+    def _restrict(self, axis, inds):
+        """Adds a restriction to inds (indices into the current expression) along axis to the lazy selection"""
+        selection = list(self._selection)
+        inds = np.asarray(inds, dtype=int)
+        selection[axis] = inds if selection[axis] is None else selection[axis][inds]
+        self._selection = tuple(selection)
+        self._expression = None
+
+    def _series_expression(self, genes, iRegion):
+        """Same as self.expression[:,genes,iRegion], without materializing the whole expression"""
+        if self._expression is not None:
+            return self._expression[:,genes,iRegion]
+        age_inds, gene_inds, region_inds = self._selection
+        base_genes = genes if gene_inds is None else gene_inds[genes]
+        base_region = iRegion if region_inds is None else region_inds[iRegion]
+        x = self._base[:,base_genes,base_region]
+        if age_inds is not None:
+            x = x[age_inds,:]
+        if self._shuffle:
+            x = np.array(x)
+            for i,ig in enumerate(genes):
+                x[:,i] = _shuffled(x[:,i], self.gene_names[ig], self.region_names[iRegion])
+        return x
+
+    def _find_series_indices(self, genes, iRegion, allow_missing):
+        """Returns (list of gene indices, region index). The list is empty if nothing was found."""
+        if isinstance(iRegion, basestring):
+            iRegion = self._find_region_index(iRegion, allow_missing=allow_missing)
+        if iRegion is None:
+            return [], None
+        genes = [self._find_gene_index(g,allow_missing=allow_missing) if isinstance(g, basestring) else g for g in genes]
+        genes = [g for g in genes if g is not None] # remove genes we don't have data for
+        return genes, iRegion
         
     def _find_gene_index(self, name, allow_missing=False):
-        match_positions = np.where(self.gene_names == name)[0]
-        if len(match_positions) > 0:
-            return match_positions[0]
+        if self._gene_index is None:
+            self._gene_index = _make_index(self.gene_names)
+        i = self._gene_index.get(name)
+        if i is not None:
+            return i
         if allow_missing:
             return None
         raise AssertionError('Gene {} not found'.format(name))
 
     def _find_region_index(self, name, allow_missing=False):
-        match_positions = np.where(self.region_names == name)[0]
-        if len(match_positions) > 0:
-            return match_positions[0]
+        if self._region_index is None:
+            self._region_index = _make_index(self.region_names)
+        i = self._region_index.get(name)
+        if i is not None:
+            return i
         if allow_missing:
             return None
         raise AssertionError('Region {} not found'.format(name))        
@@ -406,6 +606,90 @@ class OneDataset(object):
 # Helpers
 ####################################################
 
+PREPROCESSED_VERSION = 2 # change when the preprocessing or the format changes, to create the files again
+
+def _preprocessed_dir(dataset):
+    return join(project_dirs.cache_dir(), 'datasets', '{}-v{}'.format(dataset,PREPROCESSED_VERSION))
+
+def _source_signature(dataset):
+    """Identifies the version of the source file and the settings the preprocessing depends on"""
+    path = join(project_dirs.data_dir(), '{}_allGenes.mat'.format(dataset))
+    st = os.stat(path)
+    return (st.st_size, int(st.st_mtime), cfg.sorted_regions.get(dataset))
+
+def _read_preprocessed_meta(dataset):
+    """Returns the metadata of the preprocessed dataset or None if it doesn't exist or is stale"""
+    filename = join(_preprocessed_dir(dataset), 'meta.pkl')
+    if not isfile(filename):
+        return None
+    try:
+        with open(filename) as f:
+            meta = pickle.load(f)
+    except:
+        print 'Failed to read preprocessed dataset from {}'.format(filename)
+        return None
+    if meta['signature'] != _source_signature(dataset):
+        if cfg.verbosity > 0:
+            print 'Preprocessed dataset {} is out of date'.format(dataset)
+        return None
+    return meta
+
+def _preprocess_dataset(dataset):
+    """Saves the dataset (after removing duplicate genes, sorting ages and ordering the regions) 
+       with the expression in gene major order, so the genes of a pathway can be read without reading the rest.
+    """
+    ds = OneDataset.load_from_mat(dataset)
+    dirname = _preprocessed_dir(dataset)
+    if cfg.verbosity > 0:
+        print 'Saving preprocessed dataset {} to {}'.format(dataset, dirname)
+    # write to a temporary directory and rename it when it's complete, in case other processes are doing the same
+    ensure_dir(os.path.dirname(dirname))
+    tmpdir = tempfile.mkdtemp(prefix=os.path.basename(dirname) + '-', dir=os.path.dirname(dirname))
+    np.save(join(tmpdir,'expression.npy'), np.ascontiguousarray(ds.expression.transpose(1,0,2)))
+    meta = dict(
+        signature = _source_signature(dataset),
+        gene_names = ds.gene_names,
+        region_names = ds.region_names,
+        genders = ds.genders,
+        ages = ds.ages,
+    )
+    with open(join(tmpdir,'meta.pkl'),'w') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if isdir(dirname):
+        shutil.rmtree(dirname, ignore_errors=True) # stale
+    try:
+        os.rename(tmpdir, dirname)
+    except OSError: # another process got there first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+_shared_files = [] # (pid, filename) for memory mapped files created by share_expression()
+
+def _new_shared_filename(dataset_name):
+    fd, filename = tempfile.mkstemp(prefix='{}-expression-'.format(dataset_name), suffix='.npy')
+    os.close(fd)
+    _shared_files.append( (os.getpid(), filename) )
+    return filename
+
+@atexit.register
+def _remove_shared_files():
+    for pid, filename in _shared_files:
+        if pid != os.getpid():
+            continue # created by the process we were forked from
+        try:
+            os.remove(filename)
+        except OSError:
+            pass # e.g. on windows while the file is still mapped
+
+def _shuffled(values, g, r):
+    """The permutation of a series used by OneDataset.shuffle. It depends only on the gene and region."""
+    seed = abs(hash(g) ^ hash(r))
+    rng = np.random.RandomState(seed)
+    return rng.permutation(values)
+
+def _make_index(names):
+    """name -> index of its first appearance"""
+    return {name:i for i,name in reversed(list(enumerate(names)))}
+
 def _translate_pathway(pathway, ad_hoc_genes):
     if pathway is None or pathway == 'all':
         return 'all',None
@@ -0,0 +1,158 @@
+"""
+A permutation null distribution for the fit scores.
+
+Instead of shuffling the whole dataset (--shuffle) and running the complete pipeline on it again,
+the null scores are computed directly: each series is permuted many times and each permutation is
+fitted with reduced settings (no bootstrap, fewer folds and restarts - see cfg.null_*). Only the
+LOO scores of the permuted fits are kept. The reduced settings give lower LOO scores (e.g. each fold
+trains on fewer points), so the unpermuted series is also fitted with the same settings and its score,
+and not the score of the full fit, is compared with the null scores.
+
+The permutations of a series are generated together, in batches of cfg.null_batch_size, from a
+seed that depends only on the gene, the region and the batch. So computing more permutations later
+only computes the new batches, and the results are cached (and can be sharded) with job_splitting.
+"""
+
+import zlib
+from contextlib import contextmanager
+import numpy as np
+import config as cfg
+from sklearn.datasets.base import Bunch
+from fit_score import loo_score
+from project_dirs import fit_results_relative_path
+from utils import job_splitting
+from utils.derived_fields import fingerprint
+
+class NullScores(object):
+    def __init__(self, scores, observed):
+        """scores - dictionary (g,r) -> array of the LOO scores of the permuted series (series that
+                    can't be fitted are missing)
+           observed - dictionary (g,r) -> LOO score of the unpermuted series, fitted with the same settings
+        """
+        self.scores = scores
+        self.observed = observed
+
+    def n_permutations(self, g, r):
+        return len(self.scores.get((g,r),[]))
+
+    def all_scores(self):
+        """All the null scores (of all the series) in one array"""
+        return np.concatenate([s for s in self.scores.itervalues()] + [np.array([])])
+
+    def histogram(self, bin_edges):
+        """Counts of the null scores (of all the series) in each bin. Scores outside the range go to the first/last bin."""
+        counts = np.zeros(len(bin_edges)-1, dtype=int)
+        for s in self.scores.itervalues():
+            counts += np.histogram(np.clip(s, bin_edges[0], bin_edges[-1]), bin_edges)[0]
+        return counts
+
+    def p_values(self):
+        """Returns dictionary (g,r) -> empirical p-value of the observed score, i.e.
+           (1 + number of null scores >= observed) / (1 + number of null scores).
+           The observed score must come from the same fitting settings as the null scores, so it's the
+           score of the unpermuted series fitted with the reduced settings (self.observed) and not fit.LOO_score.
+        """
+        res = {}
+        for k,score in self.observed.iteritems():
+            s = self.scores.get(k)
+            if s is None or score is None:
+                continue
+            res[k] = (1.0 + np.count_nonzero(s >= score)) / (1.0 + len(s))
+        return res
+
+def get_null_scores(data, fitter, n_permutations, k_of_n=None, allow_new_computation=True):
+    """Returns { dataset_name -> NullScores } with (at least) n_permutations null scores for each series in 'data'
+       and the score of each unpermuted series with the same settings.
+    """
+    n_batches = int(np.ceil(float(n_permutations) / cfg.null_batch_size))
+    jobs = [_null_scores_job(ds, fitter, n_batches, k_of_n, allow_new_computation) for ds in data.datasets]
+    with _reduced_fitting_settings(): # the worker processes copy the settings when they start
+        all_results = job_splitting.compute_many(jobs)
+    res = {}
+    for ds,dct_batches in zip(data.datasets,all_results):
+        batches = {}
+        observed = {}
+        for (g,r,b),scores in dct_batches.iteritems():
+            if scores is None:
+                continue
+            if b == _OBSERVED_BATCH:
+                if not np.isnan(scores[0]):
+                    observed[(g,r)] = scores[0]
+            else:
+                batches.setdefault((g,r),[]).append( (b,scores) )
+        scores = {}
+        for k,lst in batches.iteritems():
+            s = np.concatenate([x for b,x in sorted(lst)])
+            scores[k] = s[~np.isnan(s)]
+        res[ds.name] = NullScores(scores, observed)
+    return res
+
+def permutation_indices(n, n_permutations, seed):
+    """Returns an array of shape (n_permutations, n) whose rows are random permutations of range(n)"""
+    rng = np.random.RandomState(seed)
+    return np.argsort(rng.rand(n_permutations, n), axis=1)
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+_OBSERVED_BATCH = -1 # the "batch" with just the unpermuted series
+
+def _null_scores_job(dataset, fitter, n_batches, k_of_n, allow_new_computation):
+    batches = [_OBSERVED_BATCH] + range(n_batches)
+    keys = [(g,r,b) for g in dataset.gene_names for r in dataset.region_names for b in batches]
+    settings = [cfg.null_batch_size, cfg.null_n_folds, cfg.null_n_optimization_restarts, cfg.random_seed]
+    return job_splitting.job(
+        name = 'null scores for {}'.format(dataset.name),
+        f = _compute_null_scores,
+        all_keys = keys,
+        k_of_n = k_of_n,
+        base_filename = '{}-null-{}'.format(fit_results_relative_path(dataset,fitter), fingerprint(*settings)[:12]),
+        context = Bunch(dataset=dataset, fitter=fitter),
+        f_sharding_key = lambda key: key[0],
+        all_sharding_keys = list(dataset.gene_names),
+        allow_new_computation = allow_new_computation,
+    )
+
+def _compute_null_scores(context, key):
+    """Returns the LOO scores (NaN where there's no score) of one batch of permutations of a series
+       (for _OBSERVED_BATCH, an array with the score of the unpermuted series), or None if the series can't be fitted.
+    """
+    g,r,b = key
+    series = context.dataset.get_one_series(g,r)
+    x = series.ages
+    y = series.single_expression
+    if np.count_nonzero(abs(y) > cfg.nonzero_threshold) < cfg.min_nonzero_points_for_fitting:
+        return None
+    if cfg.verbosity > 0:
+        print 'Computing null scores for {}@{} (batch {})'.format(g, r, b)
+    if b == _OBSERVED_BATCH:
+        perms = [np.arange(len(y))]
+    else:
+        perms = permutation_indices(len(y), cfg.null_batch_size, _batch_seed(g,r,b))
+    scores = np.empty(len(perms))
+    for i,perm in enumerate(perms):
+        y_perm = y[perm]
+        _, _, LOO_predictions, _ = context.fitter.fit(x, y_perm, loo=True)
+        try:
+            score = loo_score(y_perm, LOO_predictions)
+        except:
+            score = None
+        scores[i] = np.NaN if score is None else score
+    return scores
+
+def _batch_seed(g, r, b):
+    seed = [zlib.crc32(g) & 0xffffffff, zlib.crc32(r) & 0xffffffff, b]
+    if cfg.random_seed is not None:
+        seed.append(cfg.random_seed)
+    return seed
+
+@contextmanager
+def _reduced_fitting_settings():
+    prev = cfg.n_folds, cfg.n_optimization_restarts
+    cfg.n_folds = cfg.null_n_folds
+    cfg.n_optimization_restarts = cfg.null_n_optimization_restarts
+    try:
+        yield
+    finally:
+        cfg.n_folds, cfg.n_optimization_restarts = prev
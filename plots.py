@@ -10,7 +10,7 @@ from sklearn.datasets.base import Bunch
 from utils.statsmodels_graphics.correlation import plot_corr
 from project_dirs import resources_dir, results_dir, fit_results_relative_path
 from utils.misc import ensure_dir, interactive, rect_subplot
-from utils.parallel import Parallel
+from utils.parallel import Parallel, batches
 from dev_stages import dev_stages
 import scalers
 
@@ -31,6 +31,10 @@ def save_figure(fig, filename, b_close=False, b_square=True, show_frame=False, u
     if b_close:
         plt.close(fig)
 
+def thumbnail_filename(filename):
+    """Where the thumbnail of a series figure is saved when cfg.plot_with_templates and cfg.plot_thumbnail_dpi are set"""
+    return join(os.path.dirname(filename), 'thumbnails', os.path.basename(filename))
+
 def plot_gene(data, g, fits=None):
     region_series_fits = _extract_gene_data(data,g,fits)
     return _plot_gene_inner(g,region_series_fits)
@@ -84,7 +88,8 @@ def add_age_ticks(ax, age_scaler, fontsize=None):
     # mark birth time with a vertical line
     ymin, ymax = ax.get_ylim()
     birth_age = scalers.unify(age_scaler).scale(0)
-    ax.plot([birth_age, birth_age], [ymin, ymax], '--', color='0.85')
+    line, = ax.plot([birth_age, birth_age], [ymin, ymax], '--', color='0.85')
+    return line
     
 def plot_one_series(series, shape=None, theta=None, LOO_predictions=None, change_distribution=None, minimal_annotations=False, ax=None, show_legend=True):
     x = series.ages
@@ -177,8 +182,7 @@ def plot_and_save_all_genes(data, fitter, fits, dirname, show_change_distributio
         else:
             bin_centers = None
         to_plot.append((g,region_series_fits,filename, bin_centers))
-    pool = Parallel(_plot_genes_job)
-    pool(pool.delay(*args) for args in to_plot)
+    _run_plot_jobs(_plot_genes_job, 'save_gene_figures', to_plot)
 
 def _plot_genes_job(gene, region_series_fits, filename, bin_centers):
     with interactive(False):
@@ -192,7 +196,7 @@ def plot_and_save_all_series(data, fitter, fits, dirname, use_correlations, show
     for dsfits in fits.itervalues():
         for (g,r),fit in dsfits.iteritems():
             filename = join(dirname, 'fit-{}-{}.png'.format(g,r))
-            if isfile(filename):
+            if isfile(filename) and not _missing_thumbnail(filename):
                 print 'Figure already exists for {}@{}. skipping...'.format(g,r)
                 continue
             series = data.get_one_series(g,r)
@@ -204,11 +208,27 @@ def plot_and_save_all_series(data, fitter, fits, dirname, use_correlations, show
             else:
                 change_distribution = None
             to_plot.append((series,fit,filename,use_correlations, change_distribution, figure_kw))
+    _run_plot_jobs(_plot_series_job, 'save_series_figures', to_plot)
+
+def _missing_thumbnail(filename):
+    """True if the HTML uses a thumbnail for this series figure (see create_html) and it doesn't exist"""
+    if not cfg.plot_with_templates or cfg.plot_thumbnail_dpi is None:
+        return False
+    return not isfile(thumbnail_filename(filename))
+
+def _run_plot_jobs(f, template_function_name, to_plot):
+    """Calls f(*args) for each args in to_plot, or when cfg.plot_with_templates is set, renders batches
+       of figures with the function template_function_name from figure_templates.
+    """
+    if cfg.plot_with_templates:
+        import figure_templates
+        f = getattr(figure_templates, template_function_name)
+        to_plot = [(batch,) for batch in batches(to_plot, cfg.plot_batch_size)]
     if cfg.parallel_run_locally:
         for args in to_plot:
-            _plot_series_job(*args)
+            f(*args)
     else:
-        pool = Parallel(_plot_series_job)
+        pool = Parallel(f)
         pool(pool.delay(*args) for args in to_plot)
 
 def _plot_series_job(series, fit, filename, use_correlations, change_distribution, figure_kw):
@@ -374,6 +394,10 @@ def create_html(data, fitter, fits,
         inline_image_size = '20%'
     if ttl is None:
         ttl = 'Fits for every Gene and Region'
+    if cfg.plot_with_templates and cfg.plot_thumbnail_dpi is not None:
+        inline_image_dir = '{}/thumbnails'.format(series_dir) # see thumbnail_filename
+    else:
+        inline_image_dir = series_dir
     if filename is None:
         filename = 'fits'
     
@@ -479,7 +503,7 @@ Column/row headings and/or cell entries may link to more details for the corresp
                 {% endif %}
                 {% if b_inline_images %}
                     <br/>
-                    <img src="{{series_dir}}/fit-{{gene_name}}-{{region_name}}.png" height="{{inline_image_size}}">
+                    <img src="{{inline_image_dir}}/fit-{{gene_name}}-{{region_name}}.png" height="{{inline_image_size}}">
                 {% endif %}
                 </a>
             {% endif %}
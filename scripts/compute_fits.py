@@ -1,14 +1,16 @@
 import setup
 import re
 import sys
+import numpy as np
+import config as cfg
 from utils.misc import disable_all_warnings
-from all_fits import get_all_fits, iterate_region_fits, save_as_mat_files, save_theta_text_files
+from all_fits import iterate_fits, get_all_fits, get_all_fits_with_work_queue, iterate_region_fits, save_as_mat_files, save_theta_text_files
 from command_line import get_common_parser, process_common_inputs
 from plots import save_fits_and_create_html
-from sigmoid_change_distribution import add_change_distributions, compute_dprime_measures_for_all_pairs, export_timing_info_for_all_fits, compute_fraction_of_change
+from sigmoid_change_distribution import add_change_distributions, compute_dprime_measures_for_all_pairs, export_timing_info_for_all_fits, analytic_fraction_of_change
 
 
-def do_fits(data, fitter, k_of_n, add_correlations, correlations_k_of_n):
+def do_fits(data, fitter, k_of_n, add_correlations, correlations_k_of_n, use_queue=False, new_queue=False):
     n_correlation_iterations = 4 if add_correlations else 0
     print """
 ==============================================================================================
@@ -17,6 +19,8 @@ def do_fits(data, fitter, k_of_n, add_correlations, correlations_k_of_n):
 ==============================================================================================
 ==============================================================================================
 """.format(fitter)
+    if use_queue:
+        return get_all_fits_with_work_queue(data, fitter, new_queue)
     fits = get_all_fits(data, fitter, k_of_n, n_correlation_iterations=n_correlation_iterations, correlations_k_of_n=correlations_k_of_n)    
     return fits
     
@@ -52,23 +56,18 @@ def create_html(data, fitter, fits, html_dir, k_of_n, use_correlations, correlat
     save_fits_and_create_html(data, fitter, html_kw=html_kw, figure_kw=figure_kw, **basic_kw)
 
     if show_onsets:
+        add_childhood_and_adolescence_change(data, fitter, fits)
         for tooltips in [False, True]:
-            bin_edges = fits.change_distribution_params.bin_edges
             R2_color_threshold = 0.2
             def get_change_distribution_info(fit):
                 x_median, x_from, x_to = fit.change_distribution_spread
-                childhood = [0,12]
-                adolescence = [12,24]
                 if data.age_scaler is None:
                     age = x_median
                 else:
                     age = data.age_scaler.unscale(x_median)
                     x_from = data.age_scaler.unscale(x_from)
                     x_to = data.age_scaler.unscale(x_to)
-                    childhood = [data.age_scaler.scale(x) for x in childhood]
-                    adolescence = [data.age_scaler.scale(x) for x in adolescence]
-                pct_childhood = 100.0 * compute_fraction_of_change(fit.change_distribution_weights, bin_edges, *childhood)
-                pct_adolescence = 100.0 * compute_fraction_of_change(fit.change_distribution_weights, bin_edges, *adolescence)
+                pct_childhood, pct_adolescence = fit.pct_childhood_and_adolescence_change
                 if tooltips:
                     txt = '<div title="0-12 years: {pct_childhood:.2g}%\n12-24 years: {pct_adolescence:.2g}%">{age:.2g} </br> <small>({x_from:.2g},{x_to:.2g})</small></div>'.format(**locals())
                 else:
@@ -107,7 +106,23 @@ def create_html(data, fitter, fits, html_dir, k_of_n, use_correlations, correlat
             )
             save_fits_and_create_html(data, fitter, only_main_html=True, html_kw=html_kw, figure_kw=figure_kw, **basic_kw)
 
-def save_mat_file(data, fitter, fits, has_change_distributions):
+def add_childhood_and_adolescence_change(data, fitter, fits):
+    """Sets fit.pct_childhood_and_adolescence_change to the percent of the change that happens during
+       ages 0-12 years and 12-24 years. Both windows are computed for all the fits together.
+    """
+    windows = np.array([[0,12], [12,24]], dtype=float)
+    if data.age_scaler is not None:
+        windows = data.age_scaler.scale(windows)
+    keys = [(dsname,g,r) for dsname,g,r,fit in iterate_fits(fits, return_keys=True)]
+    if fits.change_distribution_params.analytic:
+        theta_samples = np.array([fits[dsname][(g,r)].theta_samples for dsname,g,r in keys])
+        pct = 100.0 * np.column_stack([analytic_fraction_of_change(fitter.shape, theta_samples, x_from, x_to) for x_from,x_to in windows])
+    else:
+        pct = 100.0 * fits.change_distribution_index.fraction_of_change(windows[:,0], windows[:,1], keys=keys)
+    for (dsname,g,r),row in zip(keys, pct):
+        fits[dsname][(g,r)].pct_childhood_and_adolescence_change = row
+
+def save_mat_file(data, fitter, fits, has_change_distributions, k_of_n):
     print """
 ==============================================================================================
 ==============================================================================================
@@ -115,7 +130,7 @@ def save_mat_file(data, fitter, fits, has_change_distributions):
 ==============================================================================================
 ==============================================================================================
 """
-    save_as_mat_files(data, fitter, fits, has_change_distributions)
+    save_as_mat_files(data, fitter, fits, has_change_distributions, k_of_n)
 
 
 def save_text_file(data, fitter, fits):
@@ -148,8 +163,10 @@ if __name__ == '__main__':
     NOT_USED = (None,)
     parser = get_common_parser()
     parser.add_argument('--part', help='Compute only part of the genes. format: <k>/<n> e.g. 1/4. (k=1..n)')
+    parser.add_argument('--queue', action='store_true', help='Compute the fits together with any other processes started with --queue (on this or other machines sharing the cache directory). Only the process that consolidates the fits continues after the fits are done.')
+    parser.add_argument('--new_queue', action='store_true', help='Start a new work queue for --queue instead of joining the existing one (needed to compute the fits again after a queue was finished). Processes still working on the old queue stop.')
     parser.add_argument('--html', nargs='?', metavar='DIR', default=NOT_USED, help='Create html for the fits. Optionally override output directory.')
-    parser.add_argument('--mat', action='store_true', help='Save the fits also as matlab .mat file.')
+    parser.add_argument('--mat', action='store_true', help='Save the fits also as matlab .mat file (or in the format set by cfg.export_format).')
     parser.add_argument('--text', action='store_true', help='Save the theta parameters also to a text file (spline only).')
     parser.add_argument('--correlations', action='store_true', help='Use correlations between genes for prediction')
     parser.add_argument('--correlations_part', help='Compute only part of the correlations. format: <k>/<n> e.g. 1/4. (k=1..n)')
@@ -157,10 +174,15 @@ if __name__ == '__main__':
     parser.add_argument('--dont_show_change_dist', action='store_true', help="Don't show change distribution in the figures (only relevant for sigmoids and together with --html)")
     parser.add_argument('--no_legend', action='store_true', help="Don't show the legend in the figures (only relevant together with --html)")
     parser.add_argument('--change_dist', action='store_true', help='Compute change distributions and related measures (sigmoid only)')
+    parser.add_argument('--analytic_onsets', action='store_true', help='Compute the onset ages and ranges, and the fraction of change in age windows, from the exact change distribution instead of its histogram (sigmoid only)')
     args = parser.parse_args()
     
-    if args.part is not None and args.mat:
-        abort('--mat cannot be used with --part')
+    if args.part is not None and args.mat and cfg.export_format == 'mat':
+        abort("--mat cannot be used with --part when exporting to .mat files (set cfg.export_format to 'h5' or 'npy')")
+    if args.queue and (args.part or args.correlations):
+        abort('--queue cannot be used with --part or --correlations')
+    if args.new_queue and not args.queue:
+        abort('--new_queue should only be used with --queue')
     is_sigmoid = args.shape in ['sigmoid','sigslope']
     if args.correlations:
         if args.part:
@@ -176,6 +198,8 @@ if __name__ == '__main__':
         abort('--onset can only be used with sigmoid fits')
     if args.change_dist and not is_sigmoid:
         abort('--change_dist can only be used with sigmoid fits')
+    if args.analytic_onsets and not is_sigmoid:
+        abort('--analytic_onsets can only be used with sigmoid fits')
     if args.onset and args.html == NOT_USED:
         abort('--onset should only be used with --html')
     if args.text and args.shape != 'spline':
@@ -183,11 +207,14 @@ if __name__ == '__main__':
     k_of_n = parse_k_of_n(args.part)
     correlations_k_of_n = parse_k_of_n(args.correlations_part)
     data, fitter = process_common_inputs(args)
-    fits = do_fits(data, fitter, k_of_n, args.correlations, correlations_k_of_n)
+    fits = do_fits(data, fitter, k_of_n, args.correlations, correlations_k_of_n, args.queue, args.new_queue)
+    if fits is None:
+        print 'All the fits are done. Another process is consolidating them (or already did).'
+        sys.exit(0)
     has_change_distributions = is_sigmoid
     if has_change_distributions:
         print 'Computing change distributions...'
-        add_change_distributions(data, fitter, fits)
+        add_change_distributions(data, fitter, fits, analytic=args.analytic_onsets)
         if args.change_dist:
             print 'Computing region pair timing measures...'
             compute_dprime_measures_for_all_pairs(data, fitter, fits)
@@ -205,6 +232,6 @@ if __name__ == '__main__':
                     no_legend = args.no_legend,
                     )
     if args.mat:
-        save_mat_file(data, fitter, fits, has_change_distributions)
+        save_mat_file(data, fitter, fits, has_change_distributions, k_of_n)
     if args.text:
         save_text_file(data, fitter, fits)
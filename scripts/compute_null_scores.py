@@ -0,0 +1,28 @@
+import setup
+import sys
+import numpy as np
+from utils.misc import disable_all_warnings
+from command_line import get_common_parser, process_common_inputs
+from permutation_null import get_null_scores
+from compute_fits import parse_k_of_n, abort
+
+if __name__ == '__main__':
+    disable_all_warnings()
+    parser = get_common_parser()
+    parser.add_argument('-n', '--permutations', type=int, default=100, help='Number of permutations of each series. Default: 100')
+    parser.add_argument('--part', help='Compute only part of the genes. format: <k>/<n> e.g. 1/4. (k=1..n)')
+    args = parser.parse_args()
+    if args.shuffle:
+        abort('--shuffle cannot be used for computing null scores (the series are permuted anyway)')
+    k_of_n = parse_k_of_n(args.part)
+    data, fitter = process_common_inputs(args)
+    null_scores = get_null_scores(data, fitter, args.permutations, k_of_n=k_of_n)
+    if k_of_n is not None:
+        sys.exit(0)
+
+    for dsname,dsnull in null_scores.iteritems():
+        p_values = np.array(dsnull.p_values().values()) # compared with the unpermuted series fitted with the same (reduced) settings
+        all_scores = dsnull.all_scores()
+        print '{}: null LOO score = {:.2g} +/- {:.2g} ({} scores)'.format(dsname, np.mean(all_scores), np.std(all_scores), len(all_scores))
+        for p_threshold in [0.05, 0.01]:
+            print '{}: {}/{} series with p-value below {}'.format(dsname, np.count_nonzero(p_values < p_threshold), len(p_values), p_threshold)
@@ -4,7 +4,8 @@ import config as cfg
 from load_data import GeneData
 from shapes.sigmoid import Sigmoid
 from fitter import Fitter
-from all_fits import get_all_fits, iterate_fits
+from all_fits import get_all_fits
+from fits_index import FitsIndex
 from scalers import LogScaler
 
 cfg.verbosity = 1
@@ -15,16 +16,16 @@ def get_fits():
     shape = Sigmoid(priors='sigmoid_wide')
     fitter = Fitter(shape, sigma_prior='normal')
     fits = get_all_fits(data, fitter)
-    return fits
+    return fits, fitter
     
 def main():
-    fits = get_fits()
+    fits, fitter = get_fits()
+    index = FitsIndex(fits)
+    positions = index.transitions(fitter.shape, positive=False, positions=index.query(min_score=0.5))
     def cond(fit):
         a,h,mu,w = fit.theta
-        if h*w > 0:
-            return False
         return abs(w) < 0.5
-    return [(g,r) for dsname,g,r,fit in iterate_fits(fits,R2_threshold=0.5,return_keys=True) if cond(fit)]
+    return [index.keys[i][1:] for i in positions if cond(index.fit_at(i))]
 
 if __name__ == '__main__':
     res = main()
\ No newline at end of file
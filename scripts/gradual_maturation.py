@@ -1,7 +1,6 @@
 import setup
 from os.path import join
 import numpy as np
-from scipy.stats import spearmanr
 import matplotlib.pyplot as plt
 import config as cfg
 from load_data import GeneData
@@ -12,6 +11,7 @@ from scalers import LogScaler
 from plots import save_figure, create_html
 from project_dirs import results_dir, fit_results_relative_path
 from utils.misc import ensure_dir
+from utils.matrix_stats import spearman_with_order
 
 fontsize = 30
 
@@ -82,17 +82,16 @@ def create_top_correlations_html(data, fitter, fits, scores, regions, n_top=None
 cfg.verbosity = 1
 age_scaler = LogScaler()
 
-def get_gene_correlation(fits, gene, regions):
+def get_gene_correlations(fits, genes, regions):
+    """Returns the spearman correlation of the onset times of each gene with the order of the regions (rho, pval)
+       and the LOO scores of the gene in the regions (matrix of genes x regions).
+    """
     # XXX fits should be changed to a class which support indexing by (g,r) and hides datasets
     ds_fits = fits['kang2011'] 
-    def get_onset_time(r):
-        fit = ds_fits[(gene,r)]
-        a,h,mu,_ = fit.theta
-        return mu,fit.LOO_score
-    lst_mu_R2 = [get_onset_time(r) for r in regions]
-    onset_times, lst_R2 = zip(*lst_mu_R2)
-    r,pval = spearmanr(onset_times, range(len(regions)))
-    return r,pval,lst_R2
+    onset_times = np.array([[ds_fits[(g,r)].theta[2] for r in regions] for g in genes])
+    R2 = np.array([[ds_fits[(g,r)].LOO_score for r in regions] for g in genes], dtype=float)
+    rho, pval = spearman_with_order(onset_times)
+    return rho, pval, R2
 
 lst_pathways = [
     'serotonin',
@@ -108,10 +107,8 @@ for pathway in lst_pathways:
     
     regions = ['OFC', 'M1C', 'S1C', 'IPC', 'V1C']
     
-    scores = []
-    for g in data.gene_names:
-        r,pval,lst_R2 = get_gene_correlation(fits,g,regions)
-        scores.append( (g,r,pval,lst_R2) )
+    rho, pval, R2 = get_gene_correlations(fits, data.gene_names, regions)
+    scores = zip(data.gene_names, rho, pval, R2)
     
     fig = plot_correlation_histogram(scores,pathway)
     save_figure(fig,'{}/gradual-maturation-hist.png'.format(pathway,pathway), under_results=True, b_close=True)
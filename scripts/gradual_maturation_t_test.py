@@ -1,7 +1,6 @@
 import setup
 from os.path import join
 import numpy as np
-from scipy.stats import ttest_ind
 from statsmodels.sandbox.stats.multicomp import fdrcorrection0 as fdr # not installed on cortex
 import config as cfg
 from load_data import GeneData
@@ -13,6 +12,7 @@ from plots import create_html
 from project_dirs import results_dir, fit_results_relative_path
 from utils.misc import ensure_dir
 from dev_stages import PCW
+from utils.matrix_stats import ttest_ind_rows
 
 fontsize = 30
 
@@ -94,20 +94,14 @@ for pathway in lst_pathways:
         if b_reversed:
             regions = regions[::-1]
     
-        scores = []
-        for i,g in enumerate(data.gene_names):
-            mu1 = ds_fits[(g,regions[0])].theta_samples[2,:]
-            mu2 = ds_fits[(g,regions[1])].theta_samples[2,:]
-            t,pval = ttest_ind(mu1,mu2)
-            if mu1.mean() < mu2.mean(): # make it one sided: V1C < OFC
-                pval = pval/2
-            else:
-                pval = 1 - pval/2
-            scores.append( (g,pval) )
+        mu1 = np.array([ds_fits[(g,regions[0])].theta_samples[2,:] for g in data.gene_names])
+        mu2 = np.array([ds_fits[(g,regions[1])].theta_samples[2,:] for g in data.gene_names])
+        t,pvals = ttest_ind_rows(mu1,mu2)
+        pvals = np.where(mu1.mean(axis=1) < mu2.mean(axis=1), pvals/2, 1 - pvals/2) # make it one sided: V1C < OFC
         
         # add FDR correction
-        _,qvals = fdr([pval for g,pval in scores])
-        scores = [(g,pval,qval) for (g,pval),qval in zip(scores,qvals)]
+        _,qvals = fdr(pvals)
+        scores = zip(data.gene_names, pvals, qvals)
         
         filename_suffix = '-reversed' if b_reversed else ''
         create_top_genes_html(data,fitter,fits,scores,regions,filename_suffix=filename_suffix)
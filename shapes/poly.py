@@ -21,6 +21,14 @@ class Poly(Shape):
 
     def f_grad(self,theta,x):
         return [x**j for j in xrange(self.n+1)]
+
+    def f_batch(self,thetas,x):
+        powers = np.array([x**j for j in xrange(self.n+1)])
+        return np.dot(np.asarray(thetas, dtype=float).reshape(-1,self.n+1), powers)
+
+    def f_grad_batch(self,thetas,x):
+        powers = np.array([x**j for j in xrange(self.n+1)], dtype=float)
+        return np.repeat(powers[np.newaxis,:,:], len(thetas), axis=0)
     
     def get_theta_guess(self,x,y):
         return [y.mean()] + self.n*[0]
@@ -21,6 +21,12 @@ class ScaledX(Shape):
 
     def f_grad(self,theta,x):
         return self.shape.f_grad(theta, self._sx(x))
+
+    def f_batch(self,thetas,x):
+        return self.shape.f_batch(thetas, self._sx(x))
+
+    def f_grad_batch(self,thetas,x):
+        return self.shape.f_grad_batch(thetas, self._sx(x))
     
     def get_theta_guess(self,x,y):
         return self.shape.get_theta_guess(self._sx(x),y)
@@ -8,6 +8,9 @@ class Shape(object):
            lst = param_names()
            str = cache_name()
            y = f(theta,x)
+       and can override with vectorized versions (the defaults loop over the thetas):
+           Y = f_batch(thetas,x)
+           D = f_grad_batch(thetas,x)
        A class that works with Fitter should implement:
            d_theta = f_grad(theta,x)
            theta0 = get_theta_guess(x,y)
@@ -75,6 +78,22 @@ class Shape(object):
         # NOTE: This assumes the priors for different parameters are independent
         return np.array([pr.d_log_prob(t) for pr,t in zip(self.priors,theta)])
 
+    def f_batch(self, thetas, x):
+        """Evaluates f for several parameter vectors at the same x. Returns array of shape len(thetas) x len(x).
+           Derived classes can override this with a vectorized version.
+        """
+        return np.array([self.f(theta,x) for theta in thetas]).reshape(len(thetas), len(x))
+
+    def f_grad_batch(self, thetas, x):
+        """Evaluates f_grad for several parameter vectors at the same x. Returns array of shape len(thetas) x n_params x len(x).
+           Derived classes can override this with a vectorized version.
+        """
+        res = np.empty((len(thetas), self.n_params(), len(x)))
+        for i,theta in enumerate(thetas):
+            for j,d in enumerate(self.f_grad(theta,x)):
+                res[i,j,:] = d
+        return res
+
     def high_res_preds(self, theta, x):
         x_smooth = np.linspace(x.min(),x.max(),cfg.n_curve_points_to_plot)
         y_smooth = self.f(theta, x_smooth)
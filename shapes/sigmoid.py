@@ -57,6 +57,22 @@ class Sigmoid(Shape):
         d_w = -h*(x-mu)/(w**2 * (1+e) * (1+ie))
         return [d_a, d_h, d_mu, d_w]
     
+    def f_batch(self,thetas,x):
+        a,h,mu,w = self._batch_params(thetas)
+        return a + h/(1+np.exp(-(x-mu)/w))
+
+    def f_grad_batch(self,thetas,x):
+        grads = self.f_grad(self._batch_params(thetas), x)
+        return np.array(np.broadcast_arrays(*grads)).transpose(1,0,2) # d_a doesn't depend on theta
+
+    def change_cdf(self,theta,x):
+        """The fraction of the transition that happened up to x (broadcasts like f).
+           This is the CDF of the change distribution: |df/dx| / |h| is a logistic density.
+        """
+        a,h,mu,w = theta
+        L = 1/(1+np.exp(-(x-mu)/w))
+        return np.where(w > 0, L, 1-L)
+
     def get_theta_guess(self,x,y):
         return [
             y.min(), # a
@@ -73,5 +89,10 @@ class Sigmoid(Shape):
         w = w / sx[0]
         return a,h,mu,w
 
+    @staticmethod
+    def _batch_params(thetas):
+        """Each parameter as a column vector (n_theta x 1) that broadcasts against x"""
+        return np.asarray(thetas, dtype=float).T[:,:,np.newaxis]
+
 if __name__ == '__main__':
     Sigmoid().TEST_check_grad()
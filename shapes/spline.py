@@ -1,3 +1,4 @@
+from collections import defaultdict
 import numpy as np
 from scipy.interpolate import UnivariateSpline, splev
 import config as cfg
@@ -20,10 +21,28 @@ class Spline(Shape):
         return 'spline'
 
     def f(self,theta,x):
-        if isinstance(theta, UnivariateSpline): # for backward compatibility with when we saved the UnivariateSpline objects
-            theta = [theta._eval_args]
-        tck = theta[0]
-        return splev(x,tck)
+        return splev(x, self._tck(theta))
+
+    def f_batch(self,thetas,x):
+        """Splines with the same knots (and degree) are evaluated together, as a product of their
+           coefficients with the B-spline basis of the knots (which is computed once).
+        """
+        x = np.asarray(x, dtype=float)
+        res = np.empty((len(thetas), len(x)))
+        groups = defaultdict(list) # (knots, degree) -> indices of the thetas
+        tcks = [self._tck(theta) for theta in thetas]
+        for i,(t,c,k) in enumerate(tcks):
+            groups[(tuple(t),k)].append(i)
+        for (t,k),inds in groups.iteritems():
+            if len(inds) == 1:
+                res[inds[0],:] = splev(x, tcks[inds[0]])
+                continue
+            t = np.array(t)
+            n_coeffs = len(t) - k - 1
+            basis = np.array([splev(x, (t, np.eye(n_coeffs)[j], k)) for j in xrange(n_coeffs)]) # n_coeffs x len(x)
+            coeffs = np.array([tcks[i][1][:n_coeffs] for i in inds])
+            res[inds,:] = np.dot(coeffs, basis)
+        return res
 
     def fit(self,x,y):
         inds = np.argsort(x)
@@ -46,6 +65,12 @@ class Spline(Shape):
         tck = spline._eval_args
         return [tck]
     
+    @staticmethod
+    def _tck(theta):
+        if isinstance(theta, UnivariateSpline): # for backward compatibility with when we saved the UnivariateSpline objects
+            theta = [theta._eval_args]
+        return theta[0]
+
     @staticmethod
     def _estimate_std(y):
         k = 10 # window size for std estimation
@@ -1,10 +1,12 @@
-import math
 from os.path import join
 import numpy as np
 from sklearn.datasets.base import Bunch
+import config as cfg
 from all_fits import iterate_fits
 from project_dirs import cache_dir, fit_results_relative_path
-from utils.misc import cache, init_array, save_matfile
+from utils.misc import init_array, save_matfile
+from utils.mapped_arrays import mapped_cache
+from utils.derived_fields import get_derived, fingerprint
 from utils.formats import list_of_strings_to_matlab_cell_array
 import scalers
 
@@ -20,16 +22,23 @@ def get_bins(data, age_range=None, n_bins=50):
     return bin_edges, bin_centers
 
 def calc_change_distribution(shape, theta, bin_edges):
-    a,h,mu,_ = theta
-    edge_vals = shape.f(theta,bin_edges)
-    changes = np.abs(edge_vals[1:] - edge_vals[:-1])
-    return changes / abs(h) # ignore change magnitude per gene - take only distribution of change times
-    
+    return calc_change_distributions(shape, np.asarray(theta)[:,np.newaxis], bin_edges)[0]
+
+def calc_change_distributions(shape, theta, bin_edges):
+    """theta - n_params x n array of sigmoid parameters. Returns n x n_bins array of change distributions."""
+    edge_vals = shape.f_batch(theta.T, bin_edges)
+    changes = np.abs(edge_vals[:,1:] - edge_vals[:,:-1])
+    return changes / abs(theta[1])[:,np.newaxis] # ignore change magnitude per gene - take only distribution of change times
+
 def change_distribution_mean_and_std(bin_centers, weights):
-    weights = np.array(weights, dtype=float) # in case it's a list
-    weights /= np.sum(weights) # normalize to make it a PMF
-    x0 = np.sum([x*w for x,w in zip(bin_centers,weights)])
-    V = np.sum([w*(x-x0)**2 for x,w in zip(bin_centers,weights)])
+    mu, std = change_distribution_means_and_stds(bin_centers, np.array(weights, dtype=float)[np.newaxis,:])
+    return mu[0], std[0]
+
+def change_distribution_means_and_stds(bin_centers, weights):
+    """weights - n x n_bins array. Returns arrays of the mean and std of each of the n distributions."""
+    weights = weights / np.sum(weights, axis=1)[:,np.newaxis] # normalize to make it a PMF
+    x0 = weights.dot(bin_centers)
+    V = np.sum(weights * (bin_centers - x0[:,np.newaxis])**2, axis=1)
     std = np.sqrt(V)
     return x0,std
     
@@ -38,23 +47,29 @@ def change_distribution_width_cumsum(bin_centers, weights, threshold=0.8):
     return x_to - x_from
 
 def change_distribution_spread_cumsum(bin_centers, weights, threshold=0.8):
-    weights = np.array(weights, dtype=float) # in case it's a list
-    weights /= np.sum(weights) # normalize to make it a PMF
+    x_median, x_from, x_to = change_distribution_spreads_cumsum(bin_centers, np.array(weights, dtype=float)[np.newaxis,:], threshold)
+    return x_median[0], x_from[0], x_to[0]
+
+def change_distribution_spreads_cumsum(bin_centers, weights, threshold=0.8):
+    """weights - n x n_bins array. Returns arrays of x_median, x_from, x_to for each of the n distributions."""
+    weights = weights / np.sum(weights, axis=1)[:,np.newaxis] # normalize to make it a PMF
     bin_width = bin_centers[1] - bin_centers[0] # we assume uniform bins here
-    s = np.cumsum(weights)
-    i_from = np.argmax(s > 0.5 - threshold/2.0)
-    i_to = np.argmax(s > 0.5 + threshold/2.0)
-    i_median = np.argmax(s > 0.5)
+    s = np.cumsum(weights, axis=1)
+    i_from = np.argmax(s > 0.5 - threshold/2.0, axis=1)
+    i_to = np.argmax(s > 0.5 + threshold/2.0, axis=1)
+    i_median = np.argmax(s > 0.5, axis=1)
     x_from = bin_centers[i_from] - 0.5*bin_width
     x_to = bin_centers[i_to] + 0.5*bin_width
     x_median = bin_centers[i_median]
     return x_median, x_from, x_to
 
-def add_change_distributions(data, fitter, fits, age_range=None, n_bins=50):
+def add_change_distributions(data, fitter, fits, age_range=None, n_bins=50, analytic=False):
     """ Compute a histogram of "strength of transition" at different ages.
         The histogram is computed for each (gene,region) in fits and is added to the fit objects.
         Currently this function only works for sigmoid fits. It uses the h parameter explicitly,
         relies on monotonicity, etc. It is probably not too hard to generalize it to other shapes.
+        analytic - compute the spread (median and range) from the exact CDF of the change distribution
+                   (see analytic_change_quantiles) instead of from the histogram.
     """
     shape = fitter.shape
     assert shape.cache_name() in ['sigmoid','sigslope'] # the function currently works only for sigmoid/sigslope fits
@@ -63,48 +78,230 @@ def add_change_distributions(data, fitter, fits, age_range=None, n_bins=50):
     fits.change_distribution_params = Bunch(
         bin_edges = bin_edges,
         bin_centers = bin_centers,
+        analytic = analytic,
     )
 
-    for dsname,g,r,fit in iterate_fits(fits, return_keys=True):
-        weights = calc_bootstrap_change_distribution(shape, fit.theta_samples, bin_edges)
-        fit.change_distribution_weights = weights
-        fit.change_distribution_spread = change_distribution_spread_cumsum(bin_centers, weights)
-        fit.change_distribution_mean_std = change_distribution_mean_and_std(bin_centers, weights)
+    def compute(dct_fits):
+        # all the fits (and all their bootstrap samples) are computed together, in chunks of fits
+        res = {}
+        keys = dct_fits.keys()
+        n = cfg.change_distribution_chunk_size
+        for i in xrange(0, len(keys), n):
+            chunk = keys[i:i+n]
+            theta_samples = np.array([dct_fits[k].theta_samples for k in chunk]) # n_fits x n_params x n_samples
+            weights = calc_bootstrap_change_distributions(shape, theta_samples, bin_edges)
+            if analytic:
+                x_median, x_from, x_to = analytic_change_spreads(shape, theta_samples, bin_edges)
+            else:
+                x_median, x_from, x_to = change_distribution_spreads_cumsum(bin_centers, weights)
+            mu, std = change_distribution_means_and_stds(bin_centers, weights)
+            for j,k in enumerate(chunk):
+                res[k] = (weights[j], (x_median[j], x_from[j], x_to[j]), (mu[j], std[j]))
+        return res
+
+    # the change distributions are cached next to the fits of each dataset
+    index_keys = []
+    for dataset in data.datasets:
+        ds_fits = {(g,r):fit for dsname,g,r,fit in iterate_fits(fits, return_keys=True) if dsname == dataset.name}
+        dct_change_distributions = get_derived(
+            name = 'change-distributions',
+            base_filename = fit_results_relative_path(dataset,fitter),
+            dependencies = [shape.cache_name(), bin_edges] + (['analytic'] if analytic else []),
+            items = ds_fits,
+            f_fingerprint = lambda fit: fingerprint(fit.theta_samples),
+            f_compute = compute,
+            k_of_n = getattr(fits, 'k_of_n', None),
+        )
+        for (g,r),fit in ds_fits.iteritems():
+            weights, spread, mean_std = dct_change_distributions[(g,r)]
+            fit.change_distribution_weights = weights
+            fit.change_distribution_spread = spread
+            fit.change_distribution_mean_std = mean_std
+            index_keys.append( (dataset.name,g,r) )
+
+    # the cumulative weights of all the fits are computed together (that's cheaper than caching them)
+    dct_fits = {(dsname,g,r):fit for dsname,g,r,fit in iterate_fits(fits, return_keys=True)}
+    weights = np.array([dct_fits[k].change_distribution_weights for k in index_keys]).reshape(len(index_keys), n_bins)
+    fits.change_distribution_index = ChangeFractionIndex(index_keys, cumulative_change_weights(weights), bin_edges)
+
+class ChangeFractionIndex(object):
+    """The cumulative change weights of many fits, for answering "what fraction of the change happens 
+       between ages A and B" for all of them at once (see fraction_of_change_from_cumulative).
+    """
+    def __init__(self, keys, cumulative, bin_edges):
+        self.keys = keys # (dsname,g,r) for each row of cumulative
+        self.cumulative = cumulative
+        self.bin_edges = bin_edges
+        self.key_to_row = {k:i for i,k in enumerate(keys)}
+
+    def fraction_of_change(self, x_from, x_to, normalize=False, keys=None):
+        """Returns an array with the fraction of change between x_from and x_to for each key 
+           (all the keys by default). x_from and x_to can also be arrays of several windows,
+           and then the result is n_keys x n_windows.
+        """
+        cumulative = self.cumulative
+        if keys is not None:
+            cumulative = cumulative[[self.key_to_row[k] for k in keys]]
+        return fraction_of_change_from_cumulative(cumulative, self.bin_edges, x_from, x_to, normalize)
+
+    def as_dict(self, values):
+        return dict(zip(self.keys, values))
+
+def cumulative_change_weights(weights):
+    """weights - n x n_bins. Returns n x (n_bins+1) array with the change up to each bin edge."""
+    cumulative = np.zeros((weights.shape[0], weights.shape[1]+1))
+    np.cumsum(weights, axis=1, out=cumulative[:,1:])
+    return cumulative
+
+def fraction_of_change_from_cumulative(cumulative, bin_edges, x_from, x_to, normalize=False):
+    """Vectorized compute_fraction_of_change for the n rows of cumulative (see cumulative_change_weights).
+       The change within each bin is assumed to be uniform, so the cumulative change is interpolated
+       linearly between the bin edges. x_from, x_to - scalars (returns an array of n fractions) or
+       arrays of n_windows (returns n x n_windows).
+    """
+    def change_up_to(x):
+        x = np.clip(x, bin_edges[0], bin_edges[-1])
+        i = np.clip(np.searchsorted(bin_edges, x, side='right'), 1, len(bin_edges)-1)
+        t = (x - bin_edges[i-1]) / (bin_edges[i] - bin_edges[i-1])
+        return cumulative[:,i-1] + t * (cumulative[:,i] - cumulative[:,i-1])
+    res = np.maximum(change_up_to(x_to) - change_up_to(x_from), 0)
+    if normalize:
+        total = cumulative[:,-1]
+        res = res / (total if res.ndim == 1 else total[:,np.newaxis])
+    return res
 
 def calc_bootstrap_change_distribution(shape, theta_samples, bin_edges):
-    bin_centers = bin_edges_to_centers(bin_edges)
-    n_params, n_samples = theta_samples.shape
-    weights = np.zeros(bin_centers.shape)
-    for i in xrange(n_samples):
-        weights += calc_change_distribution(shape, theta_samples[:,i], bin_edges)
-    weights /= n_samples # now values are in fraction of total change (doesn't have to sum up to 1 if ages don't cover the whole transition range)
-    return weights
-
-@cache(lambda data, fitter, fits: join(cache_dir(), fit_results_relative_path(data,fitter) + '-dprime-cube.pkl'))
+    return calc_bootstrap_change_distributions(shape, theta_samples[np.newaxis,:,:], bin_edges)[0]
+
+def calc_bootstrap_change_distributions(shape, theta_samples, bin_edges):
+    """theta_samples - n_fits x n_params x n_samples. Returns n_fits x n_bins array of the change distributions."""
+    n_fits, n_params, n_samples = theta_samples.shape
+    theta = theta_samples.transpose(1,0,2).reshape(n_params, n_fits*n_samples)
+    weights = calc_change_distributions(shape, theta, bin_edges).reshape(n_fits, n_samples, -1)
+    return weights.mean(axis=1) # now values are in fraction of total change (doesn't have to sum up to 1 if ages don't cover the whole transition range)
+
+#####################################################################
+# Analytic change distributions
+#   For sigmoids the change distribution of each bootstrap sample is a logistic density in age
+#   with a known CDF (shape.change_cdf), so the change distribution of a fit is a mixture of 
+#   logistics. Its CDF, quantiles and the fraction of change in an age window can be computed 
+#   exactly instead of from the histogram.
+#   The functions accept the theta_samples of one fit (n_params x n_samples) or of several 
+#   fits (n_fits x n_params x n_samples).
+#####################################################################
+
+def analytic_change_cdf(shape, theta_samples, x):
+    """Returns the fraction of the change (averaged over the samples) that happened up to each age in x.
+       For several fits x can also be n_fits x n_ages (different ages for each fit).
+    """
+    theta_samples, x, single = _as_several_fits(theta_samples, x)
+    theta = theta_samples.transpose(1,0,2)[:,:,:,np.newaxis] # n_params x n_fits x n_samples x 1
+    cdf = shape.change_cdf(theta, x[:,np.newaxis,:]).mean(axis=1)
+    return cdf[0] if single else cdf
+
+def analytic_fraction_of_change(shape, theta_samples, x_from, x_to, age_range=None):
+    """The fraction of the change that happens between x_from and x_to (analytic version of compute_fraction_of_change).
+       If age_range=(from_age,to_age) is given, the fraction is relative to the change within that range
+       (like normalize=True in compute_fraction_of_change).
+    """
+    ages = [x_from, x_to] if age_range is None else [x_from, x_to] + list(age_range)
+    cdf = analytic_change_cdf(shape, theta_samples, np.array(ages, dtype=float))
+    res = cdf[...,1] - cdf[...,0]
+    if age_range is not None:
+        res = res / (cdf[...,3] - cdf[...,2])
+    return res
+
+def analytic_change_quantiles(shape, theta_samples, quantiles, from_age, to_age, n_iterations=50):
+    """Returns the ages where the change within [from_age,to_age] reaches each of the quantiles 
+       (e.g. 0.5 is the median age of the change). The change distribution is restricted to the age
+       range, like the histogram. The ages are found by bisection (for all the fits and quantiles together)
+       with precision of (to_age-from_age) / 2**n_iterations.
+    """
+    theta_samples, _, single = _as_several_fits(theta_samples, None)
+    n_fits = theta_samples.shape[0]
+    quantiles = np.asarray(quantiles, dtype=float)
+    cdf_range = analytic_change_cdf(shape, theta_samples, np.array([from_age, to_age], dtype=float))
+    targets = cdf_range[:,[0]] + quantiles * (cdf_range[:,[1]] - cdf_range[:,[0]]) # n_fits x n_quantiles
+    low = np.tile(float(from_age), targets.shape)
+    high = np.tile(float(to_age), targets.shape)
+    for _ in xrange(n_iterations):
+        mid = 0.5 * (low + high)
+        below = analytic_change_cdf(shape, theta_samples, mid) < targets
+        low = np.where(below, mid, low)
+        high = np.where(below, high, mid)
+    res = 0.5 * (low + high)
+    return res[0] if single else res
+
+def analytic_change_spreads(shape, theta_samples, bin_edges, threshold=0.8):
+    """Analytic version of change_distribution_spreads_cumsum. Returns arrays of x_median, x_from, x_to."""
+    quantiles = [0.5, 0.5 - threshold/2.0, 0.5 + threshold/2.0]
+    res = analytic_change_quantiles(shape, theta_samples, quantiles, bin_edges[0], bin_edges[-1])
+    return res[...,0], res[...,1], res[...,2]
+
+def _as_several_fits(theta_samples, x):
+    theta_samples = np.asarray(theta_samples, dtype=float)
+    single = theta_samples.ndim == 2
+    if single:
+        theta_samples = theta_samples[np.newaxis,:,:]
+    if x is not None:
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = np.tile(x, (theta_samples.shape[0],1))
+    return theta_samples, x, single
+
+@mapped_cache(lambda data, fitter, fits: join(cache_dir(), fit_results_relative_path(data,fitter) + '-dprime-cube'), 'd-prime cube', cfg.timing_arrays_float32)
 def compute_dprime_measures_for_all_pairs(data, fitter, fits):
     genes = data.gene_names
     regions = data.region_names 
     r2ds = data.region_to_dataset()        
-    cube_shape = (len(genes), len(regions), len(regions))
-    d_mu = np.empty(cube_shape) # mu2-mu1 for all genes and region pairs
-    std = np.empty(cube_shape) # std (combined) for all genes and region pairs
-    def get_mu_std(g,r):
-        dsfits = fits[r2ds[r]]
-        fit = dsfits.get((g,r))
-        if fit is None:
-            return np.nan, np.nan
-        else:
-            return fit.change_distribution_mean_std
+    mu = init_array(np.NaN, len(genes), len(regions))
+    std = init_array(np.NaN, len(genes), len(regions))
     for ig,g in enumerate(genes):
-        for ir1,r1 in enumerate(regions):
-            mu1, std1 = get_mu_std(g,r1)
-            for ir2,r2 in enumerate(regions):
-                mu2, std2 = get_mu_std(g,r2)
-                d_mu[ig,ir1,ir2] = mu2 - mu1
-                std[ig,ir1,ir2] = math.sqrt(0.5*(std1*std1 + std2*std2))
-    return Bunch(d_mu=d_mu, std=std, genes=genes, regions=regions, age_scaler=data.age_scaler)
-
-@cache(lambda data, fitter, fits: join(cache_dir(), fit_results_relative_path(data,fitter) + '-change-dist.pkl'))
+        for ir,r in enumerate(regions):
+            fit = fits[r2ds[r]].get((g,r))
+            if fit is not None:
+                mu[ig,ir], std[ig,ir] = fit.change_distribution_mean_std
+    return DPrimeCube(mu, std, genes, regions, data.age_scaler)
+
+class DPrimeCube(object):
+    """The d' measures of the change distributions for all genes and region pairs:
+         d_mu[g,r1,r2] = mu[g,r2] - mu[g,r1]
+         std[g,r1,r2] = sqrt(0.5*(std[g,r1]^2 + std[g,r2]^2)) (combined std)
+       Only the (genes x regions) mean and std of the change distributions are kept, and each (r1,r2)
+       slice is computed when it's needed. The full (genes x regions x regions) cubes are computed 
+       (and not kept) only when d_mu or std are accessed.
+    """
+    def __init__(self, mu, std, genes, regions, age_scaler):
+        self.mu = mu
+        self.single_std = std
+        self.genes = genes
+        self.regions = regions
+        self.age_scaler = age_scaler
+
+    def pair(self, ir1, ir2, gene_inds=None):
+        """Returns (d_mu, combined std) for the region pair, for all the genes or just gene_inds"""
+        mu, std = self.mu, self.single_std
+        if gene_inds is not None:
+            mu, std = mu[gene_inds], std[gene_inds]
+        d_mu = mu[:,ir2] - mu[:,ir1]
+        pair_std = np.sqrt(0.5*(std[:,ir1]**2 + std[:,ir2]**2))
+        return d_mu, pair_std
+
+    def pair_scores(self, ir1, ir2, gene_inds=None):
+        """The d' scores (d_mu / combined std) for the region pair"""
+        d_mu, pair_std = self.pair(ir1, ir2, gene_inds)
+        return d_mu / pair_std
+
+    @property
+    def d_mu(self):
+        return self.mu[:,np.newaxis,:] - self.mu[:,:,np.newaxis]
+
+    @property
+    def std(self):
+        var = self.single_std**2
+        return np.sqrt(0.5*(var[:,:,np.newaxis] + var[:,np.newaxis,:]))
+
+@mapped_cache(lambda data, fitter, fits: join(cache_dir(), fit_results_relative_path(data,fitter) + '-change-dist'), 'change distributions', cfg.timing_arrays_float32)
 def compute_timing_info_for_all_fits(data, fitter, fits):
     genes = data.gene_names
     regions = data.region_names 
@@ -183,14 +380,5 @@ The scaling used for ages (i.e. 'log' means x' = log(x + 38/52))
     save_matfile(mdict, filename)
 
 def compute_fraction_of_change(weights, bin_edges, x_from, x_to, normalize=False):
-    total = 0
-    for weight, bin_from, bin_to in zip(weights,bin_edges[:-1],bin_edges[1:]):
-        bin_width = bin_to - bin_from
-        effective_from = max(x_from, bin_from)
-        effective_to = min(x_to, bin_to)
-        effective_width = effective_to - effective_from
-        if effective_width > 0:
-            total += weight * effective_width/bin_width
-    if normalize:
-        total /= sum(weights)
-    return total
+    cumulative = cumulative_change_weights(np.array(weights, dtype=float)[np.newaxis,:])
+    return fraction_of_change_from_cumulative(cumulative, bin_edges, x_from, x_to, normalize)[0]
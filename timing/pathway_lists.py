@@ -1,7 +1,13 @@
 import setup
+import cPickle as pickle
+import os
 from os import listdir
 from os.path import join, isfile
-from project_dirs import pathways_dir, pathway_lists_dir
+import numpy as np
+import scipy.sparse
+from sklearn.datasets.base import Bunch
+from project_dirs import cache_dir, pathways_dir, pathway_lists_dir
+from utils.misc import ensure_dir
 
 
 def all_pathway_lists():
@@ -10,8 +16,48 @@ def all_pathway_lists():
     return [x for x in listdir(d) if is_ok(x)]
 
 def read_all_pathways(listname='all'):
+    """Returns pathway -> list of genes for all the pathways in the list.
+       The pathways are read from the text files once and then kept in a compiled file in the cache,
+       which is used as long as the text files don't change.
+    """
     pathway_names = list_to_pathway_names(listname)
-    return {pathway: read_pathway(pathway) for pathway in pathway_names}
+    filename = join(cache_dir(), 'pathways', 'compiled-{}.pkl'.format(listname))
+    signature = _files_signature(pathway_names)
+    if isfile(filename):
+        try:
+            with open(filename) as f:
+                cached_signature, pathways = pickle.load(f)
+            if cached_signature == signature:
+                return pathways
+        except:
+            print 'Failed to read compiled pathways from {}'.format(filename)
+    pathways = {pathway: read_pathway(pathway) for pathway in pathway_names}
+    ensure_dir(join(cache_dir(), 'pathways'))
+    with open(filename,'w') as f:
+        pickle.dump((signature, pathways), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return pathways
+
+def pathway_membership(pathways, genes):
+    """ pathways - pathway -> list of genes (see read_all_pathways)
+        genes - the genes that are the columns of the matrix (e.g. the genes of the timing arrays)
+        Returns Bunch with:
+          pathways - the pathway names (sorted). These are the rows of the matrix.
+          matrix - sparse (pathways x genes) matrix with the number of times each gene appears in each pathway.
+                   Sums over the pathway genes (like nansum etc.) are then products of this matrix with arrays over genes.
+          sizes - the number of genes in each pathway (the length of the pathway's list)
+    """
+    names = sorted(pathways.iterkeys())
+    g2i = {g:i for i,g in enumerate(genes)}
+    rows = []
+    cols = []
+    for i,pathway in enumerate(names):
+        inds = [g2i[g] for g in pathways[pathway]]
+        rows.extend([i]*len(inds))
+        cols.extend(inds)
+    vals = np.ones(len(rows))
+    matrix = scipy.sparse.coo_matrix((vals,(rows,cols)), shape=(len(names),len(genes))).tocsr() # duplicates are summed
+    sizes = np.array([len(pathways[pathway]) for pathway in names])
+    return Bunch(pathways=names, matrix=matrix, sizes=sizes)
 
 def list_to_pathway_names(listname):
     if listname == 'all':
@@ -30,3 +76,11 @@ def read_pathway(pathway):
         lines = f.readlines()
     genes = [x.strip() for x in lines] # remove newlines
     return [x for x in genes if x] # rmeove empty strings
+
+def _files_signature(pathway_names):
+    """(name, size, modification time) for the files of the pathways"""
+    res = []
+    for pathway in pathway_names:
+        st = os.stat(join(pathways_dir(), pathway + '.txt'))
+        res.append( (pathway, st.st_size, st.st_mtime) )
+    return res
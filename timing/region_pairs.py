@@ -3,18 +3,20 @@ from os.path import join
 from collections import defaultdict
 import numpy as np
 from scipy.io import savemat
-from scipy.stats import nanmean
+from scipy.stats import nanmean, norm
 from sklearn.datasets.base import Bunch
+import config as cfg
 from project_dirs import cache_dir, results_dir
-from utils.misc import z_score_to_p_value, cache, load_pickle
+from utils.misc import cache
 from utils.formats import list_of_strings_to_matlab_cell_array
+from sigmoid_change_distribution import DPrimeCube
 from single_region import SingleRegion
 
 ##############################################################
 # RegionPairTiming
 ##############################################################
 class RegionPairTiming(object):
-    cube_filename = join(cache_dir(), 'both', 'fits-log-all-sigslope-theta-sigslope80-sigma-normal-dprime-cube.pkl')
+    cube_dirname = join(cache_dir(), 'both', 'fits-log-all-sigslope-theta-sigslope80-sigma-normal-dprime-cube')
     
     def __init__(self, listname='all'):
         self.listname = listname
@@ -28,94 +30,124 @@ class RegionPairTiming(object):
         self.mu = self.single.mu
         self.single_std = self.single.std
 
-        cube = load_pickle(RegionPairTiming.cube_filename, name='timing d-prime info for all genes and region pairs')
-        self.d_mu = cube.d_mu
-        self.pair_std = cube.std
-        self.scores = self.d_mu / self.pair_std
+        # the d-prime measures of each region pair are computed from the change distributions when needed
+        self.cube = DPrimeCube(self.mu, self.single_std, self.genes, self.regions, self.age_scaler)
 
         self.baseline = self.baseline_distribution_all_pairs(100, 10000)
 
     @cache(lambda self: join(cache_dir(), 'both', 'dprime-all-pathways-and-regions-{}.pkl'.format(self.listname)))
     def analyze_all_pathways(self):
+        """Computes the timing results for all the pathways and region pairs together.
+           Sums over the genes of each pathway are products of the sparse (pathways x genes) membership 
+           matrix with (genes x region pairs) arrays.
+        """
+        print 'Analyzing region pairs for {} pathways'.format(len(self.pathways))
+        M = self.single.membership.matrix
+        pathway_names = self.single.membership.pathways
+        n_genes = self.single.membership.sizes.astype(float) # genes in each pathway (the pathway's list length)
+
+        # keep only results "above the diagonal" (r1 < r2 lexicographically)
+        pairs = [(r1,r2) for r1 in self.regions for r2 in self.regions if r1 < r2]
+        d_mu, pair_std = [np.array(x).T for x in zip(*[self.cube.pair(self.r2i[r1], self.r2i[r2]) for r1,r2 in pairs])] # genes x pairs
+        scores = d_mu / pair_std
+        valid_scores = ~np.isnan(scores)
+        valid = ~np.isnan(d_mu) # needed for the PFC region from colantuoni which doesn't contain all genes
+        weights = 1/pair_std
+        def pathway_sum(x, mask):
+            return M.dot(np.where(mask, x, 0)) # pathways x pairs
+
+        score = pathway_sum(scores, valid_scores) / M.dot(valid_scores.astype(float)) # nanmean
+        baseline = np.array([self.baseline[pair] for pair in pairs]) # pairs x (mu,sigma)
+        sigma = baseline[:,1] / np.sqrt(n_genes)[:,np.newaxis]
+        z = (score - baseline[:,0]) / sigma
+        cdf = norm.cdf(z)
+        pval = 2 * np.minimum(cdf, 1-cdf) # two sided p-value of the z score
+        n_valid = M.dot(valid.astype(float))
+        weighted_delta = pathway_sum(weights*d_mu, valid) / pathway_sum(weights, valid)
+        delta = pathway_sum(d_mu, valid) / n_valid
+        n_non_valid = n_genes[:,np.newaxis] - n_valid
+        for j,(r1,r2) in enumerate(pairs):
+            assert r1 == 'PFC' or r2 == 'PFC' or not n_non_valid[:,j].any(), "r1={}, r2={}".format(r1,r2)
+        too_many_nans = n_non_valid / n_genes[:,np.newaxis] > 0.05
+
+        # mean onset age of each pathway in each region (weighted by 1/std)
+        single_weights = 1/self.single_std
+        single_valid = ~np.isnan(single_weights)
+        mean_ages = pathway_sum(single_weights*self.mu, single_valid) / pathway_sum(single_weights, single_valid)
+        mean_ages = self.age_scaler.unscale(mean_ages) # pathways x regions
+
         res = {} # (pathway,r1,r2) -> timing results
-        for pathway in self.pathways.iterkeys():
-            print 'Analyzing region pairs for pathway {}'.format(pathway)
-            pathway_genes = self.pathways[pathway]
-            for r1 in self.regions:
-                for r2 in self.regions:
-                    if r2 <= r1: # keep only results "above the diagonal" (r1 < r2 lexicographically)
-                        continue
-                    pathway_res = self.analyze_pathway_and_region_pair(pathway_genes, r1, r2)
-                    res[(pathway,r1,r2)] = pathway_res
+        for i,pathway in enumerate(pathway_names):
+            for j,(r1,r2) in enumerate(pairs):
+                nan_if_too_many = np.nan if too_many_nans[i,j] else 1
+                res[(pathway,r1,r2)] = Bunch(
+                    score = score[i,j] * nan_if_too_many,
+                    delta = delta[i,j] * nan_if_too_many,
+                    weighted_delta = weighted_delta[i,j] * nan_if_too_many,
+                    mu1_years = mean_ages[i,self.r2i[r1]] * nan_if_too_many,
+                    mu2_years = mean_ages[i,self.r2i[r2]] * nan_if_too_many,
+                    pval = pval[i,j] * nan_if_too_many,
+                    pathway_size = self.single.membership.sizes[i],
+                )
         return TimingResults.fromResultsDct(res, self.listname, self.pathways)
 
-    def analyze_pathway_and_region_pair(self, pathway_genes, r1, r2):
-        ir1, ir2 = self.r2i[r1], self.r2i[r2]
-        pathway_ig = [self.g2i[g] for g in pathway_genes]  
-        
-        all_pathway_scores = self.scores[pathway_ig, ir1, ir2]
-        score = nanmean(all_pathway_scores)
-        mu, sigma = self.baseline[(r1,r2)]
-        sigma = sigma / np.sqrt(len(pathway_ig))
-        z = (score - mu) / sigma
-        pval = z_score_to_p_value(z)
-
-        pathway_d_mu = self.d_mu[pathway_ig,ir1,ir2]
-        pathway_pair_std = self.pair_std[pathway_ig,ir1,ir2]
-        weights = 1/pathway_pair_std
-        valid = ~np.isnan(pathway_d_mu) # needed for the PFC region from colantuoni which doesn't contain all genes\
-        weights, pathway_d_mu = weights[valid], pathway_d_mu[valid]
-        weighted_delta = np.dot(weights, pathway_d_mu) / sum(weights)
-        delta = np.mean(pathway_d_mu)
-        too_many_nans = False
-        if not valid.all():
-            assert r1 == 'PFC' or r2 == 'PFC', "r1={}, r2={}".format(r1,r2)
-            n_genes = len(valid)
-            n_non_valid = n_genes - np.count_nonzero(valid)
-            if float(n_non_valid)/n_genes > 0.05:
-                too_many_nans = True
-        def mean_age(ir):
-            if too_many_nans:
-                return np.NaN            
-            ages = self.mu[pathway_ig,ir]
-            weights = 1/self.single_std[pathway_ig,ir]
-            valid = ~np.isnan(weights)
-            weights, ages = weights[valid], ages[valid]
-            age = np.dot(weights,ages) / sum(weights)
-            return self.age_scaler.unscale(age)
-        return Bunch(
-            score = score if not too_many_nans else np.nan,
-            delta = delta if not too_many_nans else np.nan,
-            weighted_delta = weighted_delta if not too_many_nans else np.nan,
-            mu1_years = mean_age(ir1),
-            mu2_years = mean_age(ir2),
-            pval = pval if not too_many_nans else np.nan,
-            pathway_size = len(pathway_genes),
-        )
-
-    @cache(filename = join(cache_dir(), 'both', 'dprime-baseline.pkl'))
+    @cache(lambda self, sample_size, n_samples: join(cache_dir(), 'both', 'dprime-baseline-{}.pkl'.format(cfg.dprime_baseline_mode)))
     def baseline_distribution_all_pairs(self, sample_size, n_samples):
+        """Returns (r1,r2) -> (mu,sigma) of the d' score of a random set of genes (see sampled_baseline).
+           All the region pairs are computed together, using cfg.dprime_baseline_mode ('sampling' or 'analytic').
+        """
+        n = len(self.regions)
+        pairs = [(ir1,ir2) for ir1 in xrange(n) for ir2 in xrange(ir1,n)] # (r2,r1) is just the opposite of (r1,r2)
+        scores = np.array([self.cube.pair_scores(ir1,ir2) for ir1,ir2 in pairs]).T # genes x pairs
+        if cfg.dprime_baseline_mode == 'analytic':
+            print 'Computing analytic baseline distribution for all region pairs'
+            mu, sigma = analytic_baseline(scores, sample_size, replace=False)
+        else:
+            print 'Sampling baseline distribution for all region pairs'
+            mu, sigma = sampled_baseline(scores, sample_size, n_samples, seed=cfg.random_seed)
         res = {}
-        for r1 in self.regions:
-            print 'Sampling baseline distribution of {} vs. all other regions'.format(r1)
-            for r2 in self.regions:
-                if (r2,r1) in res:
-                    mu,sigma = res[(r2,r1)]
-                    res[(r1,r2)] = -mu,sigma
-                else:
-                    res[(r1,r2)] = self.baseline_distribution_one_pair(r1, r2, sample_size, n_samples)
+        for (ir1,ir2),pair_mu,pair_sigma in zip(pairs,mu,sigma):
+            r1, r2 = self.regions[ir1], self.regions[ir2]
+            res[(r1,r2)] = pair_mu, pair_sigma
+            if r1 != r2:
+                res[(r2,r1)] = -pair_mu, pair_sigma
         return res
 
-    def baseline_distribution_one_pair(self, r1, r2, sample_size, n_samples):
-        ir1, ir2 = self.r2i[r1], self.r2i[r2]
-        pair_scores = self.scores[:,ir1,ir2]
-        x = np.empty(n_samples)
-        for i in xrange(n_samples):
-            inds = np.random.random_integers(0, len(pair_scores)-1, sample_size)
-            x[i] = nanmean(pair_scores[inds])
-        mu = x.mean()
-        sigma = x.std() * np.sqrt(sample_size)
-        return mu,sigma
+##############################################################
+# Baseline distributions
+##############################################################
+def sampled_baseline(scores, sample_size, n_samples, seed=None, max_chunk_elements=10**7):
+    """ scores - n_genes x n_pairs array of d' scores (NaN where missing)
+        Draws n_samples random sets of sample_size genes (with replacement). The same sets are used for all the
+        pairs, and the sets' mean scores are computed in chunks of sets to bound the memory.
+        Returns arrays (mu, sigma) for each pair: mu is the mean of the sets' mean score and sigma is the std 
+        of the sets' mean score scaled to a set of one gene, i.e. the std of the mean score of k genes is sigma/sqrt(k).
+    """
+    n_genes, n_pairs = scores.shape
+    rng = np.random.RandomState(seed)
+    inds = rng.randint(0, n_genes, size=(n_samples, sample_size))
+    means = np.empty((n_samples, n_pairs))
+    chunk_size = max(1, max_chunk_elements // (sample_size * n_pairs))
+    for i in xrange(0, n_samples, chunk_size):
+        means[i:i+chunk_size] = nanmean(scores[inds[i:i+chunk_size]], axis=1)
+    return means.mean(axis=0), means.std(axis=0) * np.sqrt(sample_size)
+
+def analytic_baseline(scores, sample_size, replace=True):
+    """Same as sampled_baseline, using the central limit theorem instead of sampling.
+       A set of sample_size genes has on average sample_size*p genes with a score (p = fraction of valid scores), 
+       so the std of its mean score is std/sqrt(sample_size*p). For sets of distinct genes (replace=False), like the 
+       real pathways, the variance is also multiplied by the finite population correction.
+    """
+    valid = ~np.isnan(scores)
+    n_valid = valid.sum(axis=0).astype(float)
+    p = n_valid / scores.shape[0]
+    mu = nanmean(scores, axis=0)
+    std = np.sqrt(nanmean((scores - mu)**2, axis=0))
+    sigma = std / np.sqrt(p)
+    if not replace:
+        n = sample_size * p
+        sigma *= np.sqrt((n_valid - n) / (n_valid - 1))
+    return mu, sigma
 
 ##############################################################
 # TimingResults
@@ -2,13 +2,13 @@ import setup
 import argparse
 from os.path import join
 import numpy as np
-from scipy.stats import spearmanr
 import matplotlib.pyplot as plt
 import config as cfg
 from project_dirs import results_dir
 from single_region import SingleRegion
 import pathway_lists
 from plots import save_figure
+from utils.permutation_test import paired_rank_correlation_test
 
 def plot_pathway(singles, pathway, order):
     lst_ir = [singles.r2i[r] for r in order]
@@ -41,38 +41,17 @@ def save_scores(singles, scores, order):
                 pathway = pathway[:55] + '...'
             print >>f, '{pathway:<60}{pathway_size:<7}{logpval:<15.3g}{pval:<10.3g}{sr:<15.3g}'.format(**locals())
 
-def get_permuted_rows(x,rng):
-    y = np.empty(x.shape, dtype=x.dtype)
-    for i,row in enumerate(x):
-        y[i,:] = rng.permutation(x[i])
-    return y
-
 def paired_spearman(x):
     """x is a two dimensional array. We check spearman rho (monotoncity) for each row.
        The function returns the average rho across rows and the two sided p-value of that score. 
-       The p-value is computed by permutation test.
+       The p-value is computed by a sequential permutation test (see utils/permutation_test.py).
     """
-    def mean_rho(x):
-        return np.mean([spearmanr(row,range(len(row)))[0] for row in x])
-    rho = mean_rho(x)
-    
     rng = np.random.RandomState(cfg.random_seed)
-    min_hits = 3
-    for n in [10, 10**2, 10**3, 10**4, 10**5]:
-        print '  running {} permutations...'.format(n),
-        n_more_extreme = 0
-        for _ in xrange(n):
-            y = get_permuted_rows(x,rng)
-            rho_i = mean_rho(y)
-            if abs(rho_i) >= abs(rho):
-                n_more_extreme += 1
-        pval = float(n_more_extreme)/n
-        print '  pval={:.3g}'.format(pval)
-        if n_more_extreme >= min_hits:
-            break
-    else:
-        print 'NOTE: APPROXIMATE P-VALUE. Permutation test found less than {} "hits"'.format(min_hits)
-    return rho, pval
+    rho, res = paired_rank_correlation_test(x, rng)
+    print '  pval={:.3g} ({} permutations)'.format(res.pval, res.n_permutations)
+    if not res.stopped_early:
+        print 'NOTE: APPROXIMATE P-VALUE. Permutation test found only {} "hits" in {} permutations'.format(res.n_hits, res.n_permutations)
+    return rho, res.pval
 
 def timing_vs_region_order(singles, order):
     lst_ir = [singles.r2i[r] for r in order]
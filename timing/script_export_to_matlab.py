@@ -2,9 +2,10 @@ import setup
 from os.path import join, dirname
 import numpy as np
 from scipy.io import savemat
-from single_region import SingleRegion
+from single_region import load_change_distributions
 from region_pairs import RegionPairTiming
-from utils.misc import load_pickle, ensure_dir
+from utils.misc import ensure_dir
+from utils.mapped_arrays import load_mapped
 from utils.formats import list_of_strings_to_matlab_cell_array
 from project_dirs import results_dir
 import scalers
@@ -16,7 +17,8 @@ def save_matfile(mdict, filename):
     savemat(filename, mdict, oned_as='column')
     
 def export_cube():
-    cube = load_pickle(RegionPairTiming.cube_filename)
+    cube = load_mapped(RegionPairTiming.cube_dirname)
+    assert cube is not None, 'd-prime cube not found in {}'.format(RegionPairTiming.cube_dirname)
     README = """\
 d_mu:
 mu(r2)-mu(r1) for every gene and region pair. 
@@ -52,7 +54,7 @@ The scaling used for ages (i.e. 'log' means x' = log(x + 38/52))
     save_matfile(mdict, join(results_dir(), 'export', 'cube.mat'))
 
 def export_singles():
-    change_dist = load_pickle(SingleRegion.change_dist_filename)
+    change_dist = load_change_distributions() # memory mapped, so the weights aren't loaded before they're written
     README = """\
 mu:
 The mean age of the change distribution for given gene and region.
@@ -98,7 +100,7 @@ The scaling used for ages (i.e. 'log' means x' = log(x + 38/52))
     save_matfile(mdict, join(results_dir(), 'export', 'change-distributions.mat'))
 
 def export_pathways():
-    change_dist = load_pickle(SingleRegion.change_dist_filename)
+    change_dist = load_change_distributions()
     matlab_g2i = {g:(i+1) for i,g in enumerate(change_dist.genes)} # NOTE that matlab is one based
     
     pathways = pathway_lists.read_all_pathways()
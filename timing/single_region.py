@@ -2,17 +2,17 @@ import setup
 from os.path import join
 import numpy as np
 from project_dirs import cache_dir
-from utils.misc import load_pickle
+from utils.mapped_arrays import load_mapped
 import pathway_lists 
 
 class SingleRegion(object):    
-    change_dist_filename = join(cache_dir(), 'both', 'fits-log-all-sigslope-theta-sigslope80-sigma-normal-change-dist.pkl')
+    change_dist_dirname = join(cache_dir(), 'both', 'fits-log-all-sigslope-theta-sigslope80-sigma-normal-change-dist')
     
     def __init__(self, listname='all'):
         self.listname = listname
         self.pathways = pathway_lists.read_all_pathways(listname)
 
-        self.change_dist = load_pickle(SingleRegion.change_dist_filename, 'change distribution for all genes and regions')
+        self.change_dist = load_change_distributions()
         self.genes = self.change_dist.genes
         self.regions = self.change_dist.regions
         self.g2i = {g:i for i,g in enumerate(self.genes)}
@@ -23,19 +23,24 @@ class SingleRegion(object):
         self.bin_edges = self.change_dist.bin_edges
         self.bin_centers = self.change_dist.bin_centers
         self.weights = self.change_dist.weights
+        self.membership = pathway_lists.pathway_membership(self.pathways, self.genes)
 
     def region_timings_per_pathway(self):
-        def mean_age(pathway_genes, r):
-            pathway_ig = [self.g2i[g] for g in pathway_genes]
-            ir = self.r2i[r]
-            ages = self.mu[pathway_ig,ir]
-            weights = 1/self.std[pathway_ig,ir]
-            age = np.dot(weights,ages) / sum(weights)
-            return self.age_scaler.unscale(age)
+        # the mean age (weighted by 1/std) of the genes of each pathway, for all pathways and regions together
+        M = self.membership.matrix
+        weights = 1/self.std
+        ages = M.dot(weights*self.mu) / M.dot(weights) # pathways x regions
+        ages = self.age_scaler.unscale(ages)
 
         res = {} # pathway -> { r -> mu }
-        for pathway in self.pathways.iterkeys():
-            pathway_genes = self.pathways[pathway]
-            res[pathway] = {r : mean_age(pathway_genes, r) for r in self.regions}
+        for pathway,pathway_ages in zip(self.membership.pathways, ages):
+            res[pathway] = dict(zip(self.regions, pathway_ages))
         return res
 
+def load_change_distributions():
+    """The change distributions of all genes and regions. The arrays are memory mapped, so e.g. the weights
+       (genes x regions x bins) are only read for the genes that are used.
+    """
+    change_dist = load_mapped(SingleRegion.change_dist_dirname)
+    assert change_dist is not None, 'Change distributions not found in {}. Compute them using compute_fits.py --change_dist'.format(SingleRegion.change_dist_dirname)
+    return change_dist
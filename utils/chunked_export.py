@@ -0,0 +1,147 @@
+"""
+Export of large arrays that are filled block by block (e.g. a block of genes at a time), so only
+the formats that need it have to keep all the arrays in memory.
+
+Formats:
+  'mat' - a matlab .mat file. The arrays are kept in memory and saved together when the export is closed.
+  'h5'  - an HDF5 file (requires h5py). Matlab can read it using h5read.
+  'npy' - a directory with a .npy file for each array and a header with the other fields, which can
+          be loaded (memory mapped) with utils.mapped_arrays.load_mapped.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os.path import join, isdir
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.io import savemat
+from sklearn.datasets.base import Bunch
+from utils.misc import ensure_dir
+from utils.formats import list_of_strings_to_matlab_cell_array
+from utils.mapped_arrays import load_mapped
+
+def export_formats():
+    return ['mat', 'h5', 'npy']
+
+def export_filename(base_filename, fmt):
+    return base_filename + {'mat': '.mat', 'h5': '.h5', 'npy': ''}[fmt]
+
+class ChunkedExport(object):
+    def __init__(self, base_filename, fmt, float32=False):
+        """ Use in a with statement, so the export is saved when the block ends or removed if it fails.
+            base_filename - the filename without the extension of the format
+            float32 - save float arrays in single precision
+        """
+        assert fmt in export_formats(), 'Unknown export format: {}'.format(fmt)
+        self.fmt = fmt
+        self.filename = export_filename(base_filename, fmt)
+        self.dtype = np.float32 if float32 else float
+        ensure_dir(os.path.dirname(self.filename))
+        # write to a temporary name and rename when it's complete, so a partial export is never read
+        if fmt == 'npy':
+            self._tmpname = tempfile.mkdtemp(prefix=os.path.basename(self.filename) + '-', dir=os.path.dirname(self.filename))
+        else:
+            fd, self._tmpname = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '-', suffix='.' + fmt, dir=os.path.dirname(self.filename))
+            os.close(fd)
+        if fmt == 'h5':
+            import h5py # not installed everywhere, and only needed for this format
+            self._h5 = h5py.File(self._tmpname, 'w')
+        self._mdict = {} # fields that are saved at the end ('mat' arrays, 'npy' header fields)
+        self._arrays = []
+
+    def create(self, name, shape):
+        """Returns a new array (filled with NaN) for the field 'name'. Assignments to the array are exported."""
+        self._arrays.append(name)
+        if self.fmt == 'h5':
+            return self._h5.create_dataset(name, shape=shape, dtype=self.dtype, fillvalue=np.NaN)
+        if self.fmt == 'npy':
+            arr = open_memmap(join(self._tmpname, name + '.npy'), mode='w+', dtype=self.dtype, shape=shape)
+            arr[:] = np.NaN
+            return arr
+        arr = np.empty(shape, dtype=self.dtype)
+        arr[:] = np.NaN
+        self._mdict[name] = arr
+        return arr
+
+    def set(self, name, value):
+        """Exports a (small) value: a number, array or list of strings"""
+        if _is_list_of_strings(value):
+            if self.fmt == 'mat':
+                value = list_of_strings_to_matlab_cell_array(value)
+            elif self.fmt == 'h5':
+                value = np.array(value, dtype=str)
+        if self.fmt == 'h5':
+            self._h5[name] = value
+        else:
+            self._mdict[name] = value
+
+    def close(self):
+        if self.fmt == 'mat':
+            savemat(self._tmpname, self._mdict, oned_as='column')
+        elif self.fmt == 'h5':
+            self._h5.close()
+        else:
+            for name in self._arrays:
+                self._mdict.pop(name, None)
+            header = dict(cls=Bunch, arrays=sorted(self._arrays), other=self._mdict)
+            with open(join(self._tmpname,'meta.pkl'),'w') as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._mdict = {}
+        if isdir(self.filename):
+            shutil.rmtree(self.filename, ignore_errors=True)
+        elif os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(self._tmpname, self.filename)
+
+    def abort(self):
+        """Removes the partial export (nothing is saved)"""
+        if self.fmt == 'h5':
+            self._h5.close()
+        self._mdict = {}
+        if isdir(self._tmpname):
+            shutil.rmtree(self._tmpname, ignore_errors=True)
+        elif os.path.exists(self._tmpname):
+            os.remove(self._tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.abort()
+
+@contextmanager
+def open_export(filename, fmt):
+    """Yields a dictionary name -> value for an export in the 'h5' or 'npy' format. The arrays are only read when
+       they're indexed (h5py datasets, memory mapped arrays). Lists of strings are returned as lists.
+    """
+    assert fmt in ['h5','npy'], 'Reading exports in the {} format is not supported'.format(fmt)
+    if fmt == 'npy':
+        yield dict(load_mapped(filename))
+        return
+    import h5py
+    f = h5py.File(filename, 'r')
+    try:
+        res = {}
+        for k,v in f.iteritems():
+            if v.dtype.kind == 'S':
+                res[k] = list(v[...])
+            elif v.shape == ():
+                res[k] = v[()]
+            else:
+                res[k] = v
+        yield res
+    finally:
+        f.close()
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+def _is_list_of_strings(x):
+    return isinstance(x, (list,tuple,np.ndarray)) and len(x) > 0 and all(isinstance(s, basestring) for s in x)
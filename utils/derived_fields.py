@@ -0,0 +1,119 @@
+"""
+Persists fields that are derived from cached results (e.g. the fit scores, which are computed
+from the fit predictions) next to the cached results, so loading everything from the cache
+doesn't mean recomputing them.
+
+A derived value is reused only if both of these didn't change since it was computed:
+  * dependencies - the inputs the derived values depend on, other than the base result itself
+    (e.g. score type, bin edges). These are hashed into the filename, so changing them just
+    means using a different file.
+  * the base result - each derived value is saved with a fingerprint of the base result
+    it was computed from (e.g. the fit predictions).
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+from os.path import dirname, join, isfile
+from glob import glob
+import numpy as np
+import config as cfg
+from project_dirs import cache_dir
+from utils.misc import ensure_dir
+
+def get_derived(name, base_filename, dependencies, items, f_fingerprint, f_compute, k_of_n=None):
+    """ name - name of the derived fields. Used in the filename and in print messages
+        base_filename - base file name of the results the fields are derived from
+        dependencies - list of (picklable) values the derived fields depend on
+        items - dictionary key -> base result
+        f_fingerprint(base) - returns a string that changes when the base result changes
+        f_compute(dct) - computes the derived values for a dictionary key -> base result
+                         and returns a dictionary key -> derived value
+        k_of_n - None or (k,n) when the items are a shard (see job_splitting)
+        Returns dictionary key -> derived value for all the keys in items.
+    """
+    filename = _derived_filename(name, base_filename, dependencies, k_of_n)
+    dct_cached = _read_all_derived_files(filename, k_of_n)
+
+    dct_res = {}
+    to_compute = {}
+    fingerprints = {}
+    for k,base in items.iteritems():
+        fp = f_fingerprint(base)
+        fingerprints[k] = fp
+        entry = dct_cached.get(k)
+        if entry is not None and entry[0] == fp:
+            dct_res[k] = entry[1]
+        else:
+            to_compute[k] = base
+
+    if cfg.verbosity > 0:
+        print 'Found {}/{} {} in cache'.format(len(dct_res), len(items), name)
+    if to_compute:
+        dct_computed = f_compute(to_compute)
+        dct_res.update(dct_computed)
+        for k,val in dct_computed.iteritems():
+            dct_cached[k] = (fingerprints[k], val)
+    if to_compute or _shard_files(filename, k_of_n):
+        if k_of_n is not None: # a shard only keeps its own values
+            dct_cached = {k:dct_cached[k] for k in items}
+        _save(filename, dct_cached, k_of_n)
+    return dct_res
+
+def fingerprint(*vals):
+    """A fingerprint for a sequence of values which may contain numpy arrays, None, or other picklable values"""
+    h = hashlib.md5()
+    for val in vals:
+        if val is None:
+            h.update('None')
+        elif isinstance(val, np.ndarray) and val.dtype != object:
+            h.update('{}{}'.format(val.dtype, val.shape))
+            h.update(np.ascontiguousarray(val).data)
+        else:
+            h.update(pickle.dumps(val, protocol=2))
+    return h.hexdigest()
+
+def _derived_filename(name, base_filename, dependencies, k_of_n):
+    str_dependencies = fingerprint(*dependencies)[:12]
+    filename = join(cache_dir(), '{}-{}-{}.pkl'.format(base_filename, name, str_dependencies))
+    if k_of_n is not None:
+        k,n = k_of_n
+        filename = '{}.{}-of-{}'.format(filename,k,n)
+    return filename
+
+def _main_filename(filename, k_of_n):
+    if k_of_n is None:
+        return filename
+    return filename.rsplit('.',1)[0]
+
+def _shard_files(filename, k_of_n):
+    """Derived files written by shards, which should be merged into the main file"""
+    if k_of_n is not None:
+        return []
+    return glob(filename + '.*-of-*')
+
+def _read_all_derived_files(filename, k_of_n):
+    dct = {}
+    # when computing a shard, values may already exist in the main file. When computing
+    # everything, values may be in the shards' files.
+    filenames = [_main_filename(filename, k_of_n)] + _shard_files(filename, k_of_n)
+    if k_of_n is not None:
+        filenames.append(filename)
+    for fname in filenames:
+        if not isfile(fname):
+            continue
+        try:
+            with open(fname) as f:
+                dct.update(pickle.load(f))
+        except:
+            print 'Failed to read cached derived fields from {}'.format(fname)
+    return dct
+
+def _save(filename, dct_cached, k_of_n):
+    if cfg.verbosity > 0:
+        print 'Saving derived fields to {}'.format(filename)
+    ensure_dir(dirname(filename))
+    with open(filename,'w') as f:
+        pickle.dump(dct_cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+    for fname in _shard_files(filename, k_of_n):
+        os.remove(fname)
@@ -9,10 +9,16 @@ from a set of keys to the result of the computation on them.
 """
 
 import cPickle as pickle
+import hashlib
+import heapq
 import os
 import shutil
+import time
+import traceback
+from collections import defaultdict
 from os.path import dirname, join, isfile, isdir
 from glob import glob
+from sklearn.datasets.base import Bunch
 import config as cfg
 from project_dirs import cache_dir
 from utils.misc import ensure_dir
@@ -21,60 +27,306 @@ from utils import parallel
 def proxy(*a,**kw):
     return a,kw
 
-def compute(name, f, arg_mapper, all_keys, k_of_n, base_filename, batch_size=None, f_sharding_key=None, all_sharding_keys=None, allow_new_computation=True):
+def compute(name, f, arg_mapper, all_keys, k_of_n, base_filename, batch_size=None, f_sharding_key=None, all_sharding_keys=None, allow_new_computation=True, context=None, result_arrays=None, partition=None):
     """ name - appears in print messages if verbosity > 0
         f - pickleable function that is called to do the actual computation on each sub-process
         arg_mapper(key,f_proxy):
             Translates key to arguments for the call to f.
             For convenience, this is done by calling f_proxy with the correct arguments and returning the result.
+        context - if not None, arg_mapper is not used. Instead f(context,key) is called in the sub-processes.
+            The context is sent once to each worker process (see parallel.WorkerPool), so it's a good place 
+            for large objects that are the same for all keys (e.g. the dataset).
+            The keys are then computed as they complete (see compute_many).
+        result_arrays - optional ResultArrays (see utils.result_arrays). Requires context.
+            The sub-processes write the results directly into these memory mapped arrays instead of 
+            returning them, and the arrays are used as the checkpoint instead of the batch files.
         k_of_n - None for complete computation. Otherwise (k,n) pair - n = number of parts, k = part number in [1..n]
         base_filename - base file name to use for caching the results
         batch_size - how many iterations to do before saving a checkpoint
+        partition - optional list of n lists of sharding keys (see balanced_partition) to use instead of
+            assigning the sharding keys to the shards round-robin. Requires f_sharding_key.
     """
-    if arg_mapper is None:
-        def arg_mapper(key,f_proxy):
-            return f_proxy(key)
+    j = job(name, f, all_keys, k_of_n, base_filename, 
+        arg_mapper = arg_mapper,
+        context = context,
+        result_arrays = result_arrays,
+        batch_size = batch_size,
+        f_sharding_key = f_sharding_key,
+        all_sharding_keys = all_sharding_keys,
+        allow_new_computation = allow_new_computation,
+        partition = partition,
+    )
+    return compute_many([j])[0]
+
+def job(name, f, all_keys, k_of_n, base_filename, arg_mapper=None, context=None, result_arrays=None, batch_size=None, f_sharding_key=None, all_sharding_keys=None, allow_new_computation=True, partition=None):
+    """Describes one computation for compute_many(). The arguments are the same as for compute()."""
     if batch_size is None:
         batch_size = cfg.job_batch_size
-     
-    keys = _get_shard(all_keys, k_of_n, f_sharding_key, all_sharding_keys)
-    dct_res, found_keys_not_in_main_file = _read_all_cache_files(base_filename, k_of_n, keys)
-    _consolidate(dct_res, base_filename, k_of_n, found_keys_not_in_main_file)
+    if result_arrays is not None:
+        assert context is not None, 'result_arrays requires a context'
+    return Bunch(
+        name = name,
+        f = f,
+        arg_mapper = arg_mapper,
+        context = context,
+        result_arrays = result_arrays,
+        all_keys = all_keys,
+        k_of_n = k_of_n,
+        base_filename = base_filename,
+        batch_size = batch_size,
+        f_sharding_key = f_sharding_key,
+        all_sharding_keys = all_sharding_keys,
+        allow_new_computation = allow_new_computation,
+        partition = partition,
+    )
 
-    missing_keys = set(k for k in keys if k not in dct_res)
+def compute_many(jobs):
+    """Computes several jobs (see job()) and returns a list with the results dictionary of each job.
+       The missing keys of all the jobs that have a context are computed by one pool of workers
+       and handled as they complete, so a slow key doesn't hold back the rest and there's no barrier 
+       between the jobs:
+         * Checkpoints are saved every batch_size results of a job or every cfg.job_checkpoint_seconds.
+         * A key whose computation raises an exception is retried (up to cfg.job_max_attempts attempts).
+           After that it is skipped - it's missing from the results and isn't cached, so it will be 
+           computed again next time.
+       Jobs without a context are computed in batches of batch_size.
+    """
+    for j in jobs:
+        _read_job_cache(j)
+    for j in jobs:
+        if j.missing_keys and j.context is None:
+            _compute_in_batches(j)
+    as_completed_jobs = [j for j in jobs if j.missing_keys and j.context is not None]
+    if as_completed_jobs:
+        _compute_as_completed(as_completed_jobs)
+    for j in jobs:
+        if cfg.verbosity > 0:
+            print 'Consolidating {}...'.format(j.name)
+        _consolidate(j.dct_res, j.base_filename, j.k_of_n, bool(j.missing_keys))
+    return [j.dct_res for j in jobs]
+
+def _read_job_cache(j):
+    j.shard_keys = _get_shard(j.all_keys, j.k_of_n, j.f_sharding_key, j.all_sharding_keys, j.partition)
+    j.dct_res, found_keys_not_in_main_file = _read_all_cache_files(j.base_filename, j.k_of_n, j.shard_keys)
+    if j.result_arrays is not None:
+        dct_arrays = j.result_arrays.read(_arrays_dir(j.base_filename,j.k_of_n), j.shard_keys)
+        if any(k not in j.dct_res for k in dct_arrays):
+            found_keys_not_in_main_file = True
+        j.dct_res.update(dct_arrays)
+    _consolidate(j.dct_res, j.base_filename, j.k_of_n, found_keys_not_in_main_file)
+
+    j.missing_keys = set(k for k in j.shard_keys if k not in j.dct_res)
     if cfg.verbosity > 0:
-        print 'Still need to compute {}/{} {}'.format(len(missing_keys),len(keys),name)
-    if missing_keys and not allow_new_computation:
+        print 'Still need to compute {}/{} {}'.format(len(j.missing_keys),len(j.shard_keys),j.name)
+    if j.missing_keys and not j.allow_new_computation:
         raise AssertionError('Cache does not contain all results')
 
-    # compute the keys that are missing
-    batches = parallel.batches(missing_keys, batch_size)
+def _compute_in_batches(j):
+    arg_mapper = j.arg_mapper
+    if arg_mapper is None:
+        def arg_mapper(key,f_proxy):
+            return f_proxy(key)
+    batches = parallel.batches(j.missing_keys, j.batch_size)
     pool = parallel.Parallel(_job_wrapper)
     for i,batch in enumerate(batches):
         if cfg.verbosity > 0:
-            print 'Computing {}: batch {}/{} ({} jobs per batch)'.format(name,i+1,len(batches),batch_size)
+            print 'Computing {}: batch {}/{} ({} jobs per batch)'.format(j.name,i+1,len(batches),j.batch_size)
         if cfg.parallel_run_locally:
-            updates = [_job_wrapper(f,key,*arg_mapper(key,proxy)) for key in batch]
+            updates = [_job_wrapper(j.f,key,*arg_mapper(key,proxy)) for key in batch]
         else:
-            updates = pool(pool.delay(f,key,*arg_mapper(key,proxy)) for key in batch)
+            updates = pool(pool.delay(j.f,key,*arg_mapper(key,proxy)) for key in batch)
         dct_updates = dict(updates) # convert key,value pairs to dictionary
-        _save_batch(dct_updates, base_filename, k_of_n, i)
-        dct_res.update(dct_updates)
+        _save_batch(dct_updates, j.base_filename, j.k_of_n, i)
+        j.dct_res.update(dct_updates)
 
+def _compute_as_completed(jobs):
+    contexts = []
+    for j in jobs:
+        j.pending = {} # results since the last checkpoint
+        j.i_batch = 0
+        j.n_done = 0
+        j.timings = {} # key -> seconds it took to compute
+        if j.result_arrays is not None:
+            j.result_arrays.create(_arrays_dir(j.base_filename,j.k_of_n), list(j.missing_keys))
+            contexts.append( (_store_in_result_arrays, (j.f,j.context,j.result_arrays)) )
+        else:
+            contexts.append( (j.f, j.context) )
+
+    tasks = [(i,key) for i,j in enumerate(jobs) for key in j.missing_keys]
+    attempts = defaultdict(int)
+    skipped = []
+    last_checkpoint = time.time()
+    try:
+        with parallel.WorkerPool(_compute_one, contexts) as pool:
+            while tasks:
+                failed = []
+                for (i,key),(ok,val,seconds) in pool.imap_unordered(tasks):
+                    j = jobs[i]
+                    if ok:
+                        j.timings[key] = seconds
+                        if j.result_arrays is not None:
+                            val = j.result_arrays.get(key)
+                        j.dct_res[key] = val
+                        j.pending[key] = val
+                        j.n_done += 1
+                    else:
+                        attempts[(i,key)] += 1
+                        print 'Failed computing {} for {} (attempt {}/{}):\n{}'.format(j.name, key, attempts[(i,key)], cfg.job_max_attempts, val)
+                        if attempts[(i,key)] < cfg.job_max_attempts:
+                            failed.append( (i,key) )
+                        else:
+                            skipped.append( (j.name,key) )
+                    out_of_time = time.time() - last_checkpoint > cfg.job_checkpoint_seconds
+                    if out_of_time or len(j.pending) >= j.batch_size:
+                        for other in jobs:
+                            _save_checkpoint(other)
+                        last_checkpoint = time.time()
+                tasks = failed
+    finally:
+        for j in jobs:
+            _save_checkpoint(j)
+            _save_timings(j)
+            if j.result_arrays is not None:
+                j.result_arrays.close()
+    if skipped:
+        print 'WARNING: skipped {} keys that failed {} times: {}'.format(len(skipped), cfg.job_max_attempts, skipped)
+
+def _save_checkpoint(j):
+    if not j.pending:
+        return
     if cfg.verbosity > 0:
-        print 'Consolidating fits...'
-    _consolidate(dct_res, base_filename, k_of_n, bool(missing_keys))
-    return dct_res
+        print 'Computing {}: {}/{} done'.format(j.name, j.n_done, len(j.missing_keys))
+    if j.result_arrays is not None:
+        j.result_arrays.flush() # the arrays are the checkpoint
+    else:
+        _save_batch(j.pending, j.base_filename, j.k_of_n, j.i_batch)
+        j.i_batch += 1
+    j.pending = {}
+
+def _compute_one(contexts, task):
+    # this must be a top-level function so the worker pool can pickle it
+    i, key = task
+    f, context = contexts[i]
+    t0 = time.time()
+    try:
+        return True, f(context,key), time.time() - t0
+    except Exception:
+        return False, traceback.format_exc(), time.time() - t0
+
+#####################################################################
+# Balancing the shards
+#####################################################################
+
+def read_timings(base_filename):
+    """Returns a dictionary key -> seconds it took to compute the key, as recorded by previous 
+       computations with this base file name (including all the shards).
+    """
+    dct = {}
+    for filename in sorted(glob(_timings_filename(base_filename, k_of_n=None) + '*')):
+        dct.update(_read_one_cache_file(filename, st_keys=None, is_batch=True))
+    return dct
+
+def balanced_partition(base_filename, all_sharding_keys, n, f_costs):
+    """Splits the sharding keys to n parts with roughly the same total cost, using the greedy 
+       longest-processing-time rule (most expensive key first, to the part with the least total cost).
+       f_costs() - returns a dictionary sharding key -> estimated cost.
+       The partition is saved in the cache and the first shard that computes it determines it for all 
+       the shards, since the cost estimates can change while the shards are running (e.g. new timings).
+       Use remove_partitions() to allow computing a new partition.
+       Returns a list of n lists of sharding keys.
+    """
+    all_sharding_keys = list(all_sharding_keys)
+    filename = _partition_filename(base_filename, all_sharding_keys, n)
+    partition = _read_partition(filename)
+    if partition is not None:
+        return partition
+
+    costs = f_costs()
+    loads = [(0,i) for i in xrange(n)] # heap of (total cost, part index)
+    partition = [[] for _ in xrange(n)]
+    for skey in sorted(all_sharding_keys, key=lambda skey: -costs.get(skey,0)): # sort is stable, so ties keep their order
+        load, i = heapq.heappop(loads)
+        partition[i].append(skey)
+        heapq.heappush(loads, (load + costs.get(skey,0), i))
+    if cfg.verbosity > 0:
+        part_costs = sorted(load for load,i in loads)
+        print 'Balanced partition to {} parts. Estimated costs: min={:.3g}, max={:.3g}'.format(n, part_costs[0], part_costs[-1])
+
+    # write the partition unless another shard already did
+    ensure_dir(dirname(filename))
+    try:
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return _read_partition(filename, wait=True)
+    with os.fdopen(fd,'w') as f:
+        pickle.dump(partition,f)
+    return partition
+
+def remove_partitions(base_filename):
+    for filename in glob(join(cache_dir(), base_filename + '-partition-*.pkl')):
+        os.remove(filename)
+
+def _partition_filename(base_filename, all_sharding_keys, n):
+    h = hashlib.md5(pickle.dumps(all_sharding_keys)).hexdigest()[:12]
+    return join(cache_dir(), '{}-partition-{}-{}.pkl'.format(base_filename, n, h))
+
+def _read_partition(filename, wait=False):
+    n_tries = 10 if wait else 1
+    for i in xrange(n_tries):
+        if i > 0:
+            time.sleep(1) # the shard that created the file may still be writing it
+        if not isfile(filename):
+            continue
+        try:
+            with open(filename) as f:
+                return pickle.load(f)
+        except:
+            pass
+    if wait:
+        raise AssertionError('Failed to read partition from {}'.format(filename))
+    return None
+
+def _save_timings(j):
+    if not j.timings:
+        return
+    filename = _timings_filename(j.base_filename, j.k_of_n)
+    dct = _read_one_cache_file(filename, st_keys=None, is_batch=True)
+    dct.update(j.timings)
+    ensure_dir(dirname(filename))
+    with open(filename,'w') as f:
+        pickle.dump(dct,f)
+    j.timings = {}
+
+def _timings_filename(base_filename, k_of_n):
+    filename = join(cache_dir(), base_filename + '-timings.pkl')
+    if k_of_n is not None:
+        k,n = k_of_n
+        filename = '{}.{}-of-{}'.format(filename,k,n)
+    return filename
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+def _store_in_result_arrays(context, key):
+    # this must be a top-level function so the worker pool can pickle it
+    f, f_context, result_arrays = context
+    result_arrays.store(key, f(f_context,key))
 
 def _job_wrapper(f,key,a,kw):
     # this must be a top-level function so the parallelization can pickle it
     val = f(*a,**kw)
     return key,val
 
-def _get_shard(all_keys, k_of_n, f_sharding_key, all_sharding_keys):
+def _get_shard(all_keys, k_of_n, f_sharding_key, all_sharding_keys, partition=None):
     if k_of_n is None:
         return all_keys
     k,n = k_of_n
+    if partition is not None:
+        assert f_sharding_key is not None, 'partition requires f_sharding_key'
+        assert len(partition) == n
+        chosen_skeys = set(partition[k-1])
+        return [key for key in all_keys if f_sharding_key(key) in chosen_skeys]
     if f_sharding_key is None:
         return all_keys[k-1::n] # k is one-based, so subtract one
     else:
@@ -179,10 +431,19 @@ def _consolidate(dct_res, base_filename, k_of_n, found_keys_not_in_main_file):
         batch_filenames = glob(base + '*')
         for filename in batch_filenames:
             os.remove(filename)
+    arrays_dir = _arrays_dir(base_filename, k_of_n)
+    if isdir(arrays_dir):
+        shutil.rmtree(arrays_dir)
 
 def _batch_dir(base_filename):
     return join(cache_dir(),base_filename + '-batches')
 
+def _arrays_dir(base_filename, k_of_n):
+    if k_of_n is None:
+        return join(cache_dir(),base_filename + '-arrays')
+    k,n = k_of_n
+    return join(cache_dir(),'{}-arrays.{}-of-{}'.format(base_filename,k,n))
+
 def _batch_base_filename(base_filename, k_of_n):
     if k_of_n is None:
         prefix = 'main'
@@ -0,0 +1,97 @@
+"""
+Large results saved as memory mapped arrays.
+
+A result (a Bunch, or any object whose attributes are numpy arrays and small values) is saved as a
+directory with one .npy file for each numeric array and a small header (meta.pkl) with the rest of
+the fields. Loading the result memory maps the arrays, so it takes no time and only the parts of
+the arrays that are actually used are read from disk.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+from functools import wraps
+from os.path import join, isfile, isdir
+import numpy as np
+from sklearn.datasets.base import Bunch
+from utils.misc import ensure_dir
+
+def save_mapped(dirname, obj, float32=False):
+    """Saves obj to dirname. With float32=True, float arrays are saved in single precision (half the size)."""
+    fields = obj if isinstance(obj, Bunch) else vars(obj)
+    arrays = {k:v for k,v in fields.iteritems() if _is_numeric_array(v)}
+    header = dict(
+        cls = type(obj),
+        arrays = sorted(arrays.keys()),
+        other = {k:v for k,v in fields.iteritems() if k not in arrays},
+    )
+    # write to a temporary directory and rename it when it's complete, so a partial result is never loaded
+    ensure_dir(os.path.dirname(dirname))
+    tmpdir = tempfile.mkdtemp(prefix=os.path.basename(dirname) + '-', dir=os.path.dirname(dirname))
+    for name,arr in arrays.iteritems():
+        if float32 and arr.dtype == np.float64:
+            arr = arr.astype(np.float32)
+        np.save(join(tmpdir, name + '.npy'), arr)
+    with open(join(tmpdir,'meta.pkl'),'w') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if isdir(dirname):
+        shutil.rmtree(dirname, ignore_errors=True) # stale
+    try:
+        os.rename(tmpdir, dirname)
+    except OSError: # another process got there first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def load_mapped(dirname):
+    """Loads the result saved in dirname, with its arrays memory mapped (read only).
+       If there's no result in dirname but there's a pickle of it in <dirname>.pkl (e.g. saved
+       by utils.misc.cache), the pickle is converted once. Returns None if the result doesn't exist.
+    """
+    filename = join(dirname,'meta.pkl')
+    legacy_pickle = dirname + '.pkl'
+    if not isfile(filename):
+        if not isfile(legacy_pickle):
+            return None
+        print 'Converting {} to memory mapped arrays in {}'.format(legacy_pickle, dirname)
+        with open(legacy_pickle) as f:
+            save_mapped(dirname, pickle.load(f))
+    with open(filename) as f:
+        header = pickle.load(f)
+    fields = dict(header['other'])
+    for name in header['arrays']:
+        fields[name] = np.load(join(dirname, name + '.npy'), mmap_mode='r')
+    cls = header['cls']
+    if cls is Bunch:
+        return Bunch(**fields)
+    obj = cls.__new__(cls)
+    obj.__dict__.update(fields)
+    return obj
+
+def mapped_cache(dirname, name='data', float32=False):
+    """Like utils.misc.cache, but saves the result with save_mapped and loads it with load_mapped"""
+    def deco(func):
+        @wraps(func)
+        def _wrapper(*a, **kw):
+            force = kw.pop('force', False)
+            if isinstance(dirname, str):
+                dname = dirname
+            else:
+                dname = dirname(*a,**kw)
+            if not force:
+                res = load_mapped(dname)
+                if res is not None:
+                    print 'Loading {} from {}'.format(name, dname)
+                    return res
+            res = func(*a,**kw)
+            print 'Saving {} to {}'.format(name, dname)
+            save_mapped(dname, res, float32)
+            return load_mapped(dname) # so the result is the same as when it's loaded later
+        return _wrapper
+    return deco
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+def _is_numeric_array(x):
+    return isinstance(x, np.ndarray) and x.dtype.kind in 'biuf' and x.ndim > 0
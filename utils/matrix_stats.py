@@ -0,0 +1,148 @@
+"""
+Statistical tests computed for all the rows of a matrix together (e.g. one test per gene).
+
+The tests work along the last axis, so a 2D array of genes x values gives one result per gene
+and a 1D array gives a single result. The results match scipy.stats (spearmanr, ttest_ind,
+ttest_rel and wilcoxon with its default settings) and sklearn's r2_score applied to each row separately.
+
+With skip_nan=True, NaN values are ignored (pairs where either value is NaN, for the paired tests),
+otherwise a row that contains a NaN gets a NaN result.
+"""
+
+import numpy as np
+from scipy.stats import t as t_dist, norm
+
+def rank_rows(x, skip_nan=False):
+    """Returns the ranks (1..n, averaged for ties) of the values in each row of x.
+       NaN values get NaN ranks. Without skip_nan the whole row of a NaN gets NaN ranks.
+    """
+    x = np.asarray(x, dtype=float)
+    ranks, _ = _ranks_and_ties(x)
+    if not skip_nan:
+        ranks[np.isnan(x).any(axis=-1)] = np.nan
+    return ranks
+
+def spearman_with_order(x, order=None, skip_nan=False):
+    """Spearman correlation of each row of x with order (default: 0,1,2...).
+       Returns (rho, two sided p-value) with one value per row.
+    """
+    x = np.asarray(x, dtype=float)
+    if order is None:
+        order = np.arange(x.shape[-1])
+    order = np.asarray(order, dtype=float) * np.ones(x.shape)
+    valid = ~np.isnan(x) & ~np.isnan(order)
+    x_ranks = _centered(rank_rows(np.where(valid, x, np.nan), skip_nan=True), valid)
+    order_ranks = _centered(rank_rows(np.where(valid, order, np.nan), skip_nan=True), valid)
+    n = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = (x_ranks*order_ranks).sum(axis=-1) / np.sqrt((x_ranks**2).sum(axis=-1) * (order_ranks**2).sum(axis=-1))
+        t = rho * np.sqrt((n-2) / ((rho+1.0)*(1.0-rho)))
+        pval = 2*t_dist.sf(np.abs(t), n-2)
+    return _nan_rows(rho, valid, skip_nan, n < 3), _nan_rows(pval, valid, skip_nan, n < 3)
+
+def ttest_ind_rows(a, b, skip_nan=False):
+    """t-test for the means of two independent samples (with equal variances) in each pair of rows of a and b.
+       The rows of a and b can have different lengths. Returns (t, two sided p-value) with one value per row.
+    """
+    n1, m1, v1 = _n_mean_var(a, skip_nan)
+    n2, m2, v2 = _n_mean_var(b, skip_nan)
+    df = n1 + n2 - 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled_var = ((n1-1)*v1 + (n2-1)*v2) / df
+        t = (m1 - m2) / np.sqrt(pooled_var * (1.0/n1 + 1.0/n2))
+        pval = 2*t_dist.sf(np.abs(t), df)
+    return t, pval
+
+def ttest_rel_rows(a, b, skip_nan=False):
+    """Paired t-test for each pair of rows of a and b. Returns (t, two sided p-value) with one value per row."""
+    n, m, v = _n_mean_var(np.asarray(a, dtype=float) - np.asarray(b, dtype=float), skip_nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = m / np.sqrt(v / n)
+        pval = 2*t_dist.sf(np.abs(t), n-1)
+    return t, pval
+
+def wilcoxon_rows(a, b, skip_nan=False):
+    """Wilcoxon signed rank test for each pair of rows of a and b (zero differences are discarded and the
+       normal approximation is used, like scipy.stats.wilcoxon). Returns (T, two sided p-value) with one value per row.
+    """
+    d = np.asarray(a, dtype=float) - np.asarray(b, dtype=float)
+    not_nan = ~np.isnan(d)
+    valid = not_nan & (d != 0)
+    ranks, ties = _ranks_and_ties(np.where(valid, np.abs(d), np.nan))
+    r_plus = np.where(valid & (d > 0), ranks, 0).sum(axis=-1)
+    r_minus = np.where(valid & (d < 0), ranks, 0).sum(axis=-1)
+    T = np.minimum(r_plus, r_minus)
+    n = valid.sum(axis=-1).astype(float)
+    tie_correction = 0.5 * np.where(valid, ties**2 - 1, 0).sum(axis=-1) # each group of t ties adds t*(t^2-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se = np.sqrt((n*(n+1)*(2*n+1) - tie_correction) / 24)
+        z = (T - n*(n+1)/4) / se
+        pval = 2*norm.sf(np.abs(z))
+    return _nan_rows(T, not_nan, skip_nan, n == 0), _nan_rows(pval, not_nan, skip_nan, n == 0)
+
+def r2_rows(y_true, y_pred, skip_nan=False):
+    """Coefficient of determination (R2) of the predictions in each row, like sklearn's r2_score applied to each row.
+       When the values of a row are constant its R2 is 1 for perfect predictions and 0 otherwise.
+       Rows with no values get NaN.
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    y_pred = np.asarray(y_pred, dtype=float)
+    not_nan = ~np.isnan(y_true) & ~np.isnan(y_pred)
+    valid = not_nan if skip_nan else np.ones(not_nan.shape, dtype=bool)
+    numerator = np.where(valid, (y_true - y_pred)**2, 0).sum(axis=-1)
+    denominator = (_centered(y_true, valid)**2).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2 = np.where(denominator != 0, 1 - numerator/denominator, np.where(numerator != 0, 0.0, 1.0))
+    return _nan_rows(r2, not_nan, skip_nan, valid.sum(axis=-1) == 0)
+
+#####################################################################
+# Private helper methods
+#####################################################################
+
+def _ranks_and_ties(x):
+    """Returns the average ranks of the values in each row of x (NaN for NaN values) and the size of the group
+       of ties of each value.
+    """
+    shape = x.shape
+    x = x.reshape(-1, shape[-1]) if x.ndim > 0 else x.reshape(1,1)
+    m, n = x.shape
+    inds = np.argsort(x, axis=1) # NaNs are sorted last
+    s = x[np.arange(m)[:,np.newaxis], inds].ravel()
+    new_group = np.ones(m*n, dtype=bool)
+    new_group[1:] = s[1:] != s[:-1] # NaN != NaN, so each NaN is a group of its own
+    new_group[::n] = True # each row starts a new group
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.append(starts, m*n))
+    positions = starts % n # position of the first value of each group in its row
+    sorted_ranks = (positions + 0.5*(sizes+1))[group]
+    sorted_ties = sizes[group].astype(float)
+    sorted_ranks[np.isnan(s)] = np.nan
+    ranks = np.empty((m,n))
+    ties = np.empty((m,n))
+    rows = np.arange(m)[:,np.newaxis]
+    ranks[rows, inds] = sorted_ranks.reshape(m,n)
+    ties[rows, inds] = sorted_ties.reshape(m,n)
+    return ranks.reshape(shape), ties.reshape(shape)
+
+def _centered(x, valid):
+    """Subtracts the mean of the valid values in each row, and sets the other values to zero"""
+    n = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, x, 0).sum(axis=-1) / n
+    return np.where(valid, x - mean[...,np.newaxis], 0)
+
+def _n_mean_var(x, skip_nan):
+    """Number of values, mean and unbiased variance of each row"""
+    x = np.asarray(x, dtype=float)
+    valid = ~np.isnan(x) if skip_nan else np.ones(x.shape, dtype=bool)
+    n = valid.sum(axis=-1).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, x, 0).sum(axis=-1) / n
+        var = np.where(valid, (x - mean[...,np.newaxis])**2, 0).sum(axis=-1) / (n-1)
+    return n, mean, var
+
+def _nan_rows(res, valid, skip_nan, too_few):
+    """Sets NaN results for rows without enough values, and for rows with NaNs when they aren't skipped"""
+    bad = too_few if skip_nan else too_few | ~valid.all(axis=-1)
+    return np.where(bad, np.nan, res)
@@ -1,4 +1,5 @@
 import cPickle as pickle
+import multiprocessing
 from sklearn.externals import joblib
 from . import misc
 import config as cfg
@@ -36,6 +37,73 @@ class Parallel(object):
     def __call__(self, delayed_calls):
         return self.pool(delayed_calls)
 
+class WorkerPool(object):
+    """A long lived pool of worker processes.
+       Each worker is initialized once - warnings are disabled, the config settings are copied
+       from the parent process and 'context' (e.g. the fitter and the dataset) is kept resident
+       in the worker. After that each task only carries its key, and f(context,key) is called
+       in the worker.
+       f must be a top level function so it can be pickled.
+    """
+    def __init__(self, f, context=None, n_jobs=None):
+        self.f = f
+        self.context = context
+        self.n_jobs = effective_n_jobs(n_jobs)
+        if cfg.parallel_run_locally or self.n_jobs == 1:
+            self.pool = None # run in this process
+        else:
+            initargs = (_get_vars_in_module(cfg), f, context)
+            self.pool = multiprocessing.Pool(self.n_jobs, initializer=_init_worker, initargs=initargs)
+
+    def imap_unordered(self, keys):
+        """Yields (key, f(context,key)) for all keys, in the order the results are ready"""
+        if self.pool is None:
+            return ((key, self.f(self.context,key)) for key in keys)
+        return self.pool.imap_unordered(_pool_job, keys)
+
+    def __call__(self, keys):
+        """Returns a list of (key, f(context,key)) for all keys"""
+        return list(self.imap_unordered(keys))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None and exc_info[0] is not None:
+            self.pool.terminate()
+        self.close()
+
+def effective_n_jobs(n_jobs=None):
+    """Translates n_jobs to a number of processes, using the joblib convention 
+       for negative numbers (-1 = all CPUs, -2 = all CPUs but one, etc.)
+    """
+    if n_jobs is None:
+        n_jobs = cfg.parallel_n_jobs
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count() + 1 + n_jobs
+    return max(n_jobs,1)
+
+_worker_f = None
+_worker_context = None
+
+def _init_worker(_cfg_vars, f, context):
+    """Used by WorkerPool to initialize each worker process (once)"""
+    global _worker_f, _worker_context
+    misc.disable_all_warnings()
+    _set_vars_in_module(cfg, _cfg_vars)
+    _worker_f = f
+    _worker_context = context
+
+def _pool_job(key):
+    """Used by WorkerPool as the entry point for each task in the worker processes"""
+    return key, _worker_f(_worker_context, key)
+
 def _job_wrapper(_cfg_vars, _func, *a, **kw):
     """Used by Parallel as the entry point for each sub-process.
        This must be a top level function so it can be pickled.
@@ -44,18 +112,27 @@ def _job_wrapper(_cfg_vars, _func, *a, **kw):
     _set_vars_in_module(cfg, _cfg_vars)
     return _func(*a,**kw)
 
+_can_pickle_cache = {} # (module name, attribute name, type) -> whether the attribute can be pickled
+
 def _get_vars_in_module(module, only_picklable=True, remove_private=True):
     dct = {k:getattr(module,k) for k in dir(module)}
     if remove_private:
         dct = {k:v for k,v in dct.iteritems() if not k.startswith('_')}
     if only_picklable:
-        def can_pickle(x):
-            try:
-                pickle.dumps(x)
-                return True
-            except:
-                return False
-        dct = {k:v for k,v in dct.iteritems() if can_pickle(v)}
+        # trying to pickle everything each time is expensive (e.g. the module imports sklearn functions), 
+        # so remember the result per attribute and type
+        def can_pickle(k,x):
+            cache_key = (module.__name__, k, type(x))
+            res = _can_pickle_cache.get(cache_key)
+            if res is None:
+                try:
+                    pickle.dumps(x)
+                    res = True
+                except:
+                    res = False
+                _can_pickle_cache[cache_key] = res
+            return res
+        dct = {k:v for k,v in dct.iteritems() if can_pickle(k,v)}
     return dct
 
 def _set_vars_in_module(module,dct_vars):
@@ -0,0 +1,67 @@
+"""
+Permutation tests with a sequential stopping rule.
+
+Instead of running a fixed number of permutations (and starting over with more permutations when
+too few of them are as extreme as the observed statistic), the permutations are generated in blocks
+of growing size and the test stops as soon as min_hits permuted statistics were at least as extreme
+as the observed one (Besag & Clifford, 1991). Significant results need many permutations, but most
+results are not significant and stop after a few dozen.
+"""
+
+import numpy as np
+from sklearn.datasets.base import Bunch
+from utils.matrix_stats import rank_rows
+
+def sequential_permutation_test(f_permuted_statistics, observed, min_hits=10, max_permutations=10**5, first_block=100):
+    """ f_permuted_statistics(n) - returns an array with the statistic for n new random permutations
+        observed - the statistic of the data. The test is two sided (compares absolute values).
+        Returns Bunch with:
+          pval - h/L if the test stopped after L permutations with h=min_hits hits. Otherwise
+                 (hits+1)/(max_permutations+1), where hits is the number of hits in all the permutations.
+          n_permutations - the number of permutations that were used
+          n_hits - the number of permuted statistics that were at least as extreme as the observed one
+          stopped_early - whether the test reached min_hits (otherwise the p-value is an upper bound for
+                          very small p-values)
+    """
+    if np.isnan(observed):
+        return Bunch(pval=np.nan, n_permutations=0, n_hits=0, stopped_early=False)
+    n_done = 0
+    n_hits = 0
+    block = first_block
+    while n_done < max_permutations:
+        n = min(block, max_permutations - n_done)
+        hits = np.abs(f_permuted_statistics(n)) >= abs(observed)*(1 - 1E-12) # ties shouldn't depend on rounding errors
+        cumulative_hits = n_hits + np.cumsum(hits)
+        if cumulative_hits[-1] >= min_hits:
+            n_used = n_done + np.argmax(cumulative_hits >= min_hits) + 1 # the permutations after the last hit are not needed
+            return Bunch(pval=float(min_hits)/n_used, n_permutations=n_used, n_hits=min_hits, stopped_early=True)
+        n_done += n
+        n_hits = cumulative_hits[-1]
+        block *= 2 # the permutations so far are kept, so each block doubles the total
+    return Bunch(pval=(n_hits+1.0)/(n_done+1), n_permutations=n_done, n_hits=n_hits, stopped_early=False)
+
+def paired_rank_correlation_test(x, rng, max_block_elements=10**7, **kw):
+    """ x - two dimensional array. The Spearman rho of each row with its order (0,1,2...) measures its monotonicity.
+        The statistic is the average rho across the rows, and the null hypothesis is that the values in each
+        row are in random order. The permutations only reorder the ranks of each row, so the ranks and their
+        norms are computed once, and the statistic of each block of permutations is computed with matrix products.
+        Returns (mean rho, Bunch from sequential_permutation_test). kw are passed to sequential_permutation_test.
+    """
+    m, n = x.shape
+    ranks = rank_rows(x)
+    ranks = ranks - ranks.mean(axis=1)[:,np.newaxis]
+    order = np.arange(n) - (n-1)/2.0
+    norms = np.sqrt((ranks**2).sum(axis=1)) * np.sqrt((order**2).sum()) # a constant row has no rho (NaN)
+    def mean_rho(permuted_order):
+        # permuting the order instead of the ranks gives the same distribution of rho
+        return ((permuted_order * ranks).sum(axis=-1) / norms).mean(axis=-1)
+    observed = mean_rho(order)
+    def f_permuted_statistics(n_permutations):
+        res = np.empty(n_permutations)
+        block = max(1, max_block_elements // (m*n))
+        for i in xrange(0, n_permutations, block):
+            k = min(block, n_permutations-i)
+            perms = np.argsort(rng.rand(k, m, n), axis=2)
+            res[i:i+k] = mean_rho(order[perms])
+        return res
+    return observed, sequential_permutation_test(f_permuted_statistics, observed, **kw)
@@ -0,0 +1,132 @@
+"""
+Memory mapped arrays that hold the results of a job_splitting computation, one slot per key.
+
+Instead of returning each result to the parent process (which means pickling it back, and then
+pickling it again for the checkpoints), the workers write the fields of the result directly into
+the slot of its key. The arrays are files in the cache, so they are also the checkpoint of the
+computation: a slot whose status is set holds a complete result.
+
+Only results that are Bunches of numeric arrays / scalars (or None) can be stored this way.
+Each field has a maximal shape, and the actual shape of each value is kept next to it, so e.g.
+predictions for series of different lengths can be stored in the same array.
+"""
+
+import cPickle as pickle
+import shutil
+from os.path import join, isdir, isfile
+import numpy as np
+from numpy.lib.format import open_memmap
+from sklearn.datasets.base import Bunch
+from utils.misc import ensure_dir
+
+class ResultArrays(object):
+    def __init__(self, fields, constants=None):
+        """ fields - dictionary field name -> maximal shape of the field's value (() for scalars)
+            constants - dictionary of fields that are the same for all the results. They are not
+                        stored, and are added back to each result when it is read.
+        """
+        self.fields = fields
+        self.constants = constants if constants is not None else {}
+        self.dirname = None
+
+    def __getstate__(self):
+        # workers only need to know where the arrays are. They open the files themselves.
+        return dict(fields=self.fields, dirname=self.dirname)
+
+    def __setstate__(self, dct):
+        self.fields = dct['fields']
+        self.constants = {}
+        self.dirname = None
+        if dct['dirname'] is not None:
+            self._open(dct['dirname'], mode='r+')
+
+    def read(self, dirname, keys):
+        """Returns a dictionary key -> result for all the keys that have a result in
+           the arrays at dirname (e.g. from a computation that was interrupted).
+        """
+        if not isfile(join(dirname,'meta.pkl')):
+            return {}
+        try:
+            self._open(dirname, mode='r')
+        except:
+            print 'Failed to read results arrays from {}'.format(dirname)
+            return {}
+        st_keys = set(keys)
+        try:
+            return {k:self.get(k) for k in self.done_keys() if k in st_keys}
+        finally:
+            self.close()
+
+    def create(self, dirname, keys):
+        """Creates new (empty) arrays with a slot for each key"""
+        if isdir(dirname):
+            shutil.rmtree(dirname)
+        ensure_dir(dirname)
+        n = len(keys)
+        open_memmap(join(dirname,'status.npy'), mode='w+', dtype=np.int8, shape=(n,))
+        for name,shape in self.fields.iteritems():
+            arr = open_memmap(join(dirname,name + '.npy'), mode='w+', dtype=float, shape=(n,) + shape)
+            arr[:] = np.NaN
+            # column 0 says whether the value is not None, the rest is the actual shape of the value
+            open_memmap(join(dirname,name + '-shape.npy'), mode='w+', dtype=np.int32, shape=(n,len(shape)+1))
+            del arr
+        # the meta file is written last, so a directory with a meta file is complete
+        with open(join(dirname,'meta.pkl'),'w') as f:
+            pickle.dump((list(keys), self.fields), f)
+        self._open(dirname, mode='r+')
+
+    def store(self, key, val):
+        """Writes the result for key into its slot. The status is set last."""
+        i = self._key_to_slot[key]
+        for name in self.fields:
+            x = val[name]
+            shape = self._shapes[name]
+            if x is None:
+                shape[i,0] = 0
+            else:
+                x = np.asarray(x)
+                shape[i,0] = 1
+                shape[i,1:] = x.shape
+                self._arrays[name][(i,) + tuple(slice(0,n) for n in x.shape)] = x
+        self._status[i] = 1
+
+    def get(self, key):
+        """Reads the result for key from its slot (as a Bunch with copies of the values)"""
+        i = self._key_to_slot[key]
+        res = Bunch(**self.constants)
+        for name in self.fields:
+            shape = self._shapes[name][i]
+            if shape[0] == 0:
+                res[name] = None
+            else:
+                res[name] = np.array(self._arrays[name][(i,) + tuple(slice(0,n) for n in shape[1:])])
+                if res[name].ndim == 0:
+                    res[name] = res[name][()]
+        return res
+
+    def done_keys(self):
+        return [self._keys[i] for i in self._status.nonzero()[0]]
+
+    def flush(self):
+        for arr in [self._status] + self._arrays.values() + self._shapes.values():
+            arr.flush()
+
+    def close(self):
+        self.dirname = None
+        self._keys = self._key_to_slot = self._status = self._arrays = self._shapes = None
+
+    #####################################################################
+    # Private helper methods
+    #####################################################################
+
+    def _open(self, dirname, mode):
+        with open(join(dirname,'meta.pkl')) as f:
+            keys, fields = pickle.load(f)
+        if fields != self.fields:
+            raise AssertionError('Result arrays in {} have different fields'.format(dirname))
+        self.dirname = dirname
+        self._keys = keys
+        self._key_to_slot = {k:i for i,k in enumerate(keys)}
+        self._status = open_memmap(join(dirname,'status.npy'), mode=mode)
+        self._arrays = {name:open_memmap(join(dirname,name + '.npy'), mode=mode) for name in fields}
+        self._shapes = {name:open_memmap(join(dirname,name + '-shape.npy'), mode=mode) for name in fields}
@@ -0,0 +1,221 @@
+"""
+A work queue for splitting a computation between any number of processes, on one machine or on
+several machines that share the cache directory. It's an sqlite database, so no service is needed.
+
+The work is a list of chunks (e.g. lists of genes). Each process repeatedly claims a chunk,
+computes it, and marks it as done. A claimed chunk is leased for cfg.work_queue_lease_seconds and
+the lease is renewed in the background while the process is alive, so the chunks of a process that
+crashed are claimed again by others once their lease expires.
+When all the chunks are done, exactly one of the processes gets to consolidate the results.
+The queue is kept after that, so processes that join late find it finished (see is_finished) instead
+of computing everything again. A new queue is started only when it's asked for explicitly. Each queue
+has a generation id (a fingerprint of its chunks and its creator), so processes that still work on a
+queue that was replaced stop instead of taking chunks of the new one.
+
+NOTE: Leases use the wall clock, so the clocks of the machines should be (roughly) synchronized.
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from os.path import dirname
+import config as cfg
+from utils.misc import ensure_dir
+
+class WorkQueue(object):
+    def __init__(self, filename, chunks, new=False):
+        """ filename - the database file. The first process to use it creates the queue.
+            chunks - list of chunks (picklable) to add to the queue if it's new. The chunks are claimed in this order.
+            new - start a new queue even if the database already has one (finished or not). Otherwise the
+                  existing queue is used as is.
+        """
+        self.filename = filename
+        self.owner = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), random.randint(0,10**6))
+        self.claimed = set() # chunk ids this process is working on
+        self._heartbeat = None
+        ensure_dir(dirname(filename))
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, chunk BLOB, state TEXT, owner TEXT, lease_expires REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            if new:
+                db.execute('DELETE FROM meta')
+            self.generation = _read_meta(db, 'generation')
+            if self.generation is None:
+                pickled = [pickle.dumps(chunk,protocol=2) for chunk in chunks]
+                self.generation = hashlib.sha1(''.join(pickled) + self.owner + repr(time.time())).hexdigest()[:16]
+                db.execute('DELETE FROM chunks')
+                db.execute('DELETE FROM meta')
+                db.executemany('INSERT INTO chunks (id,chunk,state) VALUES (?,?,?)', [(i, sqlite3.Binary(p), 'pending') for i,p in enumerate(pickled)])
+                db.execute("INSERT INTO meta (name,value) VALUES ('generation',?)", (self.generation,))
+                if cfg.verbosity > 0:
+                    print 'Created work queue {} with {} chunks at {}'.format(self.generation, len(pickled), filename)
+
+    def claim(self):
+        """Returns (chunk id, chunk) for the next chunk that isn't done and isn't leased by a live process
+           or None if there is no such chunk right now.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            if not self._is_current(db):
+                return None
+            row = db.execute(
+                "SELECT id, chunk FROM chunks WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            chunk_id, chunk = row
+            db.execute(
+                "UPDATE chunks SET state = 'leased', owner = ?, lease_expires = ? WHERE id = ?",
+                (self.owner, now + cfg.work_queue_lease_seconds, chunk_id)
+            )
+        self.claimed.add(chunk_id)
+        self._start_heartbeat()
+        return chunk_id, pickle.loads(str(chunk))
+
+    def done(self, chunk_id):
+        """Marks the chunk as done (even if its lease was taken by someone else meanwhile - the results are the same)"""
+        with self._transaction() as db:
+            if self._is_current(db): # the ids of a new queue are different chunks
+                db.execute("UPDATE chunks SET state = 'done', owner = ? WHERE id = ?", (self.owner, chunk_id))
+        self.claimed.discard(chunk_id)
+
+    def all_chunks(self):
+        """Returns the list of all the chunks in the queue (in the order of their ids)"""
+        with self._transaction() as db:
+            rows = db.execute('SELECT chunk FROM chunks ORDER BY id').fetchall()
+        return [pickle.loads(str(chunk)) for chunk, in rows]
+
+    def counts(self):
+        """Returns (number of chunks done, total number of chunks)"""
+        with self._transaction() as db:
+            n_done, = db.execute("SELECT COUNT(*) FROM chunks WHERE state = 'done'").fetchone()
+            n, = db.execute('SELECT COUNT(*) FROM chunks').fetchone()
+        return n_done, n
+
+    def all_done(self):
+        n_done, n = self.counts()
+        return n_done == n
+
+    def is_current(self):
+        """Returns False if the queue this process opened was replaced by a new one"""
+        with self._transaction() as db:
+            return self._is_current(db)
+
+    def is_finished(self):
+        """Returns True if all the chunks were done and a process already claimed the consolidation"""
+        with self._transaction() as db:
+            return self._is_current(db) and _read_meta(db, 'consolidation') is not None
+
+    def claim_consolidation(self):
+        """Returns True for exactly one process (the first to call this after all the chunks are done)"""
+        if not self.all_done():
+            return False
+        with self._transaction() as db:
+            if not self._is_current(db) or _read_meta(db, 'consolidation') is not None:
+                return False
+            db.execute("INSERT INTO meta (name,value) VALUES ('consolidation',?)", (self.owner,))
+        return True
+
+    def process_all(self, f_process, poll_seconds=None):
+        """Claims chunks and calls f_process(chunk) for each of them until all the chunks are done.
+           While other processes are working on the remaining chunks this process waits, in case
+           one of them crashes and its chunks need to be claimed again.
+        """
+        if poll_seconds is None:
+            poll_seconds = cfg.work_queue_poll_seconds
+        try:
+            while True:
+                claimed = self.claim()
+                if claimed is None:
+                    if not self.is_current():
+                        print 'The work queue in {} was replaced by a new one. Stopping.'.format(self.filename)
+                        break
+                    n_done, n = self.counts()
+                    if n_done == n:
+                        break
+                    if cfg.verbosity > 0:
+                        print 'Waiting for other processes to finish their chunks ({}/{} done)'.format(n_done, n)
+                    time.sleep(poll_seconds)
+                    continue
+                chunk_id, chunk = claimed
+                if cfg.verbosity > 0:
+                    n_done, n = self.counts()
+                    print 'Claimed chunk {} ({}/{} done)'.format(chunk_id, n_done, n)
+                f_process(chunk)
+                self.done(chunk_id)
+        finally:
+            self._stop_heartbeat()
+
+    #####################################################################
+    # Private helper methods
+    #####################################################################
+
+    def _transaction(self):
+        return _Transaction(self.filename)
+
+    def _is_current(self, db):
+        return _read_meta(db, 'generation') == self.generation
+
+    def _renew_leases(self):
+        if not self.claimed:
+            return
+        ids = list(self.claimed)
+        with self._transaction() as db:
+            if not self._is_current(db):
+                return
+            db.execute(
+                "UPDATE chunks SET lease_expires = ? WHERE owner = ? AND state = 'leased' AND id IN ({})".format(','.join('?'*len(ids))),
+                [time.time() + cfg.work_queue_lease_seconds, self.owner] + ids
+            )
+
+    def _start_heartbeat(self):
+        if self._heartbeat is not None:
+            return
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(cfg.work_queue_lease_seconds / 3.0):
+                try:
+                    self._renew_leases()
+                except sqlite3.Error as e:
+                    print 'Failed to renew leases in {}: {}'.format(self.filename, e)
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        self._heartbeat = (thread, stop)
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is None:
+            return
+        thread, stop = self._heartbeat
+        stop.set()
+        thread.join()
+        self._heartbeat = None
+
+def _read_meta(db, name):
+    row = db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return row[0] if row is not None else None
+
+class _Transaction(object):
+    """Opens a connection (so it can be used from any thread) and holds the database write lock until exit"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.db.execute('COMMIT')
+            else:
+                self.db.execute('ROLLBACK')
+        finally:
+            self.db.close()
@@ -3,12 +3,11 @@ import setup
 from os.path import join
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import wilcoxon
 import config as cfg
 from load_data import GeneData
 from shapes.sigmoid import Sigmoid
 from fitter import Fitter
-from all_fits import get_all_fits, iterate_fits
+from permutation_null import get_null_scores
 from scalers import LogScaler
 from plots import save_figure
 from project_dirs import results_dir
@@ -57,15 +56,15 @@ cfg.verbosity = 1
 age_scaler = LogScaler()
 pathway = '17full'
 data = GeneData.load('both').restrict_pathway(pathway).scale_ages(age_scaler)
-data_shuffled = GeneData.load('both').restrict_pathway(pathway).scale_ages(age_scaler).shuffle()
+n_permutations = 200
 
 shape = Sigmoid('sigmoid_wide')
 fitter = Fitter(shape,sigma_prior='normal')
-fits = get_all_fits(data,fitter,allow_new_computation=False)
-fits_shuffled = get_all_fits(data_shuffled,fitter,allow_new_computation=False)
-R2_pairs = [(fit.LOO_score,fit2.LOO_score) for fit,fit2 in iterate_fits(fits,fits_shuffled)]
-R2 = np.array([r for r,r_shuffled in R2_pairs])
-R2_shuffled = np.array([r_shuffled for r,r_shuffled in R2_pairs])
+null_scores = get_null_scores(data,fitter,n_permutations)
+# the original scores are compared with the shuffled ones, so both are fitted with the same (reduced) settings
+R2 = np.array([score for dsnull in null_scores.itervalues() for score in dsnull.observed.itervalues()])
+R2_shuffled = np.concatenate([dsnull.all_scores() for dsnull in null_scores.itervalues()])
+p_values = np.array([p for dsnull in null_scores.itervalues() for p in dsnull.p_values().itervalues()])
 
 name = '{}-{}'.format(data.pathway,shape.cache_name())
 fig = plot_score_distribution(R2,R2_shuffled)
@@ -77,7 +76,6 @@ z_scores = (R2-mu_shuffled)/std_shuffled
 fig = plot_z_scores(z_scores)
 save_figure(fig,'RP/R2-z-scores-{}.png'.format(name), under_results=True, b_close=True)
 
-T, signed_rank_p_value = wilcoxon(R2, R2_shuffled)
 maxShuffled = R2_shuffled.max()
 nAbove = np.count_nonzero(R2 > maxShuffled)
 nTotal = len(R2)
@@ -91,4 +89,7 @@ with open(filename,'w') as f:
         nAbove = np.count_nonzero(z_scores > z_threshold)
         pct = 100.0 * nAbove/nTotal
         print('{:.2g}% ({}/{}) of z-scores are above {}'.format(pct,nAbove,nTotal,z_threshold), file=f)
-    print('wilxocon signed-rank p-value = {:.2g}'.format(signed_rank_p_value), file=f)
\ No newline at end of file
+    for p_threshold in [0.05, 0.01]:
+        nBelow = np.count_nonzero(p_values < p_threshold)
+        pct = 100.0 * nBelow/len(p_values)
+        print('{:.2g}% ({}/{}) of permutation p-values ({} permutations per series) are below {}'.format(pct,nBelow,len(p_values),n_permutations,p_threshold), file=f)
\ No newline at end of file
@@ -11,6 +11,7 @@ from load_data import GeneData
 from shapes.sigslope import Sigslope
 from fitter import Fitter
 from scalers import LogScaler
+from utils.matrix_stats import wilcoxon_rows
 import scipy.stats
 
 fontsize = 30
@@ -21,7 +22,7 @@ def plot_comparison_bar(tuples, several_levels=False):
         levels = levels[:2]
         
     scores_no_correlations, scores_with_correlations = levels[0], levels[1]
-    _, pval = scipy.stats.wilcoxon(scores_no_correlations, scores_with_correlations)
+    _, pval = wilcoxon_rows(scores_no_correlations, scores_with_correlations)
     pval = pval/2  # one sided p-value
     print '*** wilcoxon signed rank p-value (one sided) = {:.3g}'.format(pval)
     
@@ -7,6 +7,7 @@ import config as cfg
 from load_data import GeneData, load_17_pathways_breakdown
 from shapes.sigmoid import Sigmoid
 from fitter import Fitter
+from sigmoid_change_distribution import calc_change_distributions
 from all_fits import get_all_fits, restrict_genes, iterate_fits
 from scalers import LogScaler
 from dev_stages import dev_stages
@@ -27,12 +28,9 @@ def compute_change_distribution(shape, thetas, from_age, to_age, n_bins=50, b_no
     assert shape.cache_name() == 'sigmoid' # we use parameter h explicitly
     bin_edges, bin_size = np.linspace(from_age, to_age, n_bins+1, retstep=True)
     change_vals = np.zeros(n_bins)
-    for g,r,t in thetas:
-        a,h,mu,w = t
-        edge_vals = shape.f(t,bin_edges)
-        changes = np.abs(edge_vals[1:] - edge_vals[:-1])
-        # ignore change magnitude per gene - take only distribution of change times
-        change_vals += changes / abs(h)
+    if len(thetas) > 0:
+        theta = np.array([t for g,r,t in thetas]).T
+        change_vals += calc_change_distributions(shape, theta, bin_edges).sum(axis=0)
     if b_normalize:
         change_vals /= sum(change_vals)
     return bin_edges, change_vals